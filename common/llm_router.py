@@ -0,0 +1,455 @@
+"""
+模型提供商路由（llm_name="auto"）
+
+RouterModelClient 包装多个提供商的共享客户端：
+- 按实时的 EWMA 延迟（流式为首token时间）和错误率为提供商打分，选择得分最低的
+- 对冲请求：先返回者胜出，每次请求最多对冲一次
+  - 流式：主请求在 LLM_ROUTER_HEDGE_DELAY 秒内没有返回首token时，向次优提供商发起备份请求
+  - 非流式：整个回答的耗时与回答长度有关，不使用固定延迟；主请求超过该提供商完整响应耗时的
+    百分位（LLM_ROUTER_HEDGE_PERCENTILE，按 EWMA 均值和方差估算）仍未返回时才发起备份请求，样本不足时不对冲
+- 熔断：连续失败达到阈值后暂停使用该提供商，冷却后放行一个探测请求
+- 故障转移：请求失败时自动改用下一个提供商；流式输出中途断开时，把已输出的内容作为上下文让下一个提供商续写
+- 胜出的提供商通过 report_served_provider 报告给调用方（见 common/llms.py 的 track_served_provider），用于按实际提供商记录用量
+"""
+import asyncio
+import math
+import os
+import time
+from dataclasses import dataclass
+from statistics import NormalDist
+from typing import Any, AsyncGenerator, Dict, List, Literal, Mapping, Optional, Sequence, Set, Tuple, Union
+
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    AssistantMessage,
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelCapabilities,
+    ModelInfo,
+    RequestUsage,
+    UserMessage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+from common.llms import MODEL_INFO, client_registry, get_provider_config, names, report_served_provider
+
+# 参与路由的提供商（逗号分隔），为空时使用所有已配置 model_/base_url_ 的提供商
+LLM_ROUTER_PROVIDERS: str = os.getenv("LLM_ROUTER_PROVIDERS", "")
+# EWMA 平滑系数
+LLM_ROUTER_EWMA_ALPHA: float = float(os.getenv("LLM_ROUTER_EWMA_ALPHA", "0.3"))
+# 流式对冲延迟（秒，等待首token的时间），<=0 表示流式请求不发起对冲
+LLM_ROUTER_HEDGE_DELAY: float = float(os.getenv("LLM_ROUTER_HEDGE_DELAY", "3"))
+# 非流式对冲阈值：完整响应耗时的百分位（0-100），<=0 表示非流式请求不发起对冲
+LLM_ROUTER_HEDGE_PERCENTILE: float = float(os.getenv("LLM_ROUTER_HEDGE_PERCENTILE", "95"))
+# 非流式对冲所需的最少样本数（该提供商成功完成的非流式请求数）
+LLM_ROUTER_HEDGE_MIN_SAMPLES: int = int(os.getenv("LLM_ROUTER_HEDGE_MIN_SAMPLES", "20"))
+# 连续失败多少次后熔断，以及熔断冷却时间（秒）
+LLM_ROUTER_FAILURE_THRESHOLD: int = int(os.getenv("LLM_ROUTER_FAILURE_THRESHOLD", "3"))
+LLM_ROUTER_COOLDOWN: float = float(os.getenv("LLM_ROUTER_COOLDOWN", "30"))
+# 单次请求最多尝试的提供商数量
+LLM_ROUTER_MAX_ATTEMPTS: int = int(os.getenv("LLM_ROUTER_MAX_ATTEMPTS", "3"))
+
+# 错误率对得分的惩罚系数：得分 = 延迟 * (1 + 惩罚系数 * 错误率)
+ERROR_PENALTY = 10.0
+# 流式输出中途断开后，请下一个提供商续写的提示
+CONTINUE_PROMPT = "上面的回答被中断了，请从中断处直接继续输出剩余内容，不要重复已经输出的部分。"
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+_DONE = object()
+
+
+@dataclass
+class ProviderStats:
+    """单个提供商的实时统计和熔断状态"""
+    name: str
+    latency: Optional[float] = None
+    error_rate: float = 0.0
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    state: str = CIRCUIT_CLOSED
+    open_until: float = 0.0
+    probing: bool = False
+    # 非流式完整响应耗时的 EWMA 均值、方差和样本数（用于非流式对冲阈值）
+    completion_latency: Optional[float] = None
+    completion_variance: float = 0.0
+    completion_samples: int = 0
+
+    def record_completion(self, latency: float, alpha: float) -> None:
+        self.completion_samples += 1
+        if self.completion_latency is None:
+            self.completion_latency = latency
+            return
+        diff = latency - self.completion_latency
+        self.completion_latency += alpha * diff
+        self.completion_variance = (1 - alpha) * (self.completion_variance + alpha * diff * diff)
+
+    def completion_quantile(self, z: float) -> Optional[float]:
+        """完整响应耗时的百分位估计（按正态近似），没有数据时为 None"""
+        if self.completion_latency is None:
+            return None
+        return self.completion_latency + z * math.sqrt(self.completion_variance)
+
+    def score(self, default_latency: float) -> float:
+        # 没有延迟数据的提供商按当前最快的延迟估算，以便尽快被尝试并获得统计
+        latency = self.latency if self.latency is not None else default_latency
+        return latency * (1 + ERROR_PENALTY * self.error_rate)
+
+    def available(self, now: float) -> bool:
+        if self.state == CIRCUIT_OPEN:
+            return now >= self.open_until
+        if self.state == CIRCUIT_HALF_OPEN:
+            return not self.probing
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "latency": round(self.latency, 4) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 4),
+            "requests": self.requests,
+            "failures": self.failures,
+            "state": self.state,
+            "completion_latency": round(self.completion_latency, 4) if self.completion_latency is not None else None,
+            "completion_samples": self.completion_samples,
+        }
+
+
+def configured_providers() -> List[str]:
+    """参与路由的提供商列表"""
+    if LLM_ROUTER_PROVIDERS.strip():
+        return [name.strip() for name in LLM_ROUTER_PROVIDERS.split(",") if name.strip() in names]
+    return [name for name in names if get_provider_config(name)["model"] and get_provider_config(name)["base_url"]]
+
+
+class RouterModelClient(ChatCompletionClient):
+    """按延迟和错误率在多个提供商之间路由、对冲和故障转移的模型客户端"""
+
+    def __init__(
+            self,
+            providers: Sequence[str],
+            hedge_delay: float = LLM_ROUTER_HEDGE_DELAY,
+            hedge_percentile: float = LLM_ROUTER_HEDGE_PERCENTILE,
+            hedge_min_samples: int = LLM_ROUTER_HEDGE_MIN_SAMPLES,
+            max_attempts: int = LLM_ROUTER_MAX_ATTEMPTS,
+            alpha: float = LLM_ROUTER_EWMA_ALPHA,
+            failure_threshold: int = LLM_ROUTER_FAILURE_THRESHOLD,
+            cooldown: float = LLM_ROUTER_COOLDOWN
+    ):
+        if not providers:
+            raise ValueError("没有可供路由的模型提供商，请配置 LLM_ROUTER_PROVIDERS 或 model_/base_url_ 环境变量")
+        self.providers = list(providers)
+        self.hedge_delay = hedge_delay
+        # 非流式对冲阈值对应的标准正态分位数，None 表示不对冲
+        self.hedge_z = NormalDist().inv_cdf(min(hedge_percentile, 99.9) / 100) if hedge_percentile > 0 else None
+        self.hedge_min_samples = max(hedge_min_samples, 1)
+        self.max_attempts = max(max_attempts, 1)
+        self.alpha = alpha
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._stats: Dict[str, ProviderStats] = {name: ProviderStats(name) for name in self.providers}
+        self._actual_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+        self._total_usage = RequestUsage(prompt_tokens=0, completion_tokens=0)
+
+    # ---------- 统计与熔断 ----------
+
+    def rank(self, exclude: Set[str] = frozenset()) -> List[str]:
+        """按得分从低到高返回当前可用的提供商"""
+        now = time.monotonic()
+        candidates = [s for s in self._stats.values() if s.name not in exclude and s.available(now)]
+        known = [s.latency for s in self._stats.values() if s.latency is not None]
+        default_latency = min(known) if known else 1.0
+        return [s.name for s in sorted(candidates, key=lambda s: s.score(default_latency))]
+
+    def _begin(self, name: str) -> None:
+        stats = self._stats[name]
+        stats.requests += 1
+        if stats.state == CIRCUIT_OPEN:
+            # 冷却结束，放行一个探测请求
+            stats.state = CIRCUIT_HALF_OPEN
+        if stats.state == CIRCUIT_HALF_OPEN:
+            stats.probing = True
+
+    def _record_latency(self, name: str, latency: float) -> None:
+        stats = self._stats[name]
+        stats.latency = latency if stats.latency is None else self.alpha * latency + (1 - self.alpha) * stats.latency
+
+    def _record_success(self, name: str, latency: float) -> None:
+        stats = self._stats[name]
+        self._record_latency(name, latency)
+        stats.error_rate = (1 - self.alpha) * stats.error_rate
+        stats.consecutive_failures = 0
+        stats.state = CIRCUIT_CLOSED
+        stats.probing = False
+
+    def _record_failure(self, name: str) -> None:
+        stats = self._stats[name]
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        stats.error_rate = self.alpha + (1 - self.alpha) * stats.error_rate
+        stats.probing = False
+        if stats.state == CIRCUIT_HALF_OPEN or stats.consecutive_failures >= self.failure_threshold:
+            stats.state = CIRCUIT_OPEN
+            stats.open_until = time.monotonic() + self.cooldown
+
+    def _release(self, name: str, elapsed: Optional[float] = None) -> None:
+        """
+        请求被取消（对冲失败方）时释放探测名额，不计入成功/失败
+
+        :param elapsed: 尚未返回首token时已等待的时间，作为延迟的下限计入 EWMA，避免慢提供商一直保持"未知"
+        """
+        self._stats[name].probing = False
+        if elapsed is not None:
+            self._record_latency(name, elapsed)
+
+    def _add_usage(self, usage: RequestUsage) -> None:
+        self._actual_usage = RequestUsage(
+            prompt_tokens=self._actual_usage.prompt_tokens + usage.prompt_tokens,
+            completion_tokens=self._actual_usage.completion_tokens + usage.completion_tokens,
+        )
+        self._total_usage = RequestUsage(
+            prompt_tokens=self._total_usage.prompt_tokens + usage.prompt_tokens,
+            completion_tokens=self._total_usage.completion_tokens + usage.completion_tokens,
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: stats.to_dict() for name, stats in self._stats.items()}
+
+    def completion_hedge_delay(self, name: str) -> Optional[float]:
+        """非流式请求的对冲等待时间：该提供商完整响应耗时的百分位，样本不足或已关闭时为 None"""
+        stats = self._stats[name]
+        if self.hedge_z is None or stats.completion_samples < self.hedge_min_samples:
+            return None
+        return stats.completion_quantile(self.hedge_z)
+
+    # ---------- 非流式 ----------
+
+    async def _create_one(self, name: str, messages: Sequence[LLMMessage], kwargs: Dict[str, Any]) -> CreateResult:
+        self._begin(name)
+        start = time.monotonic()
+        try:
+            result = await client_registry.get(name).create(messages, **kwargs)
+        except asyncio.CancelledError:
+            self._release(name, time.monotonic() - start)
+            raise
+        except Exception:
+            self._record_failure(name)
+            raise
+        latency = time.monotonic() - start
+        self._record_success(name, latency)
+        self._stats[name].record_completion(latency, self.alpha)
+        return result
+
+    async def create(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        kwargs = dict(tools=tools, tool_choice=tool_choice, json_output=json_output,
+                      extra_create_args=extra_create_args, cancellation_token=cancellation_token)
+        tried: Set[str] = set()
+        pending: Dict[asyncio.Task, str] = {}
+        started: Dict[asyncio.Task, float] = {}
+        last_error: Optional[BaseException] = None
+        hedged = False
+
+        def launch() -> bool:
+            candidates = self.rank(tried)
+            if not candidates or len(tried) >= self.max_attempts:
+                return False
+            name = candidates[0]
+            tried.add(name)
+            task = asyncio.create_task(self._create_one(name, messages, kwargs))
+            pending[task] = name
+            started[task] = time.monotonic()
+            return True
+
+        try:
+            launch()
+            while pending:
+                hedge = None
+                if len(pending) == 1 and not hedged:
+                    task, name = next(iter(pending.items()))
+                    threshold = self.completion_hedge_delay(name)
+                    if threshold is not None:
+                        hedge = max(threshold - (time.monotonic() - started[task]), 0)
+                done, _ = await asyncio.wait(pending, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超过该提供商完整响应耗时的百分位仍未返回，向次优提供商发起备份请求（每次请求只对冲一次）
+                    hedged = True
+                    launch()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        result = task.result()
+                        self._add_usage(result.usage)
+                        report_served_provider(name)
+                        return result
+                    last_error = task.exception()
+                if not pending:
+                    # 全部失败，故障转移到下一个提供商
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise last_error or RuntimeError("没有可用的模型提供商")
+
+    # ---------- 流式 ----------
+
+    async def _pump(
+            self,
+            name: str,
+            messages: Sequence[LLMMessage],
+            kwargs: Dict[str, Any],
+            queue: "asyncio.Queue[Tuple[str, Any]]"
+    ) -> None:
+        """把单个提供商的流式输出转发到队列，首个输出时记录首token时间"""
+        self._begin(name)
+        start = time.monotonic()
+        first = True
+        try:
+            async for item in client_registry.get(name).create_stream(messages, **kwargs):
+                if first:
+                    first = False
+                    self._record_success(name, time.monotonic() - start)
+                await queue.put((name, item))
+            await queue.put((name, _DONE))
+        except asyncio.CancelledError:
+            self._release(name, time.monotonic() - start if first else None)
+            raise
+        except Exception as e:
+            self._record_failure(name)
+            await queue.put((name, e))
+
+    async def create_stream(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        kwargs = dict(tools=tools, tool_choice=tool_choice, json_output=json_output,
+                      extra_create_args=extra_create_args, cancellation_token=cancellation_token)
+        tried: Set[str] = set()
+        emitted: List[str] = []
+        last_error: Optional[BaseException] = None
+
+        while len(tried) < self.max_attempts:
+            candidates = self.rank(tried)
+            if not candidates:
+                break
+            prefix = "".join(emitted)
+            attempt_messages = list(messages)
+            if prefix:
+                attempt_messages += [
+                    AssistantMessage(content=prefix, source="assistant"),
+                    UserMessage(content=CONTINUE_PROMPT, source="user"),
+                ]
+
+            queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+            tasks: Dict[str, asyncio.Task] = {}
+            backups = candidates[1:]
+            winner: Optional[str] = None
+
+            def launch(name: str) -> None:
+                tried.add(name)
+                tasks[name] = asyncio.create_task(self._pump(name, attempt_messages, kwargs, queue))
+
+            launch(candidates[0])
+            try:
+                while tasks:
+                    # 只有在尚未输出内容、且本次尝试还没对冲过时才等待对冲
+                    can_hedge = (winner is None and not prefix and len(tasks) == 1 and backups
+                                 and self.hedge_delay > 0 and len(tried) < self.max_attempts)
+                    try:
+                        name, item = await asyncio.wait_for(queue.get(), self.hedge_delay if can_hedge else None)
+                    except asyncio.TimeoutError:
+                        launch(backups.pop(0))
+                        continue
+
+                    if winner is not None and name != winner:
+                        continue
+                    if isinstance(item, Exception):
+                        tasks.pop(name, None)
+                        last_error = item
+                        if winner is None and tasks:
+                            # 对冲中的另一个请求仍在进行
+                            continue
+                        break
+                    if item is _DONE:
+                        return
+                    if winner is None:
+                        # 首个输出的提供商胜出，取消其余请求
+                        winner = name
+                        report_served_provider(name)
+                        for other, task in tasks.items():
+                            if other != name:
+                                task.cancel()
+                    if isinstance(item, CreateResult):
+                        self._add_usage(item.usage)
+                        if prefix and isinstance(item.content, str):
+                            item = item.model_copy(update={"content": prefix + item.content})
+                        yield item
+                        return
+                    emitted.append(item)
+                    yield item
+            finally:
+                for task in tasks.values():
+                    task.cancel()
+
+        raise last_error or RuntimeError("没有可用的模型提供商")
+
+    # ---------- 其他接口 ----------
+
+    async def close(self) -> None:
+        # 底层共享客户端由注册表统一关闭
+        pass
+
+    def actual_usage(self) -> RequestUsage:
+        return self._actual_usage
+
+    def total_usage(self) -> RequestUsage:
+        return self._total_usage
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return client_registry.get((self.rank() or self.providers)[0]).count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return client_registry.get((self.rank() or self.providers)[0]).remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self.model_info  # type: ignore
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return dict(MODEL_INFO)  # type: ignore
+
+
+_router: Optional[RouterModelClient] = None
+
+
+def get_router() -> RouterModelClient:
+    """获取全局路由客户端（首次使用时按配置创建）"""
+    global _router
+    if _router is None:
+        _router = RouterModelClient(configured_providers())
+    return _router
+
+
+def router_stats() -> Optional[Dict[str, Any]]:
+    """路由统计，尚未使用路由时返回 None"""
+    return _router.stats() if _router is not None else None
@@ -1,28 +1,137 @@
 import asyncio
 import os
-from typing import Optional
+from contextvars import ContextVar
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Dict, Literal, Mapping, Optional, Sequence, Tuple, Union
 
-from autogen_agentchat.agents import AssistantAgent
-from autogen_core.models import ModelFamily
-from autogen_ext.models.openai import OpenAIChatCompletionClient
-import dotenv
+from autogen_core import CancellationToken
+from autogen_core.models import (
+    ChatCompletionClient,
+    CreateResult,
+    LLMMessage,
+    ModelCapabilities,
+    ModelFamily,
+    ModelInfo,
+    RequestUsage,
+)
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
 
-# 加载环境变量
-dotenv.load_dotenv(r"E:\BaiduSyncdisk\.env")
+from common.rate_limit import ProviderLimiter, RateLimitedModelClient, create_limiter
+
+if TYPE_CHECKING:
+    # 导入 autogen_ext（连带 openai、tiktoken）和 httpx 很慢，只在第一次创建客户端时导入
+    import httpx
+    from autogen_ext.models.openai import OpenAIChatCompletionClient
 
 # 支持的模型名称
 names = ["zhipu", "hug","gf", "bailian", "huoshan", "mota", "xunfei", "gemini", "router", "qik", "moli", "guiji", "deepseek",
          "openai"]
 
+# 自动路由的模型名称（在已配置的提供商之间按延迟和错误率选择，见 common/llm_router.py）
+AUTO_LLM_NAME = "auto"
+
+# 环境变量文件（为空时只使用进程环境变量）；原来写死的路径作为默认值保留
+LLM_ENV_FILE: str = os.getenv("LLM_ENV_FILE", r"E:\BaiduSyncdisk\.env")
+
+MODEL_INFO: ModelInfo = {
+    "vision": False,
+    "function_calling": True,
+    "json_output": True,
+    "family": ModelFamily.UNKNOWN,
+    "structured_output": True,
+    "multiple_system_messages": True,
+}
+
+
+@dataclass(frozen=True)
+class LLMConfig:
+    """模型客户端配置（连接池配置所有共享客户端使用同一组限制）"""
+    pool_max_connections: int = 100
+    pool_max_keepalive: int = 20
+    pool_keepalive_expiry: float = 60.0
+    http_timeout: float = 600.0
+    # 流式请求要求提供商在最后一个块中返回token用量（不支持 stream_options 的提供商可关闭）
+    stream_include_usage: bool = True
+
+    @classmethod
+    def from_env(cls) -> "LLMConfig":
+        return cls(
+            pool_max_connections=int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100")),
+            pool_max_keepalive=int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20")),
+            pool_keepalive_expiry=float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "60")),
+            http_timeout=float(os.getenv("LLM_HTTP_TIMEOUT", "600")),
+            stream_include_usage=os.getenv("LLM_STREAM_INCLUDE_USAGE", "1") != "0",
+        )
+
+
+@lru_cache(maxsize=None)
+def get_llm_config() -> LLMConfig:
+    """
+    加载模型配置（只加载一次）
+
+    第一次调用时读取 LLM_ENV_FILE（不覆盖已有的环境变量），之后读取的提供商配置
+    （model_/base_url_/api_key_、限流参数）都能看到文件中的值。
+    """
+    if LLM_ENV_FILE and os.path.isfile(LLM_ENV_FILE):
+        import dotenv
+        dotenv.load_dotenv(LLM_ENV_FILE)
+    return LLMConfig.from_env()
+
+
+def resolve_llm_name(llm_name: str) -> str:
+    """如果模型名称不在支持列表中（且不是自动路由），使用默认模型"""
+    return llm_name if llm_name in names or llm_name == AUTO_LLM_NAME else "mota"
+
+
+class ServedProvider:
+    """一次调用中实际提供服务的提供商（自动路由时由路由器在选中提供商后写入）"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+# 可变对象在子任务复制的上下文中共享，路由器在对冲/故障转移的子任务中写入后调用方也能看到
+served_provider: ContextVar[Optional[ServedProvider]] = ContextVar("served_provider", default=None)
+
+
+def track_served_provider(llm_name: str) -> ServedProvider:
+    """
+    在当前上下文中开始记录实际提供服务的提供商
+
+    调用结束后读取返回对象的 name；不经过路由器时为 llm_name 解析后的提供商。
+    """
+    tracker = ServedProvider(resolve_llm_name(llm_name))
+    served_provider.set(tracker)
+    return tracker
+
+
+def report_served_provider(name: str) -> None:
+    tracker = served_provider.get()
+    if tracker is not None:
+        tracker.name = name
+
+
+def get_provider_config(llm_name: str) -> Dict[str, Optional[str]]:
+    """读取模型提供商的 model/base_url/api_key 配置"""
+    get_llm_config()
+    llm_name = resolve_llm_name(llm_name)
+    return {
+        "model": os.getenv(f'model_{llm_name}'),
+        "base_url": os.getenv(f'base_url_{llm_name}'),
+        "api_key": os.getenv(f'api_key_{llm_name}'),
+    }
+
 
 def get_model_client(
         llm_name: str = "mota",
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
         model_client_stream: bool = True
-) -> OpenAIChatCompletionClient:
+) -> "OpenAIChatCompletionClient":
     """
-    获取模型客户端
+    获取模型客户端（每次调用创建一个独立客户端）
 
     Args:
         llm_name: 模型名称，支持多种大模型
@@ -33,28 +142,12 @@ def get_model_client(
     Returns:
         OpenAIChatCompletionClient: 模型客户端
     """
-    # 如果模型名称不在支持列表中，使用默认模型
-    if llm_name not in names:
-        llm_name = "mota"
-
-    # 使用其他模型配置
-    model = os.getenv(f'model_{llm_name}')
-    base_url = os.getenv(f'base_url_{llm_name}')
-    api_key = os.getenv(f'api_key_{llm_name}')
+    from autogen_ext.models.openai import OpenAIChatCompletionClient
 
     # 构建客户端参数
-    client_kwargs = {
-        "model": model,
-        "base_url": base_url,
-        "api_key": api_key,
-        "model_info": {
-            "vision": False,
-            "function_calling": True,
-            "json_output": True,
-            "family": ModelFamily.UNKNOWN,
-            "structured_output": True,
-            "multiple_system_messages": True,
-        },
+    client_kwargs: Dict[str, Any] = {
+        **get_provider_config(llm_name),
+        "model_info": dict(MODEL_INFO),
     }
 
     # 添加可选参数
@@ -66,10 +159,233 @@ def get_model_client(
     return OpenAIChatCompletionClient(**client_kwargs)
 
 
-# 默认模型客户端（单例模式）
-default_model_client = get_model_client("gf")
+class ModelClientRegistry:
+    """
+    共享模型客户端注册表
+
+    按 (provider, base_url, api_key) 复用同一个 OpenAIChatCompletionClient，
+    底层共享一个 keep-alive 的 httpx 连接池，避免每个会话重复建连和TLS握手。
+    配置了并发/速率限制的提供商，共享客户端外层再包装一层 RateLimitedModelClient。
+    创建注册表不读取配置也不导入 httpx，第一次获取客户端时才初始化。
+    """
+
+    def __init__(self, config: Optional[LLMConfig] = None):
+        self._config = config
+        self._limits: Optional["httpx.Limits"] = None
+        self._timeout: Optional["httpx.Timeout"] = None
+        self._clients: Dict[Tuple[str, Optional[str], Optional[str]], ChatCompletionClient] = {}
+        self._http_clients: Dict[Tuple[str, Optional[str], Optional[str]], "httpx.AsyncClient"] = {}
+        self._limiters: Dict[str, ProviderLimiter] = {}
+
+    @property
+    def config(self) -> LLMConfig:
+        if self._config is None:
+            self._config = get_llm_config()
+        return self._config
+
+    @property
+    def limits(self) -> "httpx.Limits":
+        if self._limits is None:
+            import httpx
+            self._limits = httpx.Limits(
+                max_connections=self.config.pool_max_connections,
+                max_keepalive_connections=self.config.pool_max_keepalive,
+                keepalive_expiry=self.config.pool_keepalive_expiry
+            )
+        return self._limits
+
+    @property
+    def timeout(self) -> "httpx.Timeout":
+        if self._timeout is None:
+            import httpx
+            self._timeout = httpx.Timeout(self.config.http_timeout, connect=5.0)
+        return self._timeout
+
+    def limiter(self, llm_name: str) -> ProviderLimiter:
+        """获取（必要时创建）提供商的限流器"""
+        llm_name = resolve_llm_name(llm_name)
+        limiter = self._limiters.get(llm_name)
+        if limiter is None:
+            limiter = self._limiters[llm_name] = create_limiter(llm_name)
+        return limiter
+
+    def get(self, llm_name: str = "mota") -> ChatCompletionClient:
+        """获取（必要时创建）指定提供商的共享客户端"""
+        llm_name = resolve_llm_name(llm_name)
+        config = get_provider_config(llm_name)
+        key = (llm_name, config["base_url"], config["api_key"])
+
+        client = self._clients.get(key)
+        if client is None:
+            import httpx
+            from autogen_ext.models.openai import OpenAIChatCompletionClient
+
+            http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            client = OpenAIChatCompletionClient(
+                **config,
+                model_info=dict(MODEL_INFO),
+                http_client=http_client
+            )
+            limiter = self.limiter(llm_name)
+            if not limiter.unlimited:
+                client = RateLimitedModelClient(client, limiter)
+            self._clients[key] = client
+            self._http_clients[key] = http_client
+        return client
+
+    def stats(self) -> Dict[str, Any]:
+        """注册表统计信息"""
+        return {
+            "clients": len(self._clients),
+            "providers": sorted({key[0] for key in self._clients}),
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "limiters": self.limiter_stats(),
+        }
+
+    def limiter_stats(self) -> Dict[str, Dict[str, Any]]:
+        """各提供商限流器的统计（排队深度、等待时间等）"""
+        return {name: limiter.stats() for name, limiter in self._limiters.items()}
+
+    async def close(self) -> None:
+        """关闭所有共享客户端和连接池"""
+        clients = list(self._clients.values())
+        http_clients = list(self._http_clients.values())
+        self._clients.clear()
+        self._http_clients.clear()
+        for client in clients:
+            try:
+                await client.close()
+            except Exception:
+                pass
+        for http_client in http_clients:
+            await http_client.aclose()
+
+
+class SessionModelClient(ChatCompletionClient):
+    """
+    会话级模型客户端
+
+    包装共享客户端，在每次请求时通过 extra_create_args 注入会话自己的
+    temperature/max_tokens，而不是为每个会话创建新的客户端。
+    关闭时不会关闭共享客户端。
+    """
+
+    def __init__(self, client: ChatCompletionClient, create_args: Optional[Mapping[str, Any]] = None):
+        self._client = client
+        self._create_args: Dict[str, Any] = dict(create_args or {})
+
+    def _merge_args(self, extra_create_args: Mapping[str, Any], stream: bool = False) -> Dict[str, Any]:
+        args = {**self._create_args, **extra_create_args}
+        if stream and get_llm_config().stream_include_usage:
+            args.setdefault("stream_options", {"include_usage": True})
+        return args
+
+    async def create(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        return await self._client.create(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=self._merge_args(extra_create_args),
+            cancellation_token=cancellation_token,
+        )
+
+    def create_stream(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        return self._client.create_stream(
+            messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            json_output=json_output,
+            extra_create_args=self._merge_args(extra_create_args, stream=True),
+            cancellation_token=cancellation_token,
+        )
+
+    async def close(self) -> None:
+        # 共享客户端由注册表统一关闭
+        pass
+
+    def actual_usage(self) -> RequestUsage:
+        return self._client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._client.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return self._client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return self._client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self._client.capabilities  # type: ignore
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._client.model_info
+
+
+# 全局共享客户端注册表
+client_registry = ModelClientRegistry()
+
+
+def get_session_model_client(
+        llm_name: str = "mota",
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+) -> SessionModelClient:
+    """
+    获取会话级模型客户端（复用提供商的共享连接池）
+
+    Args:
+        llm_name: 模型名称，支持多种大模型；"auto" 表示在多个提供商之间自动路由
+        temperature: 温度参数（按请求注入）
+        max_tokens: 最大token数（按请求注入）
+
+    Returns:
+        SessionModelClient: 包装共享客户端的会话级客户端
+    """
+    create_args: Dict[str, Any] = {}
+    if temperature is not None:
+        create_args["temperature"] = temperature
+    if max_tokens is not None:
+        create_args["max_tokens"] = max_tokens
+    if llm_name == AUTO_LLM_NAME:
+        from common.llm_router import get_router
+        return SessionModelClient(get_router(), create_args)
+    return SessionModelClient(client_registry.get(llm_name), create_args)
+
+
+def __getattr__(name: str) -> Any:
+    """默认模型客户端（单例模式），第一次访问 default_model_client 时才创建"""
+    if name == "default_model_client":
+        client = globals()["default_model_client"] = get_model_client("gf")
+        return client
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == '__main__':
+    from autogen_agentchat.agents import AssistantAgent
+
     default_model_client = get_model_client("gf")
 
     agent = AssistantAgent(
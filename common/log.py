@@ -1,46 +1,89 @@
 # 封装日志模块
 # 控制台处理器、文件处理器
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
 from pathlib import Path
 import time
 
+# 是否默认使用队列模式（后台线程写日志，调用方线程不做磁盘IO）
+LOG_USE_QUEUE = os.getenv("LOG_USE_QUEUE", "true").lower() in ("1", "true", "yes")
+
+
+class DailyFileHandler(logging.FileHandler):
+    """按日期写入 年-月-日.log 的文件处理器，跨过零点后自动切换到新文件"""
+
+    def __init__(self, log_dir, encoding="utf-8"):
+        self.log_dir = Path(log_dir)
+        now = time.time()
+        self.rollover_at = self._next_midnight(now)
+        super().__init__(self._path_for(now), encoding=encoding)
+
+    def emit(self, record):
+        if record.created >= self.rollover_at:
+            self.acquire()
+            try:
+                if record.created >= self.rollover_at:
+                    # 关闭旧文件，下一次写入时打开新日期的文件
+                    self.close()
+                    self.baseFilename = os.path.abspath(self._path_for(record.created))
+                    self.rollover_at = self._next_midnight(record.created)
+            finally:
+                self.release()
+        super().emit(record)
+
+    def _path_for(self, timestamp):
+        return self.log_dir.joinpath(time.strftime("%Y-%m-%d", time.localtime(timestamp)) + ".log")
+
+    @staticmethod
+    def _next_midnight(timestamp):
+        t = time.localtime(timestamp)
+        return time.mktime((t.tm_year, t.tm_mon, t.tm_mday + 1, 0, 0, 0, 0, 0, -1))
+
 
 class DycLogger:
-    def __init__(self, name="流星雨", logger_level="INFO", sh_level="INFO", fh_level="INFO"):
+    def __init__(self, name="流星雨", logger_level="INFO", sh_level="INFO", fh_level="INFO", use_queue=None):
         """
 
         :param name:            日志记录器的名称
         :param logger_level:    日志记录器的等级
         :param sh_level:        控制台处理器的等级
         :param fh_level:        文件台处理器的等级
+        :param use_queue:       是否使用队列模式，None 时读取环境变量 LOG_USE_QUEUE（默认开启）
         """
         self.__logger = logging.getLogger(name)  # 日志记录器
         self.__logger.setLevel(logger_level)
 
-        # 日志处理器
-        # 处理器的数据展示的格式
-        fmt = logging.Formatter('%(asctime)s - %(filename)s:[%(lineno)s] - [%(levelname)s] - %(message)s')
-
-        # 控制台处理器
-        sh = logging.StreamHandler()
-        sh.setLevel(sh_level)
-        sh.setFormatter(fmt)
-        # 文件处理器
-        t = time.strftime("%Y-%m-%d") + ".log"
-        fp = Path(__file__).parent.joinpath("logs")  # 日志文件夹
-        if not fp.exists():  # 当文件夹不存在的时候
-            os.mkdir(fp)  # 创建文件夹
-        fp = fp.joinpath(t)
-        fh = logging.FileHandler(fp, encoding="utf-8")
-        fh.setLevel(fh_level)
-        fh.setFormatter(fmt)
-
         if len(self.__logger.handlers) == 0:  # 避免日志重复记录
-            # 把日志记录器记录的信息交给 控制处理器sh进行处理
-            # if not self.logger.handlers:
-            self.__logger.addHandler(sh)  # 班主任1    班主任2
-            self.__logger.addHandler(fh)  # 文件1     文件2
+            # 日志处理器
+            # 处理器的数据展示的格式
+            fmt = logging.Formatter('%(asctime)s - %(filename)s:[%(lineno)s] - [%(levelname)s] - %(message)s')
+
+            # 控制台处理器
+            sh = logging.StreamHandler()
+            sh.setLevel(sh_level)
+            sh.setFormatter(fmt)
+            # 文件处理器（按日期切换文件）
+            fp = Path(__file__).parent.joinpath("logs")  # 日志文件夹
+            if not fp.exists():  # 当文件夹不存在的时候
+                os.mkdir(fp)  # 创建文件夹
+            fh = DailyFileHandler(fp, encoding="utf-8")
+            fh.setLevel(fh_level)
+            fh.setFormatter(fmt)
+
+            if LOG_USE_QUEUE if use_queue is None else use_queue:
+                # 队列模式：记录器只把日志放入队列，由后台线程交给 sh/fh 写出
+                log_queue = queue.SimpleQueue()
+                self.__logger.addHandler(logging.handlers.QueueHandler(log_queue))
+                listener = logging.handlers.QueueListener(log_queue, sh, fh, respect_handler_level=True)
+                listener.start()
+                atexit.register(listener.stop)  # 进程退出前写完队列中剩余的日志
+            else:
+                # 把日志记录器记录的信息交给 控制处理器sh进行处理
+                self.__logger.addHandler(sh)  # 班主任1    班主任2
+                self.__logger.addHandler(fh)  # 文件1     文件2
 
     def get_logger(self):
         return self.__logger
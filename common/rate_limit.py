@@ -0,0 +1,283 @@
+"""
+模型提供商限流
+
+每个提供商一个 ProviderLimiter：
+- 并发上限（异步信号量语义）
+- 令牌桶：每分钟请求数（RPM）和每分钟token数（TPM），TPM 先按估算值预留，完成后按实际用量多退少补
+- 公平排队：等待中的请求按会话分组轮转放行，单个会话的突发请求不会挤占其他会话
+并统计排队深度和等待时间。
+
+配置与 model_/base_url_/api_key_ 放在一起，例如:
+    max_concurrency_gf=8  rpm_gf=60  tpm_gf=100000
+未配置时使用 LLM_DEFAULT_MAX_CONCURRENCY / LLM_DEFAULT_RPM / LLM_DEFAULT_TPM，0 表示不限制。
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Deque, Dict, Literal, Mapping, Optional, Sequence, Tuple, Union
+
+from autogen_core import CancellationToken
+from autogen_core.models import ChatCompletionClient, CreateResult, LLMMessage, ModelCapabilities, ModelInfo, RequestUsage
+from autogen_core.tools import Tool, ToolSchema
+from pydantic import BaseModel
+
+LLM_DEFAULT_MAX_CONCURRENCY: int = int(os.getenv("LLM_DEFAULT_MAX_CONCURRENCY", "32"))
+LLM_DEFAULT_RPM: float = float(os.getenv("LLM_DEFAULT_RPM", "0"))
+LLM_DEFAULT_TPM: float = float(os.getenv("LLM_DEFAULT_TPM", "0"))
+# 预留TPM时，请求未指定 max_tokens 的回答长度估算
+LLM_RESERVED_COMPLETION_TOKENS: int = int(os.getenv("LLM_RESERVED_COMPLETION_TOKENS", "512"))
+
+# 当前请求所属的会话，由调用方（AutoGenService）设置，用于公平排队
+current_session: ContextVar[Optional[str]] = ContextVar("current_session", default=None)
+
+
+def estimate_request_tokens(messages: Sequence[LLMMessage], extra_create_args: Mapping[str, Any]) -> int:
+    """粗略估算一次请求消耗的token数（提示词按2个字符1个token，加上回答的最大长度）"""
+    prompt = sum(len(str(getattr(message, "content", ""))) // 2 + 4 for message in messages)
+    completion = extra_create_args.get("max_tokens") or LLM_RESERVED_COMPLETION_TOKENS
+    return prompt + int(completion)
+
+
+class TokenBucket:
+    """按分钟速率补充的令牌桶，容量为一分钟的额度"""
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """还需等待多久才能取出 amount 个令牌（超过容量的请求按容量计算，避免永远等待）"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        """归还（或在 amount 为负时追加扣除）令牌"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class ProviderLimiter:
+    """单个提供商的并发、速率限制和公平排队"""
+
+    def __init__(self, name: str, max_concurrency: int = 0, rpm: float = 0, tpm: float = 0):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.rpm_bucket = TokenBucket(rpm) if rpm > 0 else None
+        self.tpm_bucket = TokenBucket(tpm) if tpm > 0 else None
+        # 会话 -> 等待队列（future, 预留token数）；OrderedDict 的顺序即轮转顺序
+        self._queues: "OrderedDict[Optional[str], Deque[Tuple[asyncio.Future, int]]]" = OrderedDict()
+        self._waiting = 0
+        self._active = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # 统计
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def unlimited(self) -> bool:
+        return self.max_concurrency <= 0 and self.rpm_bucket is None and self.tpm_bucket is None
+
+    async def acquire(self, session: Optional[str], tokens: int) -> None:
+        """排队等待放行；取消等待时自动退出队列"""
+        start = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(session, deque()).append((future, tokens))
+        self._waiting += 1
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已被放行但调用方取消了，归还名额
+                self.release(tokens, tokens)
+            else:
+                self._remove(session, future)
+            raise
+        wait = time.monotonic() - start
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def release(self, reserved: int, actual: Optional[int] = None) -> None:
+        """请求结束，释放并发名额并按实际用量修正TPM预留"""
+        self._active -= 1
+        if self.tpm_bucket is not None and actual is not None:
+            self.tpm_bucket.refund(reserved - actual)
+        self._dispatch()
+
+    def _remove(self, session: Optional[str], future: asyncio.Future) -> None:
+        queue = self._queues.get(session)
+        if queue is None:
+            return
+        for item in queue:
+            if item[0] is future:
+                queue.remove(item)
+                self._waiting -= 1
+                break
+        if not queue:
+            del self._queues[session]
+
+    def _dispatch(self) -> None:
+        """按会话轮转放行等待中的请求，直到并发或速率受限"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._queues and (self.max_concurrency <= 0 or self._active < self.max_concurrency):
+            session, queue = next(iter(self._queues.items()))
+            future, tokens = queue[0]
+            if future.done():
+                # 已被取消的等待者
+                queue.popleft()
+                self._waiting -= 1
+                if not queue:
+                    del self._queues[session]
+                continue
+
+            delay = max(
+                self.rpm_bucket.wait_time(1) if self.rpm_bucket else 0.0,
+                self.tpm_bucket.wait_time(tokens) if self.tpm_bucket else 0.0,
+            )
+            if delay > 0:
+                # 速率受限：等令牌补足后再尝试
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+
+            queue.popleft()
+            self._waiting -= 1
+            # 本会话放行一个请求后移到队尾，轮到下一个会话
+            if queue:
+                self._queues.move_to_end(session)
+            else:
+                del self._queues[session]
+            if self.rpm_bucket:
+                self.rpm_bucket.consume(1)
+            if self.tpm_bucket:
+                self.tpm_bucket.consume(tokens)
+            self._active += 1
+            future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self._active,
+            "queue_depth": self._waiting,
+            "waiting_sessions": len(self._queues),
+            "acquired": self.acquired,
+            "total_wait": round(self.total_wait, 4),
+            "avg_wait": round(self.total_wait / self.acquired, 4) if self.acquired else 0.0,
+            "max_wait": round(self.max_wait, 4),
+            "rpm_available": round(self.rpm_bucket.tokens, 1) if self.rpm_bucket else None,
+            "tpm_available": round(self.tpm_bucket.tokens, 1) if self.tpm_bucket else None,
+        }
+
+
+def create_limiter(llm_name: str) -> ProviderLimiter:
+    """按环境变量 max_concurrency_/rpm_/tpm_{llm_name} 创建限流器"""
+    return ProviderLimiter(
+        llm_name,
+        max_concurrency=int(os.getenv(f"max_concurrency_{llm_name}", LLM_DEFAULT_MAX_CONCURRENCY)),
+        rpm=float(os.getenv(f"rpm_{llm_name}", LLM_DEFAULT_RPM)),
+        tpm=float(os.getenv(f"tpm_{llm_name}", LLM_DEFAULT_TPM)),
+    )
+
+
+class RateLimitedModelClient(ChatCompletionClient):
+    """在共享客户端外层排队限流的模型客户端"""
+
+    def __init__(self, client: ChatCompletionClient, limiter: ProviderLimiter):
+        self._client = client
+        self.limiter = limiter
+
+    async def create(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> CreateResult:
+        reserved = estimate_request_tokens(messages, extra_create_args)
+        await self.limiter.acquire(current_session.get(), reserved)
+        actual = None
+        try:
+            result = await self._client.create(
+                messages,
+                tools=tools,
+                tool_choice=tool_choice,
+                json_output=json_output,
+                extra_create_args=extra_create_args,
+                cancellation_token=cancellation_token,
+            )
+            # 提供商未返回用量时保持预留值
+            actual = (result.usage.prompt_tokens + result.usage.completion_tokens) or None
+            return result
+        finally:
+            self.limiter.release(reserved, actual)
+
+    async def create_stream(
+            self,
+            messages: Sequence[LLMMessage],
+            *,
+            tools: Sequence[Union[Tool, ToolSchema]] = [],
+            tool_choice: Union[Tool, Literal["auto", "required", "none"]] = "auto",
+            json_output: Optional[Union[bool, type[BaseModel]]] = None,
+            extra_create_args: Mapping[str, Any] = {},
+            cancellation_token: Optional[CancellationToken] = None,
+    ) -> AsyncGenerator[Union[str, CreateResult], None]:
+        reserved = estimate_request_tokens(messages, extra_create_args)
+        await self.limiter.acquire(current_session.get(), reserved)
+        actual = None
+        try:
+            async for item in self._client.create_stream(
+                    messages,
+                    tools=tools,
+                    tool_choice=tool_choice,
+                    json_output=json_output,
+                    extra_create_args=extra_create_args,
+                    cancellation_token=cancellation_token,
+            ):
+                if isinstance(item, CreateResult):
+                    actual = (item.usage.prompt_tokens + item.usage.completion_tokens) or None
+                yield item
+        finally:
+            self.limiter.release(reserved, actual)
+
+    async def close(self) -> None:
+        await self._client.close()
+
+    def actual_usage(self) -> RequestUsage:
+        return self._client.actual_usage()
+
+    def total_usage(self) -> RequestUsage:
+        return self._client.total_usage()
+
+    def count_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return self._client.count_tokens(messages, tools=tools)
+
+    def remaining_tokens(self, messages: Sequence[LLMMessage], *, tools: Sequence[Union[Tool, ToolSchema]] = []) -> int:
+        return self._client.remaining_tokens(messages, tools=tools)
+
+    @property
+    def capabilities(self) -> ModelCapabilities:  # type: ignore
+        return self._client.capabilities  # type: ignore
+
+    @property
+    def model_info(self) -> ModelInfo:
+        return self._client.model_info
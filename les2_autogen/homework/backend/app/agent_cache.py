@@ -0,0 +1,236 @@
+"""
+智能体缓存模块
+
+为 AutoGenService 提供有界的 LRU/TTL 智能体缓存：
+- 最大条目数（LRU 淘汰）
+- 空闲超时（TTL 淘汰）
+- 内存预算（按对话上下文估算大小淘汰）
+被淘汰条目的模型客户端在后台异步关闭，不阻塞当前请求。
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Set
+
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 每个智能体的固定开销估算（对象本身、客户端引用等），单位字节
+AGENT_BASE_SIZE = 16 * 1024
+
+
+def estimate_agent_size(agent: Any) -> int:
+    """估算智能体占用的内存（字节），主要由模型上下文中的消息决定"""
+    size = AGENT_BASE_SIZE
+    context = getattr(agent, "model_context", None)
+    messages = getattr(context, "_messages", None) or []
+    for message in messages:
+        content = getattr(message, "content", "")
+        if isinstance(content, str):
+            size += len(content.encode("utf-8"))
+        else:
+            size += len(str(content).encode("utf-8"))
+    return size
+
+
+@dataclass
+class AgentCacheEntry:
+    """缓存条目"""
+    agent: Any
+    model_client: Any
+    last_access: float = field(default_factory=time.monotonic)
+    size: int = AGENT_BASE_SIZE
+    active: int = 0  # 正在使用该智能体的请求数，使用中的条目不会被淘汰
+    version: int = 0  # 智能体状态对应的存储版本（见 app/agent_state.py），-1 表示需要重新加载
+
+
+class AgentCache:
+    """有界的智能体缓存（LRU + 空闲TTL + 内存预算）"""
+
+    def __init__(self, max_entries: int = 256, idle_ttl: float = 1800, memory_budget: int = 64 * 1024 * 1024):
+        """
+
+        :param max_entries:     最大缓存条目数，<=0 表示不限制
+        :param idle_ttl:        空闲超时时间（秒），<=0 表示不过期
+        :param memory_budget:   内存预算（字节），<=0 表示不限制
+        """
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        self.memory_budget = memory_budget
+
+        self._entries: "OrderedDict[str, AgentCacheEntry]" = OrderedDict()
+        self._total_size = 0
+        self._closing_tasks: Set[asyncio.Task] = set()
+
+        # 统计计数器
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        """获取智能体，命中时刷新访问时间和大小估算"""
+        # 只检查队首的过期条目，开销与过期条目数成正比
+        self.sweep()
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entry.last_access = time.monotonic()
+        self._entries.move_to_end(key)
+        self._resize(entry)
+        self._evict_if_needed()
+        return entry.agent
+
+    def put(self, key: str, agent: Any, model_client: Any, version: int = 0) -> None:
+        """放入智能体，必要时淘汰最久未使用的条目"""
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._total_size -= old.size
+            if old.model_client is not model_client:
+                self._close_client_later(old.model_client)
+
+        entry = AgentCacheEntry(agent=agent, model_client=model_client, version=version)
+        entry.size = estimate_agent_size(agent)
+        self._entries[key] = entry
+        self._total_size += entry.size
+        self._evict_if_needed()
+
+    def version(self, key: str) -> Optional[int]:
+        """条目的状态版本，条目不存在时为 None"""
+        entry = self._entries.get(key)
+        return entry.version if entry is not None else None
+
+    def set_version(self, key: str, version: int) -> None:
+        """更新条目的状态版本"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.version = version
+
+    def acquire(self, key: str) -> None:
+        """标记条目正在使用"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.active += 1
+
+    def release(self, key: str) -> None:
+        """释放条目的使用标记，并按最新的上下文大小重新估算"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.active = max(entry.active - 1, 0)
+            entry.last_access = time.monotonic()
+            self._entries.move_to_end(key)
+            self._resize(entry)
+            self._evict_if_needed()
+
+    async def pop(self, key: str) -> None:
+        """移除条目并关闭其模型客户端"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._total_size -= entry.size
+        await self._close_client(entry.model_client)
+
+    def sweep(self) -> int:
+        """
+        淘汰所有空闲超时的条目，返回淘汰数量
+
+        更新访问时间时条目都会移到末尾，所以条目按访问时间从旧到新排列：
+        从队首开始检查，遇到第一个未过期的空闲条目即可停止（使用中的条目跳过）
+        """
+        if self.idle_ttl <= 0:
+            return 0
+        deadline = time.monotonic() - self.idle_ttl
+        expired = []
+        for key, entry in self._entries.items():
+            if entry.active:
+                continue
+            if entry.last_access >= deadline:
+                break
+            expired.append(key)
+        for key in expired:
+            self._evict(key, reason="idle_ttl")
+        return len(expired)
+
+    async def run_sweeper(self, interval: float = 60) -> None:
+        """后台定期清理空闲条目（在应用生命周期中启动）"""
+        while True:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计信息"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "memory_bytes": self._total_size,
+            "memory_budget": self.memory_budget,
+            "idle_ttl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    async def clear(self) -> None:
+        """清空缓存并关闭所有客户端"""
+        entries = list(self._entries.values())
+        self._entries.clear()
+        self._total_size = 0
+        for entry in entries:
+            await self._close_client(entry.model_client)
+        if self._closing_tasks:
+            await asyncio.gather(*self._closing_tasks, return_exceptions=True)
+
+    def _resize(self, entry: AgentCacheEntry) -> None:
+        size = estimate_agent_size(entry.agent)
+        self._total_size += size - entry.size
+        entry.size = size
+
+    def _evict_if_needed(self) -> None:
+        """按条目数和内存预算淘汰最久未使用且空闲的条目（未超限时不遍历）"""
+        while True:
+            over_count = 0 < self.max_entries < len(self._entries)
+            over_budget = 0 < self.memory_budget < self._total_size
+            if not over_count and not over_budget:
+                break
+            key = next((key for key, entry in self._entries.items() if not entry.active), None)
+            if key is None:
+                break
+            self._evict(key, reason="max_entries" if over_count else "memory_budget")
+
+    def _evict(self, key: str, reason: str) -> None:
+        entry = self._entries.pop(key)
+        self._total_size -= entry.size
+        self.evictions += 1
+        logger.info("淘汰智能体缓存: %s, 原因: %s", key, reason)
+        self._close_client_later(entry.model_client)
+
+    def _close_client_later(self, client: Any) -> None:
+        """在后台任务中关闭客户端"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self._close_client(client))
+        self._closing_tasks.add(task)
+        task.add_done_callback(self._closing_tasks.discard)
+
+    @staticmethod
+    async def _close_client(client: Any) -> None:
+        try:
+            # 某些客户端可能没有close方法
+            if hasattr(client, "close"):
+                await client.close()
+        except Exception as e:
+            logger.warning("关闭模型客户端时出错: %s", e)
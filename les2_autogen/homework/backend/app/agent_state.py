@@ -0,0 +1,131 @@
+"""
+智能体状态存储（跨工作进程）
+
+uvicorn 以多个工作进程运行时，每个进程各自缓存智能体，同一会话相邻的两轮可能落在不同进程上。
+每轮对话结束后把智能体状态（AssistantAgent.save_state，即模型上下文中的消息）连同版本号
+写入数据库的 agent_states 表，所有工作进程共享：
+- 缓存命中时比较本地版本和存储的版本，其他进程写入了更新的状态时重新 load_state
+- 缓存未命中时加载存储的状态，没有状态（或会话被清空）时从消息表恢复历史
+- 写入按版本号做乐观并发控制：版本不一致说明其他进程同时写入了该会话，放弃本次写入，
+  本地缓存标记为过期，下一轮从存储重新加载
+
+状态写入通过批量写入队列提交且不等待。写入在保存助手消息之前进入队列，而队列按顺序提交，
+客户端收到完成事件时状态已经写入，下一轮无论落在哪个进程都能看到。
+"""
+import asyncio
+import os
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import AsyncSessionLocal
+from app.models import AgentState
+from app.persistence import persistence
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 状态存储后端：db（数据库 agent_states 表）/ none（关闭，只使用进程内缓存）
+AGENT_STATE_STORE: str = os.getenv("AGENT_STATE_STORE", "db").lower()
+
+
+class AgentStateStore:
+    """按会话保存带版本号的智能体状态"""
+
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.session_factory = session_factory
+        # 统计
+        self.loads = 0
+        self.saves = 0
+        self.conflicts = 0
+        self.failed = 0
+
+    async def version(self, session_id: int) -> int:
+        """存储的状态版本，没有状态时为0"""
+        async with self.session_factory() as db:
+            version = await db.scalar(select(AgentState.version).where(AgentState.session_id == session_id))
+        return version or 0
+
+    async def load(self, session_id: int) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """读取 (版本, 状态)，没有状态时返回 (0, None)"""
+        async with self.session_factory() as db:
+            row = (await db.execute(
+                select(AgentState.version, AgentState.state).where(AgentState.session_id == session_id)
+            )).first()
+        self.loads += 1
+        if row is None:
+            return 0, None
+        return row.version, row.state
+
+    def save(self, session_id: int, state: Mapping[str, Any], expected_version: int) -> asyncio.Future:
+        """
+        在写入队列中保存状态（不等待提交）
+
+        :param expected_version: 状态所基于的版本，存储的版本不同时放弃写入
+        :return: 提交后完成的 future，结果为新版本号，版本冲突时为 None
+        """
+        state = dict(state)
+
+        async def write(db: AsyncSession) -> Optional[int]:
+            if expected_version:
+                result = await db.execute(
+                    update(AgentState)
+                    .where(AgentState.session_id == session_id, AgentState.version == expected_version)
+                    .values(version=expected_version + 1, state=state)
+                )
+                return expected_version + 1 if result.rowcount else None
+            exists = await db.scalar(select(AgentState.version).where(AgentState.session_id == session_id))
+            if exists is not None:
+                return None
+            db.add(AgentState(session_id=session_id, version=1, state=state))
+            await db.flush()
+            return 1
+
+        future = persistence.submit(write)
+        future.add_done_callback(lambda future: self._record_save(session_id, future))
+        return future
+
+    def _record_save(self, session_id: int, future: asyncio.Future) -> None:
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+            logger.error("保存智能体状态失败: %s, 会话id: %s", future.exception(), session_id)
+        elif future.result() is None:
+            self.conflicts += 1
+            logger.warning("智能体状态版本冲突（其他工作进程同时写入），会话id: %s", session_id)
+        else:
+            self.saves += 1
+
+    async def reset(self, session_id: int) -> int:
+        """清空状态并递增版本（清空或删除会话时调用），其他进程缓存的智能体会从消息表重新恢复"""
+
+        async def write(db: AsyncSession) -> int:
+            result = await db.execute(
+                update(AgentState)
+                .where(AgentState.session_id == session_id)
+                .values(version=AgentState.version + 1, state=None)
+            )
+            if result.rowcount == 0:
+                db.add(AgentState(session_id=session_id, version=1, state=None))
+                await db.flush()
+            return await db.scalar(select(AgentState.version).where(AgentState.session_id == session_id))
+
+        return await persistence.run(write)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": AGENT_STATE_STORE,
+            "loads": self.loads,
+            "saves": self.saves,
+            "conflicts": self.conflicts,
+            "failed": self.failed,
+        }
+
+
+def create_agent_state_store() -> Optional[AgentStateStore]:
+    """按环境变量创建状态存储，AGENT_STATE_STORE=none 时返回 None"""
+    if AGENT_STATE_STORE == "none":
+        return None
+    return AgentStateStore()
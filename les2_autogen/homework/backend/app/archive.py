@@ -0,0 +1,485 @@
+"""
+冷数据归档
+
+所有消息的原文都保存在 chat_messages 中，删除的会话也只是软删除（is_active=False），
+热表和它的索引只增不减。后台归档任务每隔 ARCHIVE_INTERVAL 秒执行一次：
+- 归档：空闲超过 ARCHIVE_IDLE_DAYS 天的会话，把全部消息序列化为JSON数组并压缩（zstd，
+  未安装 zstandard 时用 zlib），作为一行写入 chat_archives，删除热表中的消息，会话标记 archived_at
+- 恢复：打开已归档的会话（查看消息或继续对话）时把消息解压写回热表并删除归档行，
+  原消息id未被占用时保留原id。只查看消息不改变会话的更新时间，之后的某一轮会再次归档
+- 清除：软删除超过 ARCHIVE_PURGE_DAYS 天的会话连同其消息、归档和智能体状态被物理删除
+- 空间回收：数据库为 auto_vacuum=INCREMENTAL 时执行 incremental_vacuum，把空闲页归还给文件系统
+
+已归档会话的消息写入单独的全文检索索引 chat_archives_fts（只有索引没有原文，见 app/search.py），
+搜索仍能找到这些会话；恢复时移出该索引，消息随写回热表重新进入消息索引。
+归档、恢复和清除都作为写操作提交到批量写入队列，并在事务中重新检查会话状态，
+多个工作进程同时运行归档任务也是安全的。
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app import search
+from app.database import AsyncSessionLocal, engine
+from app.models import AgentState, ChatMessage, ChatSession, SessionArchive
+from app.pagination import total_cache
+from app.persistence import persistence
+from app.telemetry import span
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 会话空闲多少天后归档，0 表示不归档
+ARCHIVE_IDLE_DAYS: float = float(os.getenv("ARCHIVE_IDLE_DAYS", "30"))
+# 软删除的会话保留多少天后物理删除，负数表示不清除
+ARCHIVE_PURGE_DAYS: float = float(os.getenv("ARCHIVE_PURGE_DAYS", "7"))
+# 后台任务执行间隔（秒），0 表示不启动后台任务（仍可通过接口手动执行）
+ARCHIVE_INTERVAL: float = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+# 每次查询候选会话的数量（每个会话单独提交，清除按批提交）
+ARCHIVE_BATCH: int = int(os.getenv("ARCHIVE_BATCH", "100"))
+# 压缩算法：auto（安装了 zstandard 时用 zstd，否则 zlib）/ zstd / zlib
+ARCHIVE_CODEC: str = os.getenv("ARCHIVE_CODEC", "auto").lower()
+# 压缩级别（归档只写一次，默认偏向压缩率）
+ARCHIVE_LEVEL: int = int(os.getenv("ARCHIVE_LEVEL", "9"))
+# 每轮最多归还的空闲页数，0 表示不执行 incremental_vacuum
+ARCHIVE_VACUUM_PAGES: int = int(os.getenv("ARCHIVE_VACUUM_PAGES", "2000"))
+# 已归档会话的消息是否写入全文检索索引（0 表示不写入，归档的消息搜索不到）
+ARCHIVE_SEARCH_INDEX: bool = os.getenv("ARCHIVE_SEARCH_INDEX", "1") != "0"
+# 恢复时每次 executemany 的行数，以及检查原消息id是否被占用时每次查询的id数
+RESTORE_BATCH_ROWS = 500
+
+# 归档数据中每条消息保存的列（会话id由归档行确定）
+ARCHIVE_COLUMNS = [column for column in ChatMessage.__table__.columns if column.name != "session_id"]
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+
+def resolve_codec(name: str = ARCHIVE_CODEC) -> str:
+    """按配置选择压缩算法，zstd 不可用时退回 zlib"""
+    if name in ("auto", "zstd") and _zstandard() is not None:
+        return "zstd"
+    if name == "zstd":
+        logger.warning("未安装 zstandard，归档改用 zlib 压缩")
+    return "zlib"
+
+
+def compress(data: bytes, codec: str, level: int = ARCHIVE_LEVEL) -> bytes:
+    if codec == "zstd":
+        return _zstandard().ZstdCompressor(level=level).compress(data)
+    return zlib.compress(data, level)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        zstandard = _zstandard()
+        if zstandard is None:
+            raise RuntimeError("归档使用 zstd 压缩，需要安装 zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def _encode_datetime(value: Any) -> str:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"无法序列化 {type(value).__name__}")
+
+
+def encode_messages(rows: List[Any]) -> bytes:
+    """消息行（按id排序）编码为JSON数组"""
+    return json.dumps(
+        [{column.name: row[column.name] for column in ARCHIVE_COLUMNS} for row in rows],
+        ensure_ascii=False, separators=(",", ":"), default=_encode_datetime
+    ).encode("utf-8")
+
+
+def decode_messages(codec: str, data: bytes) -> List[Dict[str, Any]]:
+    """解压归档数据，返回消息字典列表（时间为ISO格式字符串）"""
+    return json.loads(decompress(data, codec))
+
+
+def search_content(records: List[Any]) -> str:
+    """归档会话在检索索引中的内容：所有消息内容按顺序拼接（移除索引时必须得到相同的结果）"""
+    return "\n".join(record["content"] or "" for record in records)
+
+
+def search_index_enabled() -> bool:
+    return ARCHIVE_SEARCH_INDEX and search.fts_enabled
+
+
+def utcnow() -> datetime:
+    # 与数据库 func.now()（SQLite 的 CURRENT_TIMESTAMP）一致，使用不带时区的UTC时间
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Archiver:
+    """归档空闲会话、恢复被打开的归档会话、清除软删除的会话并回收空间"""
+
+    def __init__(self, idle_days: float = ARCHIVE_IDLE_DAYS, purge_days: float = ARCHIVE_PURGE_DAYS,
+                 batch: int = ARCHIVE_BATCH, codec: str = ARCHIVE_CODEC, vacuum_pages: int = ARCHIVE_VACUUM_PAGES):
+        self.idle_days = idle_days
+        self.purge_days = purge_days
+        self.batch = max(batch, 1)
+        self.codec_name = codec
+        self._codec: Optional[str] = None
+        self.vacuum_pages = vacuum_pages
+        self._lock: Optional[asyncio.Lock] = None
+        self._vacuum_hint_logged = False
+        # 统计（本进程）
+        self.runs = 0
+        self.archived = 0
+        self.restored = 0
+        self.purged = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.vacuum_pages_freed = 0
+        self.indexed = 0
+        self.last_run: Optional[Dict[str, Any]] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def codec(self) -> str:
+        if self._codec is None:
+            self._codec = resolve_codec(self.codec_name)
+        return self._codec
+
+    async def archive_session(self, session_id: int, idle_before: Optional[datetime] = None) -> bool:
+        """
+        归档一个会话
+
+        :param idle_before: 会话在该时间之后有更新时不归档（None 表示不检查空闲时间）
+        :return: 是否已归档；会话不存在、已归档、没有消息或读取后发生变化时返回 False
+        """
+        async with AsyncSessionLocal() as db:
+            updated_at = await db.scalar(
+                select(ChatSession.updated_at).where(
+                    ChatSession.id == session_id,
+                    ChatSession.is_active == True,
+                    ChatSession.archived_at.is_(None)
+                )
+            )
+            if updated_at is None or (idle_before is not None and updated_at >= idle_before):
+                return False
+            rows = (await db.execute(
+                select(ChatMessage.__table__).where(ChatMessage.session_id == session_id).order_by(ChatMessage.id)
+            )).mappings().all()
+        if not rows:
+            return False
+
+        # 压缩在事务之外进行，不占用写锁
+        codec = self.codec
+        raw = encode_messages(rows)
+        data = await asyncio.to_thread(compress, raw, codec)
+        count, last_id = len(rows), rows[-1]["id"]
+
+        async def write(db: AsyncSession) -> bool:
+            # 读取之后会话可能收到了新消息、被清空或被其他进程归档
+            session = (await db.execute(
+                select(ChatSession.updated_at, ChatSession.is_active, ChatSession.archived_at)
+                .where(ChatSession.id == session_id)
+            )).first()
+            if session is None or not session.is_active or session.archived_at is not None \
+                    or session.updated_at != updated_at:
+                return False
+            current = (await db.execute(
+                select(func.count(), func.max(ChatMessage.id)).where(ChatMessage.session_id == session_id)
+            )).first()
+            if tuple(current) != (count, last_id):
+                return False
+            indexed = search_index_enabled()
+            await db.execute(insert(SessionArchive).values(
+                session_id=session_id,
+                codec=codec,
+                data=data,
+                message_count=count,
+                raw_bytes=len(raw),
+                compressed_bytes=len(data),
+                indexed=indexed
+            ))
+            if indexed:
+                # 消息删除时触发器把它们移出消息索引，内容转入归档索引，搜索结果不变
+                await search.index_archive(db, session_id, search_content(rows))
+            await db.execute(delete(ChatMessage).where(ChatMessage.session_id == session_id))
+            # 智能体状态中也有全部消息：清空并递增版本，恢复后从消息表重建
+            await db.execute(
+                update(AgentState)
+                .where(AgentState.session_id == session_id)
+                .values(version=AgentState.version + 1, state=None)
+            )
+            # 显式保留 updated_at（否则 onupdate 会把归档时间当作会话的更新时间）
+            await db.execute(
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                .values(archived_at=func.now(), updated_at=ChatSession.updated_at)
+            )
+            return True
+
+        if not await persistence.run(write):
+            return False
+        total_cache.invalidate(("messages", session_id))
+        self.archived += 1
+        self.raw_bytes += len(raw)
+        self.compressed_bytes += len(data)
+        return True
+
+    async def archive_idle(self, idle_before: datetime) -> int:
+        """归档 idle_before 之后没有更新的会话，返回归档数量"""
+        archived = 0
+        after_id = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                session_ids = (await db.scalars(
+                    select(ChatSession.id)
+                    .where(
+                        ChatSession.is_active == True,
+                        ChatSession.archived_at.is_(None),
+                        ChatSession.updated_at < idle_before,
+                        ChatSession.user_message_count > 0,
+                        ChatSession.id > after_id
+                    )
+                    .order_by(ChatSession.id)
+                    .limit(self.batch)
+                )).all()
+            for session_id in session_ids:
+                try:
+                    if await self.archive_session(session_id, idle_before):
+                        archived += 1
+                except Exception as e:
+                    logger.error("归档会话失败: %s, 会话id: %s", e, session_id)
+            if len(session_ids) < self.batch:
+                return archived
+            after_id = session_ids[-1]
+
+    async def restore_session(self, db: AsyncSession, session_id: int) -> int:
+        """
+        把归档的消息写回热表并删除归档，清除会话的归档标记
+
+        在调用方的事务中执行（不提交），可以作为写操作的一部分。
+        :return: 恢复的消息数
+        """
+        archive = (await db.execute(
+            select(SessionArchive.codec, SessionArchive.data, SessionArchive.indexed)
+            .where(SessionArchive.session_id == session_id)
+        )).first()
+        restored = 0
+        if archive is not None:
+            records = await asyncio.to_thread(decode_messages, archive.codec, archive.data)
+            rows = []
+            for record in records:
+                row = {column.name: record.get(column.name) for column in ARCHIVE_COLUMNS}
+                row["session_id"] = session_id
+                if row["created_at"] is not None:
+                    row["created_at"] = datetime.fromisoformat(row["created_at"])
+                rows.append(row)
+            # 保留原消息id（分页游标、续传和任务结果中引用的id继续有效），任何一个被占用时全部分配新id
+            ids = [row["id"] for row in rows]
+            for start in range(0, len(ids), RESTORE_BATCH_ROWS):
+                taken = await db.scalar(
+                    select(func.count()).select_from(ChatMessage)
+                    .where(ChatMessage.id.in_(ids[start:start + RESTORE_BATCH_ROWS]))
+                )
+                if taken:
+                    for row in rows:
+                        del row["id"]
+                    break
+            for start in range(0, len(rows), RESTORE_BATCH_ROWS):
+                await db.execute(insert(ChatMessage.__table__), rows[start:start + RESTORE_BATCH_ROWS])
+            if archive.indexed:
+                await search.unindex_archive(db, session_id, search_content(records))
+            await db.execute(delete(SessionArchive).where(SessionArchive.session_id == session_id))
+            restored = len(rows)
+        await db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id)
+            .values(archived_at=None, updated_at=ChatSession.updated_at)
+        )
+        self.restored += 1
+        return restored
+
+    async def ensure_restored(self, session_id: int) -> int:
+        """恢复已归档的会话（读取消息之前调用），返回恢复的消息数"""
+
+        async def write(db: AsyncSession) -> int:
+            archived_at = await db.scalar(select(ChatSession.archived_at).where(ChatSession.id == session_id))
+            if archived_at is None:
+                # 同时打开的其他请求已经恢复
+                return 0
+            return await self.restore_session(db, session_id)
+
+        with span("archive.restore", **{"session.id": session_id}):
+            restored = await persistence.run(write)
+        total_cache.invalidate(("messages", session_id))
+        return restored
+
+    @staticmethod
+    async def _delete_archives(db: AsyncSession, session_ids: List[int]) -> None:
+        """删除归档行，已写入检索索引的先解压原文移出索引"""
+        result = await db.execute(
+            select(SessionArchive.session_id, SessionArchive.codec, SessionArchive.data)
+            .where(SessionArchive.session_id.in_(session_ids), SessionArchive.indexed == True)
+        )
+        for row in result.all():
+            records = await asyncio.to_thread(decode_messages, row.codec, row.data)
+            await search.unindex_archive(db, row.session_id, search_content(records))
+        await db.execute(delete(SessionArchive).where(SessionArchive.session_id.in_(session_ids)))
+
+    async def discard_archive(self, db: AsyncSession, session_id: int) -> None:
+        """删除会话的归档（清空或删除会话时在调用方的事务中执行）"""
+        await self._delete_archives(db, [session_id])
+
+    async def index_pending(self) -> int:
+        """把尚未写入检索索引的归档（关闭索引时归档的，或升级前的）写入索引，返回写入数量"""
+        if not search_index_enabled():
+            return 0
+        indexed = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                session_ids = (await db.scalars(
+                    select(SessionArchive.session_id)
+                    .where(SessionArchive.indexed == False)
+                    .order_by(SessionArchive.session_id)
+                    .limit(self.batch)
+                )).all()
+            if not session_ids:
+                return indexed
+
+            async def write(db: AsyncSession, session_ids=session_ids) -> int:
+                result = await db.execute(
+                    select(SessionArchive.session_id, SessionArchive.codec, SessionArchive.data)
+                    .where(SessionArchive.session_id.in_(session_ids), SessionArchive.indexed == False)
+                )
+                rows = result.all()
+                for row in rows:
+                    records = await asyncio.to_thread(decode_messages, row.codec, row.data)
+                    await search.index_archive(db, row.session_id, search_content(records))
+                await db.execute(
+                    update(SessionArchive)
+                    .where(SessionArchive.session_id.in_([row.session_id for row in rows]))
+                    .values(indexed=True)
+                )
+                return len(rows)
+
+            count = await persistence.run(write)
+            indexed += count
+            self.indexed += count
+            if len(session_ids) < self.batch or not count:
+                return indexed
+
+    async def purge_deleted(self, deleted_before: datetime) -> int:
+        """物理删除在 deleted_before 之前软删除的会话，返回删除数量"""
+        purged = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                session_ids = (await db.scalars(
+                    select(ChatSession.id)
+                    .where(ChatSession.is_active == False, ChatSession.updated_at < deleted_before)
+                    .order_by(ChatSession.id)
+                    .limit(self.batch)
+                )).all()
+            if not session_ids:
+                return purged
+
+            async def write(db: AsyncSession, session_ids=session_ids) -> int:
+                await self._delete_archives(db, session_ids)
+                for model in (ChatMessage, AgentState):
+                    await db.execute(delete(model).where(model.session_id.in_(session_ids)))
+                result = await db.execute(
+                    delete(ChatSession).where(ChatSession.id.in_(session_ids), ChatSession.is_active == False)
+                )
+                return result.rowcount
+
+            deleted = await persistence.run(write)
+            purged += deleted
+            self.purged += deleted
+            if len(session_ids) < self.batch or not deleted:
+                return purged
+
+    async def vacuum(self) -> int:
+        """auto_vacuum=INCREMENTAL 时归还最多 vacuum_pages 个空闲页，返回归还的页数"""
+        if engine.dialect.name != "sqlite" or self.vacuum_pages <= 0:
+            return 0
+        async with engine.connect() as conn:
+            # 0=NONE 1=FULL 2=INCREMENTAL
+            mode = (await conn.exec_driver_sql("PRAGMA auto_vacuum")).scalar()
+            if mode != 2:
+                if not self._vacuum_hint_logged:
+                    self._vacuum_hint_logged = True
+                    logger.info("数据库未启用 auto_vacuum=INCREMENTAL（auto_vacuum=%s），"
+                                "空闲页不会归还给文件系统；停机执行一次 VACUUM 后生效", mode)
+                return 0
+            before = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+            if not before:
+                return 0
+            # sqlite3 的 execute 只执行一步（只释放一页），executescript 才会执行到结束
+            raw = await conn.get_raw_connection()
+            await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(self.vacuum_pages)})")
+            after = (await conn.exec_driver_sql("PRAGMA freelist_count")).scalar()
+        freed = max(before - after, 0)
+        self.vacuum_pages_freed += freed
+        return freed
+
+    async def run_once(self) -> Dict[str, Any]:
+        """执行一轮归档、清除和空间回收，返回本轮结果"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            started = time.monotonic()
+            now = utcnow()
+            result = {"archived": 0, "indexed": 0, "purged": 0, "vacuum_pages": 0}
+            with span("archive.run"):
+                if self.idle_days > 0:
+                    result["archived"] = await self.archive_idle(now - timedelta(days=self.idle_days))
+                result["indexed"] = await self.index_pending()
+                if self.purge_days >= 0:
+                    result["purged"] = await self.purge_deleted(now - timedelta(days=self.purge_days))
+                result["vacuum_pages"] = await self.vacuum()
+            self.runs += 1
+            self.last_run = {**result, "finished_at": time.time(), "seconds": round(time.monotonic() - started, 3)}
+        if result["archived"] or result["purged"]:
+            logger.info("归档任务完成: %s", self.last_run)
+        return self.last_run
+
+    async def run(self, interval: float = ARCHIVE_INTERVAL) -> None:
+        """后台定期执行（在应用生命周期中启动）"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e) or type(e).__name__
+                logger.error("归档任务失败: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "idle_days": self.idle_days,
+            "purge_days": self.purge_days,
+            "codec": self.codec,
+            "search_index": search_index_enabled(),
+            "runs": self.runs,
+            "archived": self.archived,
+            "indexed": self.indexed,
+            "restored": self.restored,
+            "purged": self.purged,
+            "raw_bytes": self.raw_bytes,
+            "compressed_bytes": self.compressed_bytes,
+            "vacuum_pages": self.vacuum_pages_freed,
+            "last_run": self.last_run,
+            "last_error": self.last_error,
+        }
+
+
+# 全局归档任务
+archiver = Archiver()
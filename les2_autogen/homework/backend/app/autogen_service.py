@@ -1,23 +1,66 @@
 """
 AutoGen服务模块
 """
-from typing import AsyncGenerator, Dict, Any
-from autogen_agentchat.agents import AssistantAgent
-from autogen_ext.models.openai import OpenAIChatCompletionClient
+import asyncio
+import os
+import weakref
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, Any, List, Optional, Tuple
+from autogen_core.models import AssistantMessage, LLMMessage, UserMessage
+from sqlalchemy import select
+from sqlalchemy.sql import func
 
-from common.llms import get_model_client
+from app.agent_cache import AgentCache
+from app.agent_state import create_agent_state_store
+from app.database import AsyncSessionLocal
+from app.model_context import SlidingWindowChatCompletionContext, estimate_message_tokens
+from app.models import ChatMessage
+from app.response_cache import create_response_cache, replay_stream
+from app.telemetry import agent_acquire_duration, annotate, observe_chat_stream, span, traced
+from common.llms import get_provider_config, get_session_model_client, client_registry, resolve_llm_name, track_served_provider
 from common.log import DycLogger
+from common.rate_limit import current_session
+
+if TYPE_CHECKING:
+    # autogen_agentchat 导入较慢，在第一次创建智能体时才导入，加快工作进程启动
+    from autogen_agentchat.agents import AssistantAgent
 
 logger = DycLogger().get_logger()
 
+# 智能体缓存配置
+AGENT_CACHE_MAX_ENTRIES: int = int(os.getenv("AGENT_CACHE_MAX_ENTRIES", "256"))
+AGENT_CACHE_IDLE_TTL: float = float(os.getenv("AGENT_CACHE_IDLE_TTL", "1800"))
+AGENT_CACHE_MEMORY_BUDGET_MB: float = float(os.getenv("AGENT_CACHE_MEMORY_BUDGET_MB", "64"))
+
+# 对话上下文窗口配置（同时用于从数据库恢复历史）
+AGENT_HISTORY_MAX_MESSAGES: int = int(os.getenv("AGENT_HISTORY_MAX_MESSAGES", "40"))
+AGENT_HISTORY_TOKEN_BUDGET: int = int(os.getenv("AGENT_HISTORY_TOKEN_BUDGET", "4000"))
+
 
 class AutoGenService:
     """AutoGen对话服务"""
 
     def __init__(self):
-        self.agents: Dict[str, AssistantAgent] = {}
-        self.model_clients: Dict[str, OpenAIChatCompletionClient] = {}
+        self.agent_cache = AgentCache(
+            max_entries=AGENT_CACHE_MAX_ENTRIES,
+            idle_ttl=AGENT_CACHE_IDLE_TTL,
+            memory_budget=int(AGENT_CACHE_MEMORY_BUDGET_MB * 1024 * 1024)
+        )
+        # 模型回答缓存（RESPONSE_CACHE_BACKEND=none 时为 None）
+        self.response_cache = create_response_cache()
+        # 跨工作进程共享的智能体状态（AGENT_STATE_STORE=none 时为 None）
+        self.state_store = create_agent_state_store()
+        # 会话锁（没有请求持有时自动回收）
+        self._session_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
 
+    def session_lock(self, session_id: int) -> asyncio.Lock:
+        """获取会话的对话锁"""
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        return lock
+
+    @traced("agent.get_or_create", agent_acquire_duration, label="agent.cache")
     async def get_or_create_agent(
             self,
             session_id: int,
@@ -27,31 +70,178 @@ class AutoGenService:
     """,
             temperature: float = 0.7,
             max_tokens: int = 2000
-    ) -> AssistantAgent:
+    ) -> "AssistantAgent":
         """获取或创建代理"""
         agent_key = f"session_{session_id}"
 
-        if agent_key not in self.agents:
-            # 使用 d3_llms 中的方法创建模型客户端
-            model_client = get_model_client(
+        agent = self.agent_cache.get(agent_key)
+        result = "hit" if agent is not None else "miss"
+        if agent is not None and self.state_store is not None:
+            # 其他工作进程处理过该会话的后续轮次时，本地智能体的上下文已过期
+            stored_version = await self.state_store.version(session_id)
+            if stored_version != self.agent_cache.version(agent_key):
+                result = "stale"
+                self.agent_cache.set_version(agent_key, await self.restore_agent(session_id, agent))
+        annotate(**{"session.id": session_id, "agent.cache": result})
+        if agent is None:
+            # 复用提供商的共享客户端（连接池），temperature/max_tokens 按请求注入
+            model_client = get_session_model_client(
                 llm_name=model_name,
                 temperature=temperature,
-                max_tokens=max_tokens,
-                model_client_stream=True
+                max_tokens=max_tokens
+            )
+
+            # 使用有界的滑动窗口上下文，历史由 restore_agent 恢复
+            model_context = SlidingWindowChatCompletionContext(
+                max_messages=AGENT_HISTORY_MAX_MESSAGES,
+                token_budget=AGENT_HISTORY_TOKEN_BUDGET
             )
 
             # 创建助手代理
+            from autogen_agentchat.agents import AssistantAgent
             agent = AssistantAgent(
                 name=f"assistant_{session_id}",
                 model_client=model_client,
                 system_message=system_message,
+                model_context=model_context,
                 model_client_stream=True  # 启用流式输出
             )
+            version = await self.restore_agent(session_id, agent)
+
+            self.agent_cache.put(agent_key, agent, model_client, version)
+        return agent
+
+    async def restore_agent(self, session_id: int, agent: "AssistantAgent") -> int:
+        """
+        恢复智能体的上下文：优先加载存储的状态，没有状态时从消息表恢复历史
+
+        :return: 恢复的状态版本
+        """
+        version, state = 0, None
+        if self.state_store is not None:
+            try:
+                with span("agent.load_state", **{"session.id": session_id}):
+                    version, state = await self.state_store.load(session_id)
+                if state is not None:
+                    await agent.load_state(state)
+                    return version
+            except Exception as e:
+                logger.warning("加载智能体状态失败，从消息表恢复: %s, 会话id: %s", e, session_id)
+
+        with span("agent.load_history", **{"session.id": session_id}):
+            history = await self.load_history(session_id)
+        await agent.model_context.clear()
+        for message in history:
+            await agent.model_context.add_message(message)
+        return version
+
+    async def save_agent_state(self, session_id: int, agent: "AssistantAgent") -> None:
+        """
+        一轮对话结束后保存智能体状态（进入写入队列，不等待提交）
+
+        本地版本先递增，写入失败或版本冲突时标记为过期，下一轮从存储重新加载。
+        """
+        agent_key = f"session_{session_id}"
+        expected_version = self.agent_cache.version(agent_key)
+        if self.state_store is None or expected_version is None or expected_version < 0:
+            return
+        try:
+            state = await agent.save_state()
+        except Exception as e:
+            logger.warning("导出智能体状态失败: %s, 会话id: %s", e, session_id)
+            return
+        self.agent_cache.set_version(agent_key, expected_version + 1)
+
+        def on_saved(future) -> None:
+            if future.cancelled() or future.exception() is not None or future.result() is None:
+                if self.agent_cache.version(agent_key) == expected_version + 1:
+                    self.agent_cache.set_version(agent_key, -1)
+
+        self.state_store.save(session_id, state, expected_version).add_done_callback(on_saved)
+
+    async def load_history(self, session_id: int) -> List[LLMMessage]:
+        """
+        从数据库加载会话最近的历史消息
+
+        只取到最后一条助手回复为止（尚未回答的用户消息，包括本轮问题，不计入历史），
+        并按消息条数和token预算截断。
+        """
+        try:
+            async with AsyncSessionLocal() as db:
+                last_answer_id = (
+                    select(func.max(ChatMessage.id))
+                    .where(ChatMessage.session_id == session_id, ChatMessage.role == "assistant")
+                    .scalar_subquery()
+                )
+                result = await db.execute(
+                    select(ChatMessage.role, ChatMessage.content)
+                    .where(
+                        ChatMessage.session_id == session_id,
+                        ChatMessage.role.in_(("user", "assistant")),
+                        ChatMessage.id <= last_answer_id
+                    )
+                    .order_by(ChatMessage.id.desc())
+                    .limit(AGENT_HISTORY_MAX_MESSAGES)
+                )
+                rows = result.all()
+        except Exception as e:
+            logger.warning("加载会话历史失败: %s, 会话id: %s", e, session_id)
+            return []
+
+        history: List[LLMMessage] = []
+        tokens = 0
+        for role, content in rows:
+            if role == "user":
+                message = UserMessage(content=content, source="user")
+            else:
+                message = AssistantMessage(content=content, source=f"assistant_{session_id}")
+            tokens += estimate_message_tokens(message)
+            if history and tokens > AGENT_HISTORY_TOKEN_BUDGET:
+                break
+            history.append(message)
+        history.reverse()
+        if history:
+            logger.info("恢复会话历史: 会话id: %s, 消息数: %s, 估算token: %s", session_id, len(history), tokens)
+        return history
+
+    async def lookup_cached_response(
+            self,
+            agent: "AssistantAgent",
+            message: str,
+            model_name: str,
+            system_message: str,
+            temperature: float,
+            max_tokens: int
+    ) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        在调用模型前查找缓存的回答
+
+        :return: (缓存的回答, 缓存键参数)；缓存关闭时两者均为 None，
+                 未命中时回答为 None，键参数用于回答生成后调用 store_cached_response
+        """
+        if self.response_cache is None:
+            return None, None
+        cache_args = {
+            "provider": f"{resolve_llm_name(model_name)}/{get_provider_config(model_name)['model']}",
+            "system_message": system_message,
+            "history": list(await agent.model_context.get_messages()),
+            "message": message,
+            "params": {"temperature": temperature, "max_tokens": max_tokens},
+        }
+        content = await self.response_cache.lookup(**cache_args)
+        if content is not None:
+            # 命中时不会调用模型，需要手动把本轮问答写入智能体上下文，保持后续对话连贯
+            await agent.model_context.add_message(UserMessage(content=message, source="user"))
+            await agent.model_context.add_message(AssistantMessage(content=content, source=agent.name))
+            logger.info("命中回答缓存，长度: %s", len(content))
+        return content, cache_args
 
-            self.agents[agent_key] = agent
-            self.model_clients[agent_key] = model_client
-        return self.agents[agent_key]
+    async def store_cached_response(self, cache_args: Optional[Dict[str, Any]], content: str) -> None:
+        """保存模型生成的回答"""
+        if self.response_cache is not None and cache_args is not None:
+            await self.response_cache.store(content=content, **cache_args)
 
+    @observe_chat_stream("chat.stream")
     async def chat_stream(
             self,
             session_id: int,
@@ -63,8 +253,17 @@ class AutoGenService:
             temperature: float = 0.7,
             max_tokens: int = 2000
     ) -> AsyncGenerator[Dict[str, Any], None]:
-        logger.info(f"会话id: {session_id},用户问题: {message},模型提供商: {model_name}")
         """流式聊天"""
+        logger.info("会话id: %s,用户问题长度: %s,模型提供商: %s", session_id, len(message), model_name)
+        logger.debug("会话id: %s,用户问题: %s", session_id, message)
+        agent_key = f"session_{session_id}"
+        # 标记当前会话，模型提供商限流按会话公平排队（每个请求运行在独立的任务上下文中）
+        current_session.set(agent_key)
+        # 自动路由时记录实际提供服务的提供商
+        served = track_served_provider(model_name)
+        # 同一会话的多轮对话串行执行，避免并发写入同一个智能体的上下文
+        lock = self.session_lock(session_id)
+        await lock.acquire()
         try:
             # 获取或创建代理
             agent = await self.get_or_create_agent(
@@ -74,71 +273,99 @@ class AutoGenService:
                 temperature=temperature,
                 max_tokens=max_tokens
             )
+            self.agent_cache.acquire(agent_key)
             logger.info("智能体创建成功，开始对话...")
 
-            # 发送消息并获取流式响应
-            response_content = ""
+            # 发送消息并获取流式响应（使用列表缓冲累积，避免字符串重复拼接）
+            response_parts: List[str] = []
+            response_length = 0
+            seq = 0
+
+            # 命中回答缓存时按小块重放，不访问模型
+            cached_content, cache_args = await self.lookup_cached_response(
+                agent, message, model_name, system_message, temperature, max_tokens
+            )
+            if cached_content is not None:
+                async for chunk_content in replay_stream(cached_content):
+                    seq += 1
+                    yield {
+                        "type": "chunk",
+                        "seq": seq,
+                        "content": chunk_content
+                    }
+                await self.save_agent_state(session_id, agent)
+                yield {
+                    "type": "complete",
+                    "content": cached_content,
+                    "usage": None,
+                    "cached": True,
+                    "provider": served.name
+                }
+                return
 
             # 使用AutoGen进行对话
             final_content = ""
+            final_usage = None
             has_completed = False
 
+            # 流需要完整消费到 TaskResult 再结束（中途退出会在其他上下文中关闭 run_stream）
             async for event in agent.run_stream(task=message):
                 if hasattr(event, 'content'):
                     if hasattr(event, 'type'):
                         if event.type == 'ModelClientStreamingChunkEvent':
                             # 流式内容块
                             chunk_content = event.content
-                            response_content += chunk_content
-                            logger.debug(f"收到流式块，长度: {len(chunk_content)}, 累积长度: {len(response_content)}")
+                            response_parts.append(chunk_content)
+                            response_length += len(chunk_content)
+                            seq += 1
+                            logger.debug("收到流式块，长度: %s, 累积长度: %s", len(chunk_content), response_length)
                             yield {
                                 "type": "chunk",
-                                "content": chunk_content,
-                                "full_content": response_content
+                                "seq": seq,
+                                "content": chunk_content
                             }
-                        elif event.type == 'TextMessage' and hasattr(event, 'source') and event.source == 'assistant':
+                        elif event.type == 'TextMessage' and getattr(event, 'source', None) == agent.name and not has_completed:
                             # 最终完整消息 - 优先使用TextMessage的内容，但如果为空则使用累积内容
-                            final_content = event.content if event.content.strip() else response_content
+                            final_content = event.content if event.content.strip() else "".join(response_parts)
+                            final_usage = getattr(event, 'models_usage', None)
                             has_completed = True
-                            logger.info(f"收到TextMessage完整消息，长度: {len(final_content)}")
-                            yield {
-                                "type": "complete",
-                                "content": final_content,
-                                "usage": getattr(event, 'models_usage', None)
-                            }
-                            return
-                    else:
-                        # 处理TaskResult
-                        if hasattr(event, 'messages') and event.messages:
-                            last_message = event.messages[-1]
-                            if hasattr(last_message, 'content'):
-                                # 优先使用TaskResult的内容，但如果为空则使用累积内容
-                                final_content = last_message.content if last_message.content.strip() else response_content
-                                has_completed = True
-                                logger.info(f"收到TaskResult完整消息，长度: {len(final_content)}")
-                                yield {
-                                    "type": "complete",
-                                    "content": final_content,
-                                    "usage": getattr(last_message, 'models_usage', None)
-                                }
-                                return
+                            logger.info("收到TextMessage完整消息，长度: %s", len(final_content))
+                elif not has_completed and getattr(event, 'messages', None):
+                    # 处理TaskResult
+                    last_message = event.messages[-1]
+                    if hasattr(last_message, 'content'):
+                        # 优先使用TaskResult的内容，但如果为空则使用累积内容
+                        final_content = last_message.content if last_message.content.strip() else "".join(response_parts)
+                        final_usage = getattr(last_message, 'models_usage', None)
+                        has_completed = True
+                        logger.info("收到TaskResult完整消息，长度: %s", len(final_content))
 
             # 如果没有收到完成信号，发送流式累积的内容
-            if not has_completed and response_content:
-                logger.info(f"使用流式累积内容作为最终消息: {response_content}")
+            if not has_completed and response_parts:
+                final_content = "".join(response_parts)
+                has_completed = True
+                logger.info("使用流式累积内容作为最终消息，长度: %s", len(final_content))
+
+            if has_completed:
+                await self.store_cached_response(cache_args, final_content)
+                await self.save_agent_state(session_id, agent)
                 yield {
                     "type": "complete",
-                    "content": response_content,
-                    "usage": None
+                    "content": final_content,
+                    "usage": final_usage,
+                    "provider": served.name
                 }
 
         except Exception as e:
-            logger.error(f"对话过程中发生错误: {str(e)}")
+            logger.error("对话过程中发生错误: %s", e)
             yield {
                 "type": "error",
                 "content": f"对话过程中发生错误: {str(e)}",
                 "error": str(e)
             }
+        finally:
+            self.agent_cache.release(agent_key)
+            lock.release()
 
     async def chat_simple(
             self,
@@ -151,9 +378,17 @@ class AutoGenService:
             temperature: float = 0.7,
             max_tokens: int = 2000
     ) -> Dict[str, Any]:
-        logger.info(f"会话id: {session_id},用户问题: {message},模型提供商: {model_name}")
-
         """简单聊天（非流式）"""
+        logger.info("会话id: %s,用户问题长度: %s,模型提供商: %s", session_id, len(message), model_name)
+        logger.debug("会话id: %s,用户问题: %s", session_id, message)
+        agent_key = f"session_{session_id}"
+        # 标记当前会话，模型提供商限流按会话公平排队（每个请求运行在独立的任务上下文中）
+        current_session.set(agent_key)
+        # 自动路由时记录实际提供服务的提供商
+        served = track_served_provider(model_name)
+        # 同一会话的多轮对话串行执行，避免并发写入同一个智能体的上下文
+        lock = self.session_lock(session_id)
+        await lock.acquire()
         try:
             # 获取或创建代理
             agent = await self.get_or_create_agent(
@@ -163,21 +398,41 @@ class AutoGenService:
                 temperature=temperature,
                 max_tokens=max_tokens
             )
+            self.agent_cache.acquire(agent_key)
+
+            # 命中回答缓存时直接返回，不访问模型
+            cached_content, cache_args = await self.lookup_cached_response(
+                agent, message, model_name, system_message, temperature, max_tokens
+            )
+            if cached_content is not None:
+                await self.save_agent_state(session_id, agent)
+                return {
+                    "success": True,
+                    "content": cached_content,
+                    "usage": None,
+                    "cached": True,
+                    "provider": served.name
+                }
 
             # 发送消息并获取响应
-            result = await agent.run(task=message)
+            with span("chat.run", **{"llm.provider": resolve_llm_name(model_name), "session.id": session_id}):
+                result = await agent.run(task=message)
 
             if result.messages:
                 last_message = result.messages[-1]
-                logger.info(f"最终完整消息: {last_message.content}")
+                logger.info("收到完整消息，长度: %s", len(last_message.content))
+                logger.debug("最终完整消息: %s", last_message.content)
+                await self.store_cached_response(cache_args, last_message.content)
+                await self.save_agent_state(session_id, agent)
 
                 return {
                     "success": True,
                     "content": last_message.content,
-                    "usage": getattr(last_message, 'models_usage', None)
+                    "usage": getattr(last_message, 'models_usage', None),
+                    "provider": served.name
                 }
             else:
-                logger.info(f"未收到有效响应")
+                logger.info("未收到有效响应")
                 return {
                     "success": False,
                     "content": "未收到有效响应",
@@ -185,43 +440,33 @@ class AutoGenService:
                 }
 
         except Exception as e:
-            logger.error(f"对话过程中发生错误: {str(e)}")
+            logger.error("对话过程中发生错误: %s", e)
             return {
                 "success": False,
                 "content": f"对话过程中发生错误: {str(e)}",
                 "error": str(e)
             }
+        finally:
+            self.agent_cache.release(agent_key)
+            lock.release()
 
     async def clear_session(self, session_id: int):
         """清除会话"""
         agent_key = f"session_{session_id}"
-        logger.info(f"清除会话: {agent_key}")
-
-        if agent_key in self.agents:
-            # 关闭模型客户端
-            if agent_key in self.model_clients:
-                try:
-                    # 某些客户端可能没有close方法
-                    if hasattr(self.model_clients[agent_key], 'close'):
-                        await self.model_clients[agent_key].close()
-                except Exception as e:
-                    print(f"关闭模型客户端时出错: {e}")
-                finally:
-                    del self.model_clients[agent_key]
-
-            # 删除代理
-            del self.agents[agent_key]
+        logger.info("清除会话: %s", agent_key)
+
+        # 删除代理并关闭模型客户端
+        await self.agent_cache.pop(agent_key)
+        # 其他工作进程缓存的该会话智能体随之过期
+        if self.state_store is not None:
+            await self.state_store.reset(session_id)
 
     async def cleanup(self):
         """清理所有资源"""
-        for client in self.model_clients.values():
-            try:
-                await client.close()
-            except:
-                pass
-
-        self.agents.clear()
-        self.model_clients.clear()
+        await self.agent_cache.clear()
+        if self.response_cache is not None:
+            await self.response_cache.close()
+        await client_registry.close()
 
 
 # 创建全局服务实例
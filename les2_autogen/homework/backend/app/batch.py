@@ -0,0 +1,135 @@
+"""
+批量提示词
+
+一次提交多个相互独立的提示词（例如批量生成测试用例），共用系统提示词和模型：
+- 不创建会话和智能体，每个提示词直接在提供商的共享客户端（连接池、限流）上调用一次模型
+- 最多 parallelism 个提示词同时执行，结果按完成顺序产出，每项带有用量、耗时或错误
+- 整个批次在提供商限流中算作一个会话公平排队，不会挤占交互式对话
+- 用量累加到提供商统计（provider_usage），不计入任何会话
+"""
+import asyncio
+import contextvars
+import os
+import time
+import uuid
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence
+
+from autogen_core.models import SystemMessage, UserMessage
+
+from app.persistence import persistence
+from app.telemetry import chat_turns, provider_errors, span
+from app.usage import record_usage, usage_to_dict
+from common.llms import get_session_model_client, resolve_llm_name, track_served_provider
+from common.log import DycLogger
+from common.rate_limit import current_session
+
+logger = DycLogger().get_logger()
+
+# 单个批次最多的提示词数
+BATCH_MAX_PROMPTS: int = int(os.getenv("BATCH_MAX_PROMPTS", "1000"))
+# 并发数：请求未指定时的默认值和允许的上限
+BATCH_DEFAULT_PARALLELISM: int = int(os.getenv("BATCH_DEFAULT_PARALLELISM", "8"))
+BATCH_MAX_PARALLELISM: int = int(os.getenv("BATCH_MAX_PARALLELISM", "32"))
+# 单个提示词的超时时间（秒，含限流排队）
+BATCH_ITEM_TIMEOUT: float = float(os.getenv("BATCH_ITEM_TIMEOUT", "120"))
+
+
+async def run_prompt(client: Any, provider: str, system_message: str, prompt: str, timeout: float) -> Dict[str, Any]:
+    """调用一次模型，返回 content/usage/seconds；用量记在实际提供服务的提供商上（自动路由时由路由器报告）"""
+    started = time.monotonic()
+    messages = [UserMessage(content=prompt, source="user")]
+    if system_message:
+        messages.insert(0, SystemMessage(content=system_message))
+    # 同一批次的工作任务共用一个上下文，在设置后立即创建任务，使本次调用持有自己的记录对象
+    served = track_served_provider(provider)
+    result = await asyncio.wait_for(asyncio.ensure_future(client.create(messages)), timeout)
+    provider = served.name
+    content = result.content if isinstance(result.content, str) else str(result.content)
+    seconds = time.monotonic() - started
+    usage = usage_to_dict(result.usage, system_message + prompt, content)
+
+    async def write(db):
+        await record_usage(db, None, provider, usage, seconds)
+
+    persistence.enqueue(write)
+    return {"content": content, "usage": usage, "seconds": round(seconds, 3)}
+
+
+async def run_batch(
+        prompts: Sequence[str],
+        model_name: str,
+        system_message: str,
+        temperature: Optional[float],
+        max_tokens: Optional[int],
+        parallelism: int = BATCH_DEFAULT_PARALLELISM,
+        item_timeout: float = BATCH_ITEM_TIMEOUT,
+        batch_id: Optional[str] = None
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    并发执行一批提示词，按完成顺序产出每项结果，最后产出汇总
+
+    每项: {"type": "item", "index": 序号, "ok": true, "content", "usage", "seconds"}
+         或 {"type": "item", "index": 序号, "ok": false, "error"}
+    汇总: {"type": "summary", "batch_id", "total", "succeeded", "failed", "usage", "seconds"}
+    调用方停止读取（客户端断开）时取消未完成的提示词。
+    """
+    batch_id = batch_id or uuid.uuid4().hex
+    provider = resolve_llm_name(model_name)
+    client = get_session_model_client(llm_name=model_name, temperature=temperature, max_tokens=max_tokens)
+    # 整个批次在限流中作为一个会话排队
+    context = contextvars.copy_context()
+    context.run(current_session.set, f"batch_{batch_id}")
+
+    started = time.monotonic()
+    results: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue()
+    next_index = iter(range(len(prompts)))
+
+    async def worker() -> None:
+        for index in next_index:
+            try:
+                with span("batch.item", **{"batch.id": batch_id, "batch.index": index, "llm.provider": provider}):
+                    item = await run_prompt(client, provider, system_message, prompts[index], item_timeout)
+                chat_turns.inc(provider, "complete")
+                await results.put({"type": "item", "index": index, "ok": True, **item})
+            except asyncio.TimeoutError:
+                chat_turns.inc(provider, "error")
+                await results.put({"type": "item", "index": index, "ok": False, "error": f"超过 {item_timeout:g} 秒未完成"})
+            except Exception as e:
+                logger.warning("批量提示词执行失败: %s, 批次: %s, 序号: %s", e, batch_id, index)
+                chat_turns.inc(provider, "error")
+                provider_errors.inc(provider)
+                await results.put({"type": "item", "index": index, "ok": False, "error": str(e) or type(e).__name__})
+
+    workers: List[asyncio.Task] = [
+        asyncio.create_task(worker(), context=context) for _ in range(max(1, min(parallelism, len(prompts))))
+    ]
+    succeeded = failed = prompt_tokens = completion_tokens = 0
+    try:
+        for _ in range(len(prompts)):
+            item = await results.get()
+            if item["ok"]:
+                succeeded += 1
+                prompt_tokens += item["usage"]["prompt_tokens"]
+                completion_tokens += item["usage"]["completion_tokens"]
+            else:
+                failed += 1
+            yield item
+    finally:
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    logger.info("批量提示词完成: 批次: %s, 成功: %s, 失败: %s", batch_id, succeeded, failed)
+    yield {
+        "type": "summary",
+        "batch_id": batch_id,
+        "total": len(prompts),
+        "succeeded": succeeded,
+        "failed": failed,
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        },
+        "seconds": round(time.monotonic() - started, 3)
+    }
@@ -0,0 +1,225 @@
+"""
+请求合并（single-flight）与可恢复的生成流
+
+同一会话并发提交相同的消息时（重复点击、SSE断线后客户端重试），只运行一次模型调用：
+第一个请求负责生成，后续请求订阅同一个事件流，从头接收全部事件。
+
+生成过程运行在独立的后台任务中，事件写入有界的环形缓冲区并带有递增的事件id：
+- 订阅者断开不会中断生成，客户端可以用 Last-Event-ID 按 user_message_id 重新连接并从断点继续
+- 缓冲区已丢弃断点之后的事件时，先发送一个包含被丢弃内容的 snapshot 事件，再从缓冲区继续
+- 没有任何订阅者超过 STREAM_ABANDON_GRACE 秒的生成会被取消，释放模型提供商的容量
+- 生成结束后在 STREAM_RESUME_TTL 秒内仍可恢复
+"""
+import asyncio
+import hashlib
+import os
+from collections import deque
+from typing import Any, AsyncGenerator, AsyncIterator, Deque, Dict, Hashable, List, Optional, Tuple
+
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 每个生成保留的事件数
+STREAM_REPLAY_BUFFER: int = int(os.getenv("STREAM_REPLAY_BUFFER", "2048"))
+# 生成结束后仍可恢复的时间（秒）
+STREAM_RESUME_TTL: float = float(os.getenv("STREAM_RESUME_TTL", "60"))
+# 没有订阅者后等待重连的时间（秒），超时取消生成；<=0 表示从不取消
+STREAM_ABANDON_GRACE: float = float(os.getenv("STREAM_ABANDON_GRACE", "30"))
+
+
+def message_key(kind: str, session_id: int, message: str) -> tuple:
+    """合并键：(请求类型, 会话id, 消息摘要)"""
+    return kind, session_id, hashlib.sha256(message.encode("utf-8")).hexdigest()
+
+
+class Flight:
+    """一次生成，事件保存在环形缓冲区中供订阅者回放"""
+
+    def __init__(self, key: Hashable, buffer_size: int = STREAM_REPLAY_BUFFER):
+        self.key = key
+        self.events: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=max(buffer_size, 1))
+        self.last_id = 0
+        self.done = False
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        # user_message_id，开始生成时设置，用于生成SSE事件id
+        self.resume_key: Optional[int] = None
+        # 会话事件（第一个事件）和已产生的回答内容，缓冲区不足以回放时用于发送快照
+        self.header: Optional[Dict[str, Any]] = None
+        self.content_parts: List[str] = []
+        # 已被挤出缓冲区的内容块数量
+        self.evicted_chunks = 0
+        self._changed = asyncio.Event()
+        self._abandon_timer: Optional[asyncio.TimerHandle] = None
+        self._on_idle = None
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        if len(self.events) == self.events.maxlen and self.events[0][1].get("type") == "chunk":
+            self.evicted_chunks += 1
+        self.last_id += 1
+        self.events.append((self.last_id, event))
+        if self.last_id == 1:
+            self.header = event
+        if event.get("type") == "chunk":
+            self.content_parts.append(event["content"])
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._cancel_abandon_timer()
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _cancel_abandon_timer(self) -> None:
+        if self._abandon_timer is not None:
+            self._abandon_timer.cancel()
+            self._abandon_timer = None
+
+    async def subscribe(self, after_id: int = 0) -> AsyncGenerator[Tuple[int, Dict[str, Any]], None]:
+        """输出id大于 after_id 的事件 (id, event)，直到生成结束"""
+        self.subscribers += 1
+        self._cancel_abandon_timer()
+        next_id = after_id + 1
+        try:
+            while True:
+                while next_id <= self.last_id:
+                    first_id = self.events[0][0]
+                    if next_id < first_id:
+                        # 断点之后的事件已被挤出缓冲区：发送被挤出部分的累积内容，再从缓冲区继续
+                        if next_id == 1 and self.header is not None:
+                            yield 1, self.header
+                        next_id = first_id
+                        yield first_id - 1, {"type": "snapshot", "content": "".join(self.content_parts[:self.evicted_chunks])}
+                        continue
+                    event_id, event = self.events[next_id - first_id]
+                    next_id = event_id + 1
+                    yield event_id, event
+                if self.done:
+                    return
+                changed = self._changed
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self._on_idle is not None:
+                self._on_idle(self)
+
+    async def result(self) -> Optional[Dict[str, Any]]:
+        """等待生成结束，返回最后一个事件"""
+        async for _ in self.subscribe(self.last_id):
+            pass
+        return self.events[-1][1] if self.events else None
+
+
+class SingleFlight:
+    """按键合并并发的生成请求，并按 user_message_id 提供断线恢复"""
+
+    def __init__(self, abandon_grace: float = STREAM_ABANDON_GRACE, resume_ttl: float = STREAM_RESUME_TTL):
+        self.abandon_grace = abandon_grace
+        self.resume_ttl = resume_ttl
+        self._flights: Dict[Hashable, Flight] = {}
+        self._resumable: Dict[int, Flight] = {}
+        self.started = 0
+        self.coalesced = 0
+        self.resumed = 0
+        self.abandoned = 0
+        self.cancelled = 0
+
+    def get(self, key: Hashable) -> Optional[Flight]:
+        """查找进行中的生成，找到时计为一次合并"""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        return flight
+
+    def resumable(self, resume_key: int) -> Optional[Flight]:
+        """按 user_message_id 查找可恢复的生成（进行中或刚结束）"""
+        flight = self._resumable.get(resume_key)
+        if flight is not None:
+            self.resumed += 1
+        return flight
+
+    def reserve(self, key: Hashable) -> Flight:
+        """登记一次新的生成（在任何 await 之前调用，保证并发请求能看到它）"""
+        flight = Flight(key)
+        flight._on_idle = self._schedule_abandon
+        self._flights[key] = flight
+        return flight
+
+    def start(self, flight: Flight, source: AsyncIterator[Dict[str, Any]], resume_key: Optional[int] = None) -> Flight:
+        """在后台任务中运行 source，把产生的事件发布给所有订阅者"""
+        self.started += 1
+        if resume_key is not None:
+            flight.resume_key = resume_key
+            self._resumable[resume_key] = flight
+        flight.task = asyncio.create_task(self._run(flight, source, resume_key))
+        return flight
+
+    def fail(self, flight: Flight, event: Dict[str, Any]) -> None:
+        """生成未能开始（例如保存用户消息失败），通知已订阅的请求"""
+        flight.publish(event)
+        self._finish(flight, None)
+
+    def cancel(self, flight: Flight) -> bool:
+        """客户端主动取消生成（会影响订阅同一生成的所有请求），返回是否取消了进行中的生成"""
+        if flight.done or flight.task is None:
+            return False
+        self.cancelled += 1
+        flight.task.cancel()
+        return True
+
+    async def _run(self, flight: Flight, source: AsyncIterator[Dict[str, Any]], resume_key: Optional[int]) -> None:
+        try:
+            async for event in source:
+                flight.publish(event)
+        except asyncio.CancelledError:
+            logger.info("生成已取消: %s", flight.key)
+            flight.publish({"type": "error", "error": "cancelled", "content": "生成已取消"})
+        except Exception as e:
+            logger.error("后台生成失败: %s", e)
+            flight.publish({"type": "error", "error": str(e), "content": f"处理请求时发生错误: {str(e)}"})
+        finally:
+            self._finish(flight, resume_key)
+
+    def _finish(self, flight: Flight, resume_key: Optional[int]) -> None:
+        flight.finish()
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if resume_key is not None:
+            # 结束后保留一段时间，允许刚断线的客户端取回结尾
+            asyncio.get_running_loop().call_later(self.resume_ttl, self._expire, resume_key, flight)
+
+    def _expire(self, resume_key: int, flight: Flight) -> None:
+        if self._resumable.get(resume_key) is flight:
+            del self._resumable[resume_key]
+
+    def _schedule_abandon(self, flight: Flight) -> None:
+        """最后一个订阅者断开后开始计时，超时仍无人重连则取消生成"""
+        if self.abandon_grace <= 0 or flight.task is None:
+            return
+        flight._cancel_abandon_timer()
+        flight._abandon_timer = asyncio.get_running_loop().call_later(self.abandon_grace, self._abandon, flight)
+
+    def _abandon(self, flight: Flight) -> None:
+        flight._abandon_timer = None
+        if flight.subscribers == 0 and not flight.done and flight.task is not None:
+            self.abandoned += 1
+            flight.task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "resumable": len(self._resumable),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+            "cancelled": self.cancelled,
+        }
+
+
+# 全局聊天请求合并器
+chat_flights = SingleFlight()
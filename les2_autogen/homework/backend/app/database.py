@@ -1,52 +1,120 @@
 """
 数据库配置和连接管理
 """
-import asyncio
-from sqlalchemy import create_engine, MetaData
+import os
+from typing import List
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 
-# 数据库配置
-DATABASE_URL: str = "sqlite:///./chat_system.db"
+# 数据库配置（异步驱动：本地使用 aiosqlite，生产可切换为 postgresql+asyncpg://...）
+DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./chat_system.db")
+
+# SQLite日志模式：默认WAL（读写不互相阻塞，提交只追加日志）
+SQLITE_WAL: bool = os.getenv("SQLITE_WAL", "1") != "0"
+# 持久性：full 每次提交都fsync；normal 在WAL模式下只在检查点fsync（进程崩溃不丢数据，断电可能丢失最近的提交）；off 不fsync
+DB_DURABILITY: str = os.getenv("DB_DURABILITY", "normal").lower()
+# 自动清理空闲页：incremental 由归档任务定期 incremental_vacuum 归还空间；只对新建的数据库文件生效
+SQLITE_AUTO_VACUUM: str = os.getenv("SQLITE_AUTO_VACUUM", "incremental").lower()
 
 # 应用程序配置
 APP_HOST: str = "0.0.0.0"
 APP_PORT: int = 8000
 DEBUG: bool = True
 
-# 创建数据库引擎
+# 创建异步数据库引擎
 if DATABASE_URL.startswith("sqlite"):
     # SQLite配置
     SQLALCHEMY_DATABASE_URL = DATABASE_URL
-    engine = create_engine(
-        SQLALCHEMY_DATABASE_URL, 
+    engine = create_async_engine(
+        SQLALCHEMY_DATABASE_URL,
         connect_args={"check_same_thread": False},
         echo=DEBUG
     )
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def _configure_sqlite(dbapi_connection, connection_record):
+        """新连接设置空闲页清理、日志模式和持久性"""
+        synchronous = {"full": "FULL", "normal": "NORMAL", "off": "OFF"}.get(DB_DURABILITY, "NORMAL")
+        auto_vacuum = {"none": "NONE", "full": "FULL", "incremental": "INCREMENTAL"}.get(SQLITE_AUTO_VACUUM, "INCREMENTAL")
+        cursor = dbapi_connection.cursor()
+        # 必须在建表之前设置，已有数据库需要执行一次 VACUUM 才会切换
+        cursor.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+        if SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={synchronous}")
+        cursor.execute("PRAGMA busy_timeout=5000")
+        cursor.close()
+        # 全文检索触发器使用的函数
+        from app.search import register_sqlite_functions
+        register_sqlite_functions(dbapi_connection)
 else:
     # 其他数据库配置
-    engine = create_engine(DATABASE_URL, echo=DEBUG)
+    engine = create_async_engine(DATABASE_URL, echo=DEBUG, pool_pre_ping=True)
 
-# 创建会话工厂
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# 创建异步会话工厂（提交后不过期对象，避免在事件循环中触发隐式IO）
+AsyncSessionLocal = async_sessionmaker(
+    bind=engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
 
 # 创建基础模型类
 Base = declarative_base()
 
-def get_db():
-    """获取数据库会话"""
-    db = SessionLocal()
-    try:
+async def get_db():
+    """获取异步数据库会话"""
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 async def init_db():
     """初始化数据库表"""
     # 导入所有模型以确保它们被注册
-    from app.models import ChatSession, ChatMessage
-    
+    from app.models import ChatSession, ChatMessage, ProviderUsage, AgentState, SessionArchive, SESSION_STATS_BACKFILL_SQL
+    from app.search import init_search_index
+
     # 创建所有表
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # 为旧数据库补充新增的列
+        added_columns = await conn.run_sync(_add_missing_columns)
+        if "chat_sessions.user_message_count" in added_columns:
+            await conn.exec_driver_sql(SESSION_STATS_BACKFILL_SQL)
+        await conn.run_sync(_create_missing_indexes)
+        # 创建全文检索索引
+        await init_search_index(conn)
     print("Database tables created successfully!")
+
+def _add_missing_columns(sync_conn) -> List[str]:
+    """
+    为已存在的表补充模型中新增的列（create_all 不会修改已有表）
+
+    :return: 新增的列，格式为 "表名.列名"
+    """
+    inspector = inspect(sync_conn)
+    added = []
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=sync_conn.dialect)}"
+            if column.server_default is not None:
+                default = column.server_default.arg
+                ddl += f" DEFAULT '{default}'" if isinstance(default, str) else f" DEFAULT {default}"
+            sync_conn.exec_driver_sql(ddl)
+            added.append(f"{table.name}.{column.name}")
+    return added
+
+def _create_missing_indexes(sync_conn) -> None:
+    """为已存在的表创建模型中新增的索引"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+async def close_db():
+    """释放数据库连接池"""
+    await engine.dispose()
@@ -0,0 +1,34 @@
+"""
+流式接口的帧编码
+
+WebSocket聊天（app/routers/ws_chat.py）和批量提示词的NDJSON输出（app/routers/batch.py）共用。
+"""
+import json
+from typing import Any, Dict, Optional
+
+
+def encode_frame(frame: Dict[str, Any]) -> str:
+    """紧凑JSON：无多余空白，中文不转义"""
+    return json.dumps(frame, separators=(",", ":"), ensure_ascii=False)
+
+
+def format_ws_event(turn_id: Any, seq: int, event: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """把生成事件转换为WebSocket帧"""
+    if event["type"] == "session":
+        return {"t": "s", "id": turn_id, "sid": event["session_id"], "uid": event["user_message_id"], "n": seq}
+    if event["type"] == "chunk":
+        return {"t": "d", "id": turn_id, "n": seq, "d": event["content"]}
+    if event["type"] == "snapshot":
+        return {"t": "snap", "id": turn_id, "n": seq, "c": event["content"]}
+    if event["type"] == "complete":
+        return {
+            "t": "done",
+            "id": turn_id,
+            "n": seq,
+            "aid": event["assistant_message_id"],
+            "u": event["usage"],
+            "k": event["cached"]
+        }
+    if event["type"] == "error":
+        return {"t": "err", "id": turn_id, "n": seq, "e": event["error"], "c": event["content"]}
+    return None
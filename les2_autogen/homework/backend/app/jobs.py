@@ -0,0 +1,368 @@
+"""
+异步任务队列
+
+非流式聊天以任务方式提交时，请求立即返回任务id，模型调用在后台完成：
+- 进程内优先级队列（priority 越大越先执行，同优先级先进先出），队列长度有上限，满时拒绝提交
+- 固定数量的工作协程（JOB_WORKERS）执行任务，服务端并发数明确可调
+- 每个任务有截止时间（从提交时算起），排队超时的任务不再执行，执行超时的任务被取消
+- 结束的任务结果保留 JOB_RESULT_TTL 秒供轮询，过期后清除
+- 可选的 webhook：任务结束后把任务信息 POST 到指定地址，失败时按指数退避重试。
+  地址由客户端提供，为防止 SSRF：配置了 JOB_WEBHOOK_ALLOWED_HOSTS 时只允许这些主机，
+  否则解析主机名并拒绝回环、私有、链路本地、保留等非公网地址；不跟随重定向。
+  发送时直接连接检查过的地址（Host 头和 TLS 的 SNI/证书校验仍使用原主机名），
+  避免检查之后再次解析时得到不同的地址（DNS rebinding）
+"""
+import asyncio
+import contextvars
+import ipaddress
+import itertools
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from urllib.parse import urlsplit, urlunsplit
+
+from app.telemetry import span
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 工作协程数（同时执行的任务数）
+JOB_WORKERS: int = int(os.getenv("JOB_WORKERS", "4"))
+# 排队任务数上限
+JOB_QUEUE_MAX: int = int(os.getenv("JOB_QUEUE_MAX", "1000"))
+# 默认截止时间（秒，从提交时算起）
+JOB_DEFAULT_DEADLINE: float = float(os.getenv("JOB_DEFAULT_DEADLINE", "300"))
+# 结束的任务结果保留时间（秒）
+JOB_RESULT_TTL: float = float(os.getenv("JOB_RESULT_TTL", "3600"))
+# webhook 请求超时（秒）和重试次数
+JOB_WEBHOOK_TIMEOUT: float = float(os.getenv("JOB_WEBHOOK_TIMEOUT", "10"))
+JOB_WEBHOOK_RETRIES: int = int(os.getenv("JOB_WEBHOOK_RETRIES", "3"))
+# 允许的 webhook 主机（逗号分隔，"example.com" 同时匹配其子域名），为空时允许任何公网地址
+JOB_WEBHOOK_ALLOWED_HOSTS: List[str] = [
+    host.strip().lower().strip(".") for host in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+]
+
+# 任务状态
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_EXPIRED = "expired"
+JOB_CANCELLED = "cancelled"
+JOB_FINISHED = (JOB_SUCCEEDED, JOB_FAILED, JOB_EXPIRED, JOB_CANCELLED)
+
+# 任务函数：返回值作为任务结果，抛出异常时任务失败
+JobFunc = Callable[[], Awaitable[Any]]
+
+
+class JobQueueFull(Exception):
+    """排队任务数已达上限"""
+
+
+class WebhookNotAllowed(ValueError):
+    """webhook 地址不允许访问"""
+
+
+def _public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+async def check_webhook_url(url: str) -> Optional[str]:
+    """
+    检查 webhook 地址（提交任务时和每次发送前调用）
+
+    :return: 检查过的IP地址，发送时应直接连接该地址；主机在白名单中时为 None（按主机名发送）
+    :raises WebhookNotAllowed: 协议不是 http/https、主机不在白名单中，或主机解析到非公网地址
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower().rstrip(".")
+    if parts.scheme not in ("http", "https") or not host:
+        raise WebhookNotAllowed("webhook 地址必须是 http(s) URL")
+    if JOB_WEBHOOK_ALLOWED_HOSTS:
+        if not any(host == allowed or host.endswith("." + allowed) for allowed in JOB_WEBHOOK_ALLOWED_HOSTS):
+            raise WebhookNotAllowed(f"webhook 主机不在允许列表中: {host}")
+        return None
+    try:
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port)
+    except (OSError, ValueError) as e:
+        raise WebhookNotAllowed(f"无法解析 webhook 主机: {host}") from e
+    # 任何一个解析结果不是公网地址都拒绝（避免解析到多个地址时绕过检查）
+    if not infos or not all(_public_address(info[4][0]) for info in infos):
+        raise WebhookNotAllowed(f"webhook 主机解析到非公网地址: {host}")
+    return infos[0][4][0]
+
+
+def pinned_request(url: str, address: Optional[str]) -> Dict[str, Any]:
+    """
+    构造直接连接 address 的请求参数（url/headers/extensions）
+
+    URL 中的主机换成IP地址，Host 头保持原值；https 时通过 sni_hostname 让 TLS 的 SNI 和证书校验使用原主机名。
+    """
+    if address is None:
+        return {"url": url}
+    parts = urlsplit(url)
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    netloc = f"[{ip}]" if ip.version == 6 else str(ip)
+    if parts.port is not None:
+        netloc += f":{parts.port}"
+    host = parts.netloc.rsplit("@", 1)[-1]
+    return {
+        "url": urlunsplit((parts.scheme, netloc, parts.path, parts.query, parts.fragment)),
+        "headers": {"Host": host},
+        "extensions": {"sni_hostname": parts.hostname} if parts.scheme == "https" else {},
+    }
+
+
+class Job:
+    """一个后台任务"""
+
+    def __init__(self, func: JobFunc, kind: str, priority: int, deadline: float,
+                 webhook_url: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.kind = kind
+        self.priority = priority
+        self.webhook_url = webhook_url
+        self.metadata: Dict[str, Any] = dict(metadata or {})
+        self.status = JOB_QUEUED
+        self.result: Any = None
+        self.error: Optional[str] = None
+        # 墙上时间用于展示，单调时间用于截止判断
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.deadline = time.monotonic() + deadline
+        self.task: Optional[asyncio.Task] = None
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_FINISHED
+
+    def finish(self, status: str, result: Any = None, error: Optional[str] = None) -> None:
+        self.status = status
+        self.result = result
+        self.error = error
+        self.finished_at = time.time()
+        self.func = None
+        self._done.set()
+
+    async def wait(self, timeout: float) -> None:
+        """等待任务结束，最多 timeout 秒"""
+        if not self.finished and timeout > 0:
+            try:
+                await asyncio.wait_for(self._done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "priority": self.priority,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "queue_seconds": round(self.started_at - self.created_at, 3) if self.started_at else None,
+            "run_seconds": round(self.finished_at - self.started_at, 3) if self.started_at and self.finished_at else None,
+            "metadata": self.metadata,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    """有界的优先级任务队列和工作协程池"""
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_MAX,
+                 result_ttl: float = JOB_RESULT_TTL):
+        self.workers = max(workers, 1)
+        self.max_queued = max_queued
+        self.result_ttl = result_ttl
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._webhook_tasks: Set[asyncio.Task] = set()
+        self._http_client = None
+        # 任务id -> 任务；结束的任务按结束顺序排在 _finished 中，用于按TTL清除
+        self._jobs: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._seq = itertools.count()
+        # 排队中的任务数（不含已取消但还留在优先级队列中的任务）
+        self._queued = 0
+        self.running = 0
+        # 统计
+        self.submitted = 0
+        self.rejected = 0
+        self.counts: Dict[str, int] = {status: 0 for status in JOB_FINISHED}
+
+    def _ensure_workers(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._tasks = [task for task in self._tasks if not task.done()]
+        while len(self._tasks) < self.workers:
+            # 工作协程在空上下文中运行，不继承第一个提交请求的追踪上下文
+            self._tasks.append(asyncio.create_task(self._worker(), context=contextvars.Context()))
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def check_capacity(self) -> None:
+        """队列已满时抛出 JobQueueFull（调用方可以在准备任务之前先检查）"""
+        if 0 < self.max_queued <= self.queued:
+            self.rejected += 1
+            raise JobQueueFull(f"排队任务数已达上限: {self.max_queued}")
+
+    def submit(self, func: JobFunc, kind: str = "job", priority: int = 0, deadline: float = JOB_DEFAULT_DEADLINE,
+               webhook_url: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None) -> Job:
+        """提交任务，队列已满时抛出 JobQueueFull"""
+        self.sweep()
+        self.check_capacity()
+        self._ensure_workers()
+        job = Job(func, kind, priority, deadline, webhook_url, metadata)
+        self._jobs[job.id] = job
+        self._queue.put_nowait((-priority, next(self._seq), job))
+        self._queued += 1
+        self.submitted += 1
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self.sweep()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        """取消排队中或执行中的任务，返回任务（不存在时为 None）"""
+        job = self.get(job_id)
+        if job is None or job.finished:
+            return job
+        if job.task is not None:
+            job.task.cancel()
+        else:
+            # 还在队列中，工作协程取出时跳过
+            self._queued -= 1
+            self._complete(job, JOB_CANCELLED, error="任务已取消")
+        return job
+
+    def sweep(self) -> int:
+        """清除结果已过期的任务，返回清除数量"""
+        deadline = time.time() - self.result_ttl
+        removed = 0
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at >= deadline:
+                break
+            self._finished.popitem(last=False)
+            self._jobs.pop(job_id, None)
+            removed += 1
+        return removed
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.finished:
+                    # 排队时已取消，取消时已从排队数中减去
+                    continue
+                self._queued -= 1
+                remaining = job.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._complete(job, JOB_EXPIRED, error="任务在排队期间超过截止时间")
+                    continue
+                await self._run(job, remaining)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job, timeout: float) -> None:
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self.running += 1
+        try:
+            with span("job.run", **{"job.id": job.id, "job.kind": job.kind, **job.metadata}):
+                job.task = asyncio.create_task(job.func())
+                result = await asyncio.wait_for(asyncio.shield(job.task), timeout)
+        except asyncio.TimeoutError:
+            job.task.cancel()
+            self._complete(job, JOB_EXPIRED, error=f"任务执行超过截止时间（{timeout:.1f}秒）")
+        except asyncio.CancelledError:
+            if not job.task.cancelled():
+                # 工作协程本身被取消（应用关闭）
+                job.task.cancel()
+                self._complete(job, JOB_CANCELLED, error="服务关闭，任务已取消")
+                raise
+            self._complete(job, JOB_CANCELLED, error="任务已取消")
+        except Exception as e:
+            logger.error("任务执行失败: %s, 任务id: %s", e, job.id)
+            self._complete(job, JOB_FAILED, error=str(e))
+        else:
+            self._complete(job, JOB_SUCCEEDED, result=result)
+        finally:
+            self.running -= 1
+
+    def _complete(self, job: Job, status: str, result: Any = None, error: Optional[str] = None) -> None:
+        job.finish(status, result, error)
+        self.counts[status] += 1
+        self._finished[job.id] = job.finished_at
+        if job.webhook_url:
+            task = asyncio.create_task(self._send_webhook(job), context=contextvars.Context())
+            self._webhook_tasks.add(task)
+            task.add_done_callback(self._webhook_tasks.discard)
+
+    async def _send_webhook(self, job: Job) -> None:
+        """把任务信息 POST 到 webhook 地址，失败时按 1、2、4... 秒退避重试"""
+        if self._http_client is None:
+            import httpx
+            # 不跟随重定向：重定向目标未经检查，可能指向内网地址
+            self._http_client = httpx.AsyncClient(timeout=JOB_WEBHOOK_TIMEOUT, follow_redirects=False)
+        for attempt in range(JOB_WEBHOOK_RETRIES + 1):
+            try:
+                # 每次发送前重新检查，主机的解析结果可能在提交之后改变；发送时连接检查过的地址，不再重新解析
+                address = await check_webhook_url(job.webhook_url)
+            except WebhookNotAllowed as e:
+                logger.warning("webhook地址不允许访问，不再发送: %s, 任务id: %s", e, job.id)
+                return
+            try:
+                response = await self._http_client.post(json=job.to_dict(), **pinned_request(job.webhook_url, address))
+                if response.status_code < 500:
+                    if response.status_code >= 300:
+                        logger.warning("webhook返回 %s，不再重试, 任务id: %s", response.status_code, job.id)
+                    return
+                error = f"HTTP {response.status_code}"
+            except Exception as e:
+                error = str(e) or type(e).__name__
+            if attempt < JOB_WEBHOOK_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+        logger.error("webhook发送失败: %s, 任务id: %s", error, job.id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "retained": len(self._jobs),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            **self.counts,
+        }
+
+    async def close(self) -> None:
+        """停止工作协程（执行中的任务被取消），等待 webhook 发送完成"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._webhook_tasks:
+            await asyncio.gather(*self._webhook_tasks, return_exceptions=True)
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
+
+# 全局任务队列
+job_queue = JobQueue()
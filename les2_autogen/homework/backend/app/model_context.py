@@ -0,0 +1,81 @@
+"""
+有界模型上下文模块
+
+- SlidingWindowChatCompletionContext: 按消息条数和token预算滑动窗口保留最近的对话，
+  超出部分直接从存储中丢弃，保证提示词大小和内存占用不随对话增长
+- estimate_tokens: 不依赖网络的本地token估算
+"""
+from typing import Any, List, Mapping, Optional
+
+from autogen_core.model_context import ChatCompletionContext
+from autogen_core.models import FunctionExecutionResultMessage, LLMMessage
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    本地估算文本的token数
+
+    中日韩字符大约每个字符1个token，其余字符大约每4个字符1个token。
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_message_tokens(message: Any) -> int:
+    """估算单条消息的token数（含每条消息的固定开销）"""
+    content = getattr(message, "content", "")
+    if not isinstance(content, str):
+        content = str(content)
+    return estimate_tokens(content) + 4
+
+
+class SlidingWindowChatCompletionContext(ChatCompletionContext):
+    """按消息条数和token预算截断的滑动窗口上下文"""
+
+    def __init__(
+            self,
+            max_messages: int = 40,
+            token_budget: int = 4000,
+            initial_messages: Optional[List[LLMMessage]] = None
+    ) -> None:
+        """
+
+        :param max_messages:        最多保留的消息条数，<=0 表示不限制
+        :param token_budget:        最多保留的token估算值，<=0 表示不限制
+        :param initial_messages:    初始消息（例如从数据库恢复的历史）
+        """
+        super().__init__(initial_messages)
+        self._max_messages = max_messages
+        self._token_budget = token_budget
+        self._trim()
+
+    async def add_message(self, message: LLMMessage) -> None:
+        """添加消息并截断到窗口大小"""
+        await super().add_message(message)
+        self._trim()
+
+    async def get_messages(self) -> List[LLMMessage]:
+        return list(self._messages)
+
+    async def load_state(self, state: Mapping[str, Any]) -> None:
+        await super().load_state(state)
+        self._trim()
+
+    def _trim(self) -> None:
+        """从最旧的消息开始丢弃，至少保留最新的一条"""
+        total = sum(estimate_message_tokens(m) for m in self._messages)
+        drop = 0
+        while len(self._messages) - drop > 1:
+            over_count = 0 < self._max_messages < len(self._messages) - drop
+            over_budget = 0 < self._token_budget < total
+            if not over_count and not over_budget:
+                break
+            total -= estimate_message_tokens(self._messages[drop])
+            drop += 1
+        # 窗口不能以工具调用结果开头
+        while drop < len(self._messages) - 1 and isinstance(self._messages[drop], FunctionExecutionResultMessage):
+            drop += 1
+        if drop:
+            del self._messages[:drop]
@@ -2,7 +2,7 @@
 数据库模型定义
 """
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, JSON, Index, Float, LargeBinary
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -11,6 +11,10 @@ from app.database import Base
 class ChatSession(Base):
     """聊天会话模型"""
     __tablename__ = "chat_sessions"
+    __table_args__ = (
+        # 会话列表按 (is_active, updated_at) 过滤排序
+        Index("ix_chat_sessions_active_updated", "is_active", "updated_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), nullable=False, default="新对话")
@@ -24,17 +28,42 @@ class ChatSession(Base):
     temperature = Column(String(10), default="0.7")
     max_tokens = Column(Integer, default=2000)
     
+    # 冗余统计字段（写入消息时维护，列表查询无需加载消息）
+    user_message_count = Column(Integer, default=0, server_default="0", nullable=False)
+    first_question_time = Column(DateTime, nullable=True)
+    prompt_tokens = Column(Integer, default=0, server_default="0", nullable=False)
+    completion_tokens = Column(Integer, default=0, server_default="0", nullable=False)
+
+    # 归档时间：不为空表示消息已移入 chat_archives（见 app/archive.py），打开时自动恢复
+    archived_at = Column(DateTime, nullable=True)
+    
     # 关联消息
     messages = relationship("ChatMessage", back_populates="session", cascade="all, delete-orphan")
     
+    def record_user_message(self, message: "ChatMessage") -> bool:
+        """
+        记录一条新的用户消息，维护冗余统计字段
+
+        :return: 是否为会话的第一条用户消息
+
+        user_message_count 被赋值为SQL表达式，flush 后过期，调用方需要在同一数据库会话中 refresh
+        """
+        is_first = not self.user_message_count
+        # 使用SQL表达式原子自增，避免并发请求互相覆盖
+        self.user_message_count = ChatSession.user_message_count + 1
+        if self.first_question_time is None:
+            self.first_question_time = message.created_at
+        return is_first
+
+    def reset_message_stats(self):
+        """清空消息后重置冗余统计字段"""
+        self.user_message_count = 0
+        self.first_question_time = None
+
     def to_dict(self):
         """转换为字典"""
-        # 只统计用户消息的数量
-        user_message_count = len([msg for msg in self.messages if msg.role == 'user']) if self.messages else 0
-
-        # 获取第一条用户消息的时间作为问问题开始时间
-        first_user_message = next((msg for msg in self.messages if msg.role == 'user'), None) if self.messages else None
-        first_question_time = first_user_message.created_at if first_user_message else self.created_at
+        # 第一条用户消息的时间作为问问题开始时间
+        first_question_time = self.first_question_time or self.created_at
 
         return {
             "id": self.id,
@@ -47,12 +76,19 @@ class ChatSession(Base):
             "system_message": self.system_message,
             "temperature": self.temperature,
             "max_tokens": self.max_tokens,
-            "message_count": user_message_count
+            "message_count": self.user_message_count or 0,
+            "prompt_tokens": self.prompt_tokens or 0,
+            "completion_tokens": self.completion_tokens or 0,
+            "archived": self.archived_at is not None
         }
 
 class ChatMessage(Base):
     """聊天消息模型"""
     __tablename__ = "chat_messages"
+    __table_args__ = (
+        # 会话消息按 (session_id, created_at) 过滤排序
+        Index("ix_chat_messages_session_created", "session_id", "created_at"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     session_id = Column(Integer, ForeignKey("chat_sessions.id"), nullable=False)
@@ -78,3 +114,74 @@ class ChatMessage(Base):
             "metadata": self.message_metadata,
             "token_count": self.token_count
         }
+
+
+class ProviderUsage(Base):
+    """模型提供商的累计用量（每轮对话结束时增量更新）"""
+    __tablename__ = "provider_usage"
+
+    provider = Column(String(100), primary_key=True)
+    requests = Column(Integer, default=0, nullable=False)
+    # 提供商未返回用量、使用本地估算的请求数
+    estimated_requests = Column(Integer, default=0, nullable=False)
+    prompt_tokens = Column(Integer, default=0, nullable=False)
+    completion_tokens = Column(Integer, default=0, nullable=False)
+    # 生成耗时合计（秒），用于计算吞吐量
+    generation_seconds = Column(Float, default=0.0, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+    def to_dict(self):
+        """转换为字典"""
+        return {
+            "provider": self.provider,
+            "requests": self.requests,
+            "estimated_requests": self.estimated_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+            "generation_seconds": round(self.generation_seconds, 3),
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None
+        }
+
+
+class AgentState(Base):
+    """智能体状态快照（多个工作进程共享，见 app/agent_state.py）"""
+    __tablename__ = "agent_states"
+
+    session_id = Column(Integer, ForeignKey("chat_sessions.id"), primary_key=True)
+    # 每次写入加1，工作进程据此判断本地缓存的智能体是否过期
+    version = Column(Integer, default=0, nullable=False)
+    # AssistantAgent.save_state() 的结果，为空表示从消息表恢复历史（例如清空会话后）
+    state = Column(JSON, nullable=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), nullable=False)
+
+
+class SessionArchive(Base):
+    """归档会话的消息（整个会话的消息压缩为一个数据块，见 app/archive.py）"""
+    __tablename__ = "chat_archives"
+
+    session_id = Column(Integer, ForeignKey("chat_sessions.id"), primary_key=True)
+    # 压缩算法：zlib / zstd
+    codec = Column(String(10), nullable=False)
+    # 消息行（JSON数组）压缩后的数据
+    data = Column(LargeBinary, nullable=False)
+    message_count = Column(Integer, default=0, nullable=False)
+    raw_bytes = Column(Integer, default=0, nullable=False)
+    compressed_bytes = Column(Integer, default=0, nullable=False)
+    # 消息内容是否已写入全文检索索引 chat_archives_fts（移除索引时需要原文，见 app/search.py）
+    indexed = Column(Boolean, default=False, server_default="0", nullable=False)
+    archived_at = Column(DateTime, default=func.now(), nullable=False)
+
+
+# 为已有数据库回填会话冗余统计字段
+SESSION_STATS_BACKFILL_SQL = """
+UPDATE chat_sessions SET
+    user_message_count = (
+        SELECT COUNT(*) FROM chat_messages
+        WHERE chat_messages.session_id = chat_sessions.id AND chat_messages.role = 'user'
+    ),
+    first_question_time = (
+        SELECT MIN(created_at) FROM chat_messages
+        WHERE chat_messages.session_id = chat_sessions.id AND chat_messages.role = 'user'
+    )
+"""
@@ -0,0 +1,93 @@
+"""
+分页工具模块
+
+- 游标（keyset）分页的游标编解码
+- 带过期时间的总数缓存，避免每次翻页都执行一次 COUNT
+"""
+import base64
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from sqlalchemy import String, cast, literal
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql.elements import ColumnElement
+
+# 总数缓存的有效期（秒）
+PAGINATION_TOTAL_TTL: float = float(os.getenv("PAGINATION_TOTAL_TTL", "10"))
+
+
+def encode_cursor(*values: Any) -> str:
+    """把排序键编码为不透明的游标字符串（datetime 按 ISO 格式保存）"""
+    raw = [{"dt": value.isoformat()} if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(raw).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: Optional[str], size: int) -> Optional[List[Any]]:
+    """
+    解码游标
+
+    :param cursor:  游标字符串，为空表示第一页
+    :param size:    排序键的个数
+    :raises ValueError: 游标格式无效
+    """
+    if not cursor:
+        return None
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        if not isinstance(raw, list) or len(raw) != size:
+            raise ValueError
+        return [datetime.fromisoformat(value["dt"]) if isinstance(value, dict) else value for value in raw]
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+def sort_key(column: ColumnElement, db: AsyncSession) -> ColumnElement:
+    """
+    游标使用的排序键表达式
+
+    SQLite 中日期按文本存储，CURRENT_TIMESTAMP 和 Python datetime 写入的格式不同
+    （是否带微秒），排序按文本进行；因此游标也保存原始文本，保证比较结果与排序一致。
+    """
+    if db.bind.dialect.name == "sqlite":
+        return cast(column, String).label("cursor_key")
+    return column.label("cursor_key")
+
+
+def sort_value(value: Any, key: ColumnElement) -> ColumnElement:
+    """把游标中的值按排序键的类型绑定为参数"""
+    return literal(value, key.type)
+
+
+class TotalCountCache:
+    """带TTL的总数缓存"""
+
+    def __init__(self, ttl: float = PAGINATION_TOTAL_TTL, max_entries: int = 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._values: Dict[Hashable, Tuple[float, int]] = {}
+
+    async def get(self, key: Hashable, count: Callable[[], Awaitable[int]]) -> int:
+        """读取缓存的总数，过期或不存在时调用 count 重新统计"""
+        now = time.monotonic()
+        cached = self._values.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        total = await count()
+        if len(self._values) >= self.max_entries:
+            self._values = {k: v for k, v in self._values.items() if v[0] > now}
+            if len(self._values) >= self.max_entries:
+                self._values.clear()
+        self._values[key] = (now + self.ttl, total)
+        return total
+
+    def invalidate(self, key: Hashable) -> None:
+        """使某个总数缓存失效"""
+        self._values.pop(key, None)
+
+
+# 全局总数缓存
+total_cache = TotalCountCache()
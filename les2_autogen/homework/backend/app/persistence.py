@@ -0,0 +1,158 @@
+"""
+批量写入（group commit / write-behind）
+
+聊天每轮都要写入用户消息、会话统计和助手消息，在SQLite上每次提交都是一次fsync。
+写操作提交到单个写入任务，每隔 PERSIST_BATCH_MS 毫秒把积累的操作合并到一个事务中提交：
+- run(op)：等待所在批次提交后返回 op 的结果（需要数据库生成的id时使用）
+- enqueue(op)：不等待提交（write-behind），失败只记录日志
+批次提交失败时逐个重试，单个操作的错误（例如会话不存在）不影响同批的其他操作。
+应用关闭时 close() 会写完队列中剩余的操作。
+"""
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import AsyncSessionLocal
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 批次收集时间（毫秒），0 表示有操作就立即提交
+PERSIST_BATCH_MS: float = float(os.getenv("PERSIST_BATCH_MS", "5"))
+# 单个事务最多包含的操作数
+PERSIST_BATCH_MAX: int = int(os.getenv("PERSIST_BATCH_MAX", "256"))
+
+# 写操作：在批次的数据库会话中执行（不要自行提交），返回值通过 run() 交给调用方
+WriteOp = Callable[[AsyncSession], Awaitable[Any]]
+
+
+class WriteBehindQueue:
+    """把并发的写操作合并到批量事务中的单写入者队列"""
+
+    def __init__(self, session_factory=AsyncSessionLocal, batch_ms: float = PERSIST_BATCH_MS,
+                 batch_max: int = PERSIST_BATCH_MAX):
+        self.session_factory = session_factory
+        self.batch_delay = max(batch_ms, 0) / 1000
+        self.batch_max = max(batch_max, 1)
+        self._pending: List[Tuple[WriteOp, asyncio.Future]] = []
+        self._has_items: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # 统计
+        self.ops = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.failed = 0
+        self.retried_batches = 0
+
+    def _ensure_worker(self) -> None:
+        if self._task is None or self._task.done():
+            self._has_items = asyncio.Event()
+            self._idle = asyncio.Event()
+            self._idle.set()
+            self._task = asyncio.create_task(self._worker())
+
+    def submit(self, op: WriteOp) -> asyncio.Future:
+        """提交写操作，返回在批次提交后完成的 future"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((op, future))
+        self._idle.clear()
+        self._has_items.set()
+        return future
+
+    async def run(self, op: WriteOp) -> Any:
+        """提交写操作并等待提交完成（调用方被取消时操作仍会写入）"""
+        return await asyncio.shield(self.submit(op))
+
+    def enqueue(self, op: WriteOp) -> asyncio.Future:
+        """提交写操作，不等待提交完成（失败时记录日志）"""
+        future = self.submit(op)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("后台写入失败: %s", future.exception())
+
+    async def _worker(self) -> None:
+        while True:
+            await self._has_items.wait()
+            if self.batch_delay and len(self._pending) < self.batch_max:
+                # 等待同一时间窗口内的其他写操作
+                await asyncio.sleep(self.batch_delay)
+            batch, self._pending = self._pending[:self.batch_max], self._pending[self.batch_max:]
+            if not self._pending:
+                self._has_items.clear()
+            try:
+                await self._write(batch)
+            finally:
+                if not self._pending:
+                    self._idle.set()
+
+    async def _write(self, batch: List[Tuple[WriteOp, asyncio.Future]]) -> None:
+        """在一个事务中执行整批操作；失败时回滚并逐个重试"""
+        try:
+            results = []
+            async with self.session_factory() as db:
+                for op, _ in batch:
+                    results.append(await op(db))
+                await db.commit()
+        except Exception as e:
+            if len(batch) > 1:
+                self.retried_batches += 1
+                for item in batch:
+                    await self._write([item])
+                return
+            self.failed += 1
+            self._settle(batch[0][1], exception=e)
+            return
+
+        self.batches += 1
+        self.ops += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            self._settle(future, result=result)
+
+    @staticmethod
+    def _settle(future: asyncio.Future, result: Any = None, exception: Optional[BaseException] = None) -> None:
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    async def flush(self) -> None:
+        """等待已提交的写操作全部写入"""
+        if self._task is not None and not self._task.done():
+            await self._idle.wait()
+
+    async def close(self) -> None:
+        """写完剩余操作后停止写入任务"""
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._pending),
+            "batches": self.batches,
+            "ops": self.ops,
+            "avg_batch": round(self.ops / self.batches, 2) if self.batches else 0.0,
+            "max_batch": self.max_batch,
+            "retried_batches": self.retried_batches,
+            "failed": self.failed,
+        }
+
+
+# 全局写入队列
+persistence = WriteBehindQueue()
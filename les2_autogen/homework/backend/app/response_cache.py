@@ -0,0 +1,408 @@
+"""
+模型回答缓存模块
+
+在模型调用之前按 (模型提供商, 系统提示词, 历史摘要, 用户消息, 生成参数) 查找已有回答，命中时不再访问网络：
+- 精确匹配：键经过规范化（去除首尾空白、合并连续空白）后取 SHA-256
+- 存储后端：内存 LRU 或 SQLite 文件，均支持 TTL 和按条目数/字节数淘汰
+- 相似匹配（可选）：在上下文相同的前提下，用本地字符 n-gram 向量的余弦相似度匹配近似问题
+命中的回答按小块重放，模拟流式输出。
+"""
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Dict, List, Optional, Sequence, Tuple
+
+import aiosqlite
+
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# 缓存后端：memory / sqlite / none（默认关闭：相同问题在 temperature>0 时本应得到不同回答，需运维显式开启）
+RESPONSE_CACHE_BACKEND: str = os.getenv("RESPONSE_CACHE_BACKEND", "none").lower()
+RESPONSE_CACHE_PATH: str = os.getenv("RESPONSE_CACHE_PATH", "./response_cache.db")
+RESPONSE_CACHE_TTL: float = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES: int = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_MAX_MB: float = float(os.getenv("RESPONSE_CACHE_MAX_MB", "32"))
+# 相似匹配阈值（余弦相似度），<=0 表示关闭相似匹配
+RESPONSE_CACHE_SEMANTIC_THRESHOLD: float = float(os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD", "0"))
+# 重放命中回答时每块的字符数和块间隔（毫秒）
+RESPONSE_CACHE_REPLAY_CHUNK: int = int(os.getenv("RESPONSE_CACHE_REPLAY_CHUNK", "8"))
+RESPONSE_CACHE_REPLAY_DELAY_MS: float = float(os.getenv("RESPONSE_CACHE_REPLAY_DELAY_MS", "0"))
+
+# 本地向量的维度和 n-gram 长度
+EMBEDDING_DIM = 512
+EMBEDDING_NGRAM = 2
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """规范化文本：去除首尾空白并合并连续空白"""
+    return _WHITESPACE.sub(" ", (text or "").strip())
+
+
+def hash_history(messages: Sequence[Any]) -> str:
+    """对发送给模型的历史消息做摘要（只取消息类型和内容，不含会话相关的 source）"""
+    digest = hashlib.sha256()
+    for message in messages:
+        content = getattr(message, "content", "")
+        if not isinstance(content, str):
+            content = str(content)
+        digest.update(type(message).__name__.encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(normalize_text(content).encode("utf-8"))
+        digest.update(b"\x01")
+    return digest.hexdigest()
+
+
+def make_cache_key(
+        provider: str,
+        system_message: str,
+        history_hash: str,
+        message: str,
+        params: Dict[str, Any]
+) -> Tuple[str, str]:
+    """
+    生成缓存键
+
+    :return: (精确键, 上下文键)，上下文键不包含用户消息，用于相似匹配时限定候选范围
+    """
+    context = json.dumps(
+        [provider, normalize_text(system_message), history_hash, params],
+        ensure_ascii=False, sort_keys=True
+    )
+    context_key = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    exact = context_key + "\x00" + normalize_text(message)
+    return hashlib.sha256(exact.encode("utf-8")).hexdigest(), context_key
+
+
+def embed_text(text: str) -> List[float]:
+    """把文本映射为归一化的字符 n-gram 哈希向量（本地计算，不访问网络）"""
+    text = normalize_text(text).lower()
+    vector = [0.0] * EMBEDDING_DIM
+    if len(text) < EMBEDDING_NGRAM:
+        grams = [text] if text else []
+    else:
+        grams = [text[i:i + EMBEDDING_NGRAM] for i in range(len(text) - EMBEDDING_NGRAM + 1)]
+    for gram in grams:
+        index = int.from_bytes(hashlib.md5(gram.encode("utf-8")).digest()[:4], "little") % EMBEDDING_DIM
+        vector[index] += 1.0
+    norm = math.sqrt(sum(v * v for v in vector))
+    return [v / norm for v in vector] if norm else vector
+
+
+def cosine_similarity(a: Sequence[float], b: Sequence[float]) -> float:
+    """两个归一化向量的余弦相似度"""
+    return sum(x * y for x, y in zip(a, b))
+
+
+class ResponseCacheBackend(ABC):
+    """缓存存储后端"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        """读取未过期的回答"""
+
+    @abstractmethod
+    async def set(self, key: str, content: str) -> None:
+        """写入回答，必要时淘汰旧条目"""
+
+    @abstractmethod
+    async def clear(self) -> None:
+        """清空缓存"""
+
+    async def close(self) -> None:
+        """释放资源"""
+
+    @abstractmethod
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+
+
+class MemoryResponseCache(ResponseCacheBackend):
+    """内存 LRU 缓存"""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, Tuple[float, str, int]]" = OrderedDict()
+        self._bytes = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, content, _ = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return content
+
+    async def set(self, key: str, content: str) -> None:
+        size = len(content.encode("utf-8"))
+        if 0 < self.max_bytes < size:
+            return
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, content, size)
+        self._bytes += size
+        while self._entries and (
+                (self.max_entries > 0 and len(self._entries) > self.max_entries)
+                or (self.max_bytes > 0 and self._bytes > self.max_bytes)
+        ):
+            self._remove(next(iter(self._entries)))
+
+    async def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "entries": len(self._entries), "bytes": self._bytes}
+
+
+class SqliteResponseCache(ResponseCacheBackend):
+    """SQLite 文件缓存（跨进程/重启保留），按最近访问时间淘汰"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS response_cache (
+        key TEXT PRIMARY KEY,
+        content TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        expires_at REAL NOT NULL,
+        last_access REAL NOT NULL
+    )
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            conn = await aiosqlite.connect(self.path)
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute(self.SCHEMA)
+            await conn.execute("CREATE INDEX IF NOT EXISTS ix_response_cache_last_access ON response_cache(last_access)")
+            await conn.commit()
+            self._conn = conn
+        return self._conn
+
+    async def get(self, key: str) -> Optional[str]:
+        async with self._lock:
+            conn = await self._connect()
+            now = time.time()
+            async with conn.execute(
+                    "SELECT content FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ) as cursor:
+                row = await cursor.fetchone()
+            if row is None:
+                return None
+            await conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+            await conn.commit()
+            return row[0]
+
+    async def set(self, key: str, content: str) -> None:
+        size = len(content.encode("utf-8"))
+        if 0 < self.max_bytes < size:
+            return
+        async with self._lock:
+            conn = await self._connect()
+            now = time.time()
+            await conn.execute(
+                "INSERT OR REPLACE INTO response_cache(key, content, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, content, size, now + self.ttl, now)
+            )
+            await conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            await self._evict(conn)
+            await conn.commit()
+
+    async def _evict(self, conn: aiosqlite.Connection) -> None:
+        """超出条目数或字节数限制时，按最近访问时间从旧到新删除"""
+        async with conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache") as cursor:
+            count, total = await cursor.fetchone()
+        if (self.max_entries <= 0 or count <= self.max_entries) and (self.max_bytes <= 0 or total <= self.max_bytes):
+            return
+        async with conn.execute("SELECT key, size FROM response_cache ORDER BY last_access") as cursor:
+            victims = []
+            async for key, size in cursor:
+                if (self.max_entries <= 0 or count <= self.max_entries) and (self.max_bytes <= 0 or total <= self.max_bytes):
+                    break
+                victims.append((key,))
+                count -= 1
+                total -= size
+        await conn.executemany("DELETE FROM response_cache WHERE key = ?", victims)
+
+    async def clear(self) -> None:
+        async with self._lock:
+            conn = await self._connect()
+            await conn.execute("DELETE FROM response_cache")
+            await conn.commit()
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "sqlite", "path": self.path}
+
+
+class SemanticIndex:
+    """相似匹配索引：按上下文键分组保存 (向量, 精确键)，只在同一上下文内比较"""
+
+    def __init__(self, threshold: float, max_entries: int):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._groups: "OrderedDict[str, List[Tuple[List[float], str]]]" = OrderedDict()
+        self._size = 0
+
+    def lookup(self, context_key: str, message: str) -> Optional[str]:
+        """返回最相似且超过阈值的精确键"""
+        candidates = self._groups.get(context_key)
+        if not candidates:
+            return None
+        vector = embed_text(message)
+        best_key, best_score = None, self.threshold
+        for candidate, key in candidates:
+            score = cosine_similarity(vector, candidate)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def add(self, context_key: str, message: str, key: str) -> None:
+        group = self._groups.setdefault(context_key, [])
+        self._groups.move_to_end(context_key)
+        group.append((embed_text(message), key))
+        self._size += 1
+        while self.max_entries > 0 and self._size > self.max_entries and self._groups:
+            oldest = next(iter(self._groups))
+            self._size -= len(self._groups.pop(oldest))
+
+    def clear(self) -> None:
+        self._groups.clear()
+        self._size = 0
+
+
+class ResponseCache:
+    """模型回答缓存（精确匹配 + 可选的相似匹配）"""
+
+    def __init__(self, backend: ResponseCacheBackend, semantic: Optional[SemanticIndex] = None):
+        self.backend = backend
+        self.semantic = semantic
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    async def lookup(
+            self,
+            provider: str,
+            system_message: str,
+            history: Sequence[Any],
+            message: str,
+            params: Dict[str, Any]
+    ) -> Optional[str]:
+        """查找缓存的回答，未命中返回 None"""
+        key, context_key = make_cache_key(provider, system_message, hash_history(history), message, params)
+        try:
+            content = await self.backend.get(key)
+            if content is None and self.semantic is not None:
+                similar_key = self.semantic.lookup(context_key, message)
+                if similar_key is not None:
+                    content = await self.backend.get(similar_key)
+                    if content is not None:
+                        self.semantic_hits += 1
+        except Exception as e:
+            logger.warning("读取回答缓存失败: %s", e)
+            content = None
+
+        if content is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return content
+
+    async def store(
+            self,
+            provider: str,
+            system_message: str,
+            history: Sequence[Any],
+            message: str,
+            params: Dict[str, Any],
+            content: str
+    ) -> None:
+        """保存模型回答（空回答不缓存）"""
+        if not content or not content.strip():
+            return
+        key, context_key = make_cache_key(provider, system_message, hash_history(history), message, params)
+        try:
+            await self.backend.set(key, content)
+            if self.semantic is not None:
+                self.semantic.add(context_key, message, key)
+        except Exception as e:
+            logger.warning("写入回答缓存失败: %s", e)
+
+    async def clear(self) -> None:
+        await self.backend.clear()
+        if self.semantic is not None:
+            self.semantic.clear()
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            **self.backend.stats(),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+async def replay_stream(
+        content: str,
+        chunk_size: int = RESPONSE_CACHE_REPLAY_CHUNK,
+        delay_ms: float = RESPONSE_CACHE_REPLAY_DELAY_MS
+) -> AsyncGenerator[str, None]:
+    """把缓存的回答切成小块逐个输出，模拟模型的流式响应"""
+    chunk_size = max(chunk_size, 1)
+    for start in range(0, len(content), chunk_size):
+        yield content[start:start + chunk_size]
+        if delay_ms > 0:
+            await asyncio.sleep(delay_ms / 1000)
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """按环境变量创建回答缓存，RESPONSE_CACHE_BACKEND=none 时返回 None"""
+    max_bytes = int(RESPONSE_CACHE_MAX_MB * 1024 * 1024)
+    if RESPONSE_CACHE_BACKEND == "none":
+        return None
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        backend: ResponseCacheBackend = SqliteResponseCache(
+            RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, max_bytes
+        )
+    else:
+        backend = MemoryResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, max_bytes)
+
+    semantic = None
+    if RESPONSE_CACHE_SEMANTIC_THRESHOLD > 0:
+        semantic = SemanticIndex(RESPONSE_CACHE_SEMANTIC_THRESHOLD, RESPONSE_CACHE_MAX_ENTRIES)
+    return ResponseCache(backend, semantic)
@@ -0,0 +1,80 @@
+"""
+会话归档相关API路由
+
+后台归档任务按 ARCHIVE_INTERVAL 定期执行（见 app/archive.py），以下接口用于手动触发和查看：
+- POST /archive/run 立即执行一轮归档、清除和空间回收
+- GET /archive/stats 本进程的归档统计和归档表的总体情况
+- POST /sessions/{session_id}/archive 立即归档指定会话（不检查空闲时间）
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import func
+
+from app.archive import archiver
+from app.database import get_db
+from app.models import ChatSession, SessionArchive
+from app.schemas import BaseResponse
+
+router = APIRouter()
+
+
+@router.post("/archive/run", response_model=BaseResponse)
+async def run_archiver():
+    """执行一轮归档任务，返回本轮结果"""
+    try:
+        return BaseResponse(message="归档任务完成", data=await archiver.run_once())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"归档任务失败: {str(e)}")
+
+
+@router.get("/archive/stats", response_model=BaseResponse)
+async def get_archive_stats(db: AsyncSession = Depends(get_db)):
+    """归档统计"""
+    try:
+        row = (await db.execute(
+            select(
+                func.count(),
+                func.coalesce(func.sum(SessionArchive.message_count), 0),
+                func.coalesce(func.sum(SessionArchive.raw_bytes), 0),
+                func.coalesce(func.sum(SessionArchive.compressed_bytes), 0)
+            )
+        )).first()
+        sessions, messages, raw_bytes, compressed_bytes = row
+        return BaseResponse(data={
+            "archive": {
+                "sessions": sessions,
+                "messages": messages,
+                "raw_bytes": raw_bytes,
+                "compressed_bytes": compressed_bytes,
+                "ratio": round(raw_bytes / compressed_bytes, 2) if compressed_bytes else None
+            },
+            "archiver": archiver.stats()
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取归档统计失败: {str(e)}")
+
+
+@router.post("/sessions/{session_id}/archive", response_model=BaseResponse)
+async def archive_session(
+    session_id: int,
+    db: AsyncSession = Depends(get_db)
+):
+    """立即归档会话，再次打开时自动恢复"""
+    try:
+        session = await db.scalar(
+            select(ChatSession).where(ChatSession.id == session_id, ChatSession.is_active == True)
+        )
+        if not session:
+            raise HTTPException(status_code=404, detail="会话不存在")
+        if session.archived_at is not None:
+            return BaseResponse(message="会话已归档", data={"archived": True})
+        archived = await archiver.archive_session(session_id)
+        return BaseResponse(
+            message="会话归档成功" if archived else "会话没有消息或正在更新，未归档",
+            data={"archived": archived}
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"归档会话失败: {str(e)}")
@@ -0,0 +1,46 @@
+"""
+批量提示词API路由
+"""
+import uuid
+
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
+
+from app.batch import BATCH_DEFAULT_PARALLELISM, BATCH_MAX_PARALLELISM, run_batch
+from app.framing import encode_frame
+from app.schemas import BatchPromptRequest
+from common.llms import AUTO_LLM_NAME, get_provider_config
+
+router = APIRouter()
+
+
+@router.post("/chat/batch")
+async def chat_batch(request: BatchPromptRequest):
+    """
+    批量提示词接口
+
+    以 NDJSON（每行一个JSON）按完成顺序返回每个提示词的结果，index 为提示词在请求中的序号，
+    最后一行是批次汇总。单个提示词失败不影响其他提示词。
+    """
+    if any(not prompt or len(prompt) > 10000 for prompt in request.prompts):
+        raise HTTPException(status_code=400, detail="提示词不能为空且不能超过10000个字符")
+    model_name = request.model_name or "mota"
+    if model_name != AUTO_LLM_NAME and not get_provider_config(model_name)["model"]:
+        raise HTTPException(status_code=400, detail=f"模型提供商未配置: {model_name}")
+
+    batch_id = uuid.uuid4().hex
+    parallelism = min(request.parallelism or BATCH_DEFAULT_PARALLELISM, BATCH_MAX_PARALLELISM)
+
+    async def lines():
+        async for item in run_batch(
+            request.prompts,
+            model_name=model_name,
+            system_message=request.system_message or "",
+            temperature=request.temperature,
+            max_tokens=request.max_tokens,
+            parallelism=parallelism,
+            batch_id=batch_id
+        ):
+            yield encode_frame(item) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Batch-Id": batch_id})
@@ -1,247 +1,525 @@
 """
 聊天相关API路由
 """
+import asyncio
 import json
-from typing import Dict, Any
-from fastapi import APIRouter, Depends, HTTPException, Request
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Request, Query, Header
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
 from sse_starlette.sse import EventSourceResponse
 
-from app.database import get_db
+from app.archive import archiver
+from app.database import AsyncSessionLocal
 from app.models import ChatSession, ChatMessage
 from app.schemas import ChatRequest, BaseResponse
 from app.autogen_service import autogen_service
+from app.coalesce import chat_flights, message_key
+from app.model_context import estimate_tokens
+from app.persistence import WriteOp, persistence
+from app.pagination import total_cache
+from app.usage import record_usage, usage_to_dict
+from common.llms import resolve_llm_name, served_provider
 
 router = APIRouter()
 
-@router.get("/chat/stream")
-async def chat_stream(
+# 流式协议：full 每个chunk携带累积全文（兼容旧客户端），delta 只发送增量和序号
+STREAM_PROTOCOL_FULL = "full"
+STREAM_PROTOCOL_DELTA = "delta"
+
+def add_assistant_message(
+    session_id: int,
+    content: str,
+    metadata: Dict[str, Any],
+    provider: Optional[str] = None,
+    seconds: float = 0.0
+) -> WriteOp:
+    """
+    写入助手消息的批量写操作
+
+    metadata 中带有 usage 时记录回答的token数；同时给出 provider 时累加会话和提供商的用量。
+    """
+    async def write(db: AsyncSession) -> ChatMessage:
+        usage = metadata.get("usage")
+        assistant_message = ChatMessage(
+            session_id=session_id,
+            role="assistant",
+            content=content,
+            message_metadata=metadata,
+            token_count=usage["completion_tokens"] if usage else estimate_tokens(content)
+        )
+        db.add(assistant_message)
+        if usage and provider:
+            await record_usage(db, session_id, provider, usage, seconds)
+        await db.flush()
+        await db.refresh(assistant_message)
+        return assistant_message
+    return write
+
+
+async def save_assistant_message(
+    session_id: int,
+    content: str,
+    metadata: Dict[str, Any],
+    provider: Optional[str] = None,
+    seconds: float = 0.0
+) -> ChatMessage:
+    """保存助手消息（在批量写入队列中与其他请求的写入合并提交，不依赖请求的数据库会话）"""
+    assistant_message = await persistence.run(add_assistant_message(session_id, content, metadata, provider, seconds))
+    total_cache.invalidate(("messages", session_id))
+    return assistant_message
+
+
+def turn_metadata(usage: Any, cached: bool, system_message: str, message: str, content: str) -> Dict[str, Any]:
+    """助手消息的元数据：命中缓存时不消耗token，否则记录用量（提供商未返回时本地估算）"""
+    if cached:
+        return {"cached": True}
+    return {"usage": usage_to_dict(usage, (system_message or "") + message, content)}
+
+
+async def generate_turn(
+    session_id: int,
+    user_message_id: int,
     message: str,
-    session_id: int = None,
-    stream: bool = True,
-    db: Session = Depends(get_db)
+    model_name: str,
+    system_message: str,
+    temperature: float,
+    max_tokens: int
 ):
-    """流式聊天接口"""
+    """
+    运行一轮流式对话并保存助手消息
+
+    产生与协议无关的事件（session/chunk/complete/error），由 format_stream_events 按订阅者的协议格式化。
+    在后台任务中运行，所有订阅同一生成的请求共享这些事件。
+    生成被取消时（客户端断开超过宽限期）保存已生成的部分内容，标记为 partial。
+    """
+    # 发送会话信息
+    yield {"type": "session", "session_id": session_id, "user_message_id": user_message_id}
+
+    provider = resolve_llm_name(model_name)
+    started = time.monotonic()
+    response_parts: List[str] = []
+    try:
+        # 获取流式响应
+        async for chunk in autogen_service.chat_stream(
+            session_id=session_id,
+            message=message,
+            model_name=model_name,
+            system_message=system_message,
+            temperature=temperature,
+            max_tokens=max_tokens
+        ):
+            if chunk["type"] == "chunk":
+                response_parts.append(chunk["content"])
+                yield chunk
+
+            elif chunk["type"] == "complete":
+                # 完成响应
+                assistant_content = chunk["content"]
+
+                # 保存助手消息及token用量（自动路由时按实际提供服务的提供商记录）
+                provider = chunk.get("provider") or provider
+                metadata = turn_metadata(chunk.get("usage"), chunk.get("cached", False), system_message, message, assistant_content)
+                assistant_message = await save_assistant_message(
+                    session_id,
+                    assistant_content,
+                    metadata,
+                    provider,
+                    time.monotonic() - started
+                )
+
+                yield {
+                    "type": "complete",
+                    "assistant_message_id": assistant_message.id,
+                    "content": assistant_content,
+                    "usage": metadata.get("usage"),
+                    "cached": chunk.get("cached", False)
+                }
+                break
+
+            elif chunk["type"] == "error":
+                yield chunk
+                break
+
+    except asyncio.CancelledError:
+        if response_parts:
+            # 已被取消，不再等待写入完成；已生成的部分同样消耗了token
+            # chat_stream 在同一任务上下文中开始记录实际提供服务的提供商
+            served = served_provider.get()
+            if served is not None:
+                provider = served.name
+            partial_content = "".join(response_parts)
+            metadata = turn_metadata(None, False, system_message, message, partial_content)
+            metadata["partial"] = True
+            persistence.enqueue(
+                add_assistant_message(session_id, partial_content, metadata, provider, time.monotonic() - started)
+            ).add_done_callback(lambda _: total_cache.invalidate(("messages", session_id)))
+        raise
+
+
+def event_id(flight, event_id: int) -> Optional[str]:
+    """SSE事件id：{user_message_id}:{序号}，断线重连时通过 Last-Event-ID 带回"""
+    return f"{flight.resume_key}:{event_id}" if flight.resume_key is not None else None
+
+
+def parse_event_id(value: Optional[str]) -> Optional[Tuple[int, int]]:
+    """解析 Last-Event-ID，返回 (user_message_id, 序号)"""
+    try:
+        user_message_id, seq = value.split(":")
+        return int(user_message_id), int(seq)
+    except (AttributeError, ValueError):
+        return None
+
+
+async def format_stream_events(flight, delta_mode: bool, after_id: int = 0):
+    """订阅生成并把事件格式化为带id的SSE事件"""
+    # full 协议下用于拼接累积全文的缓冲
+    content_parts: List[str] = []
     try:
+        async for seq, event in flight.subscribe(after_id):
+            sse_id = event_id(flight, seq)
+            if event["type"] == "session":
+                yield {
+                    "event": "session",
+                    "id": sse_id,
+                    "data": json.dumps({'session_id': event['session_id'], 'user_message_id': event['user_message_id']})
+                }
+
+            elif event["type"] == "chunk":
+                # 发送内容块
+                if delta_mode:
+                    data = {'seq': event['seq'], 'delta': event['content']}
+                else:
+                    content_parts.append(event['content'])
+                    data = {'content': event['content'], 'full_content': "".join(content_parts)}
+                yield {
+                    "event": "chunk",
+                    "id": sse_id,
+                    "data": json.dumps(data)
+                }
+
+            elif event["type"] == "snapshot":
+                # 断点之后的内容块已不在缓冲区，发送截至当前的完整内容
+                content_parts = [event['content']]
+                yield {
+                    "event": "snapshot",
+                    "id": sse_id,
+                    "data": json.dumps({'content': event['content']})
+                }
+
+            elif event["type"] == "complete":
+                # 发送完成事件
+                yield {
+                    "event": "complete",
+                    "id": sse_id,
+                    "data": json.dumps({'assistant_message_id': event['assistant_message_id'], 'content': event['content'], 'usage': event['usage'], 'cached': event['cached']})
+                }
+
+            elif event["type"] == "error":
+                # 发送错误事件
+                yield {
+                    "event": "error",
+                    "id": sse_id,
+                    "data": json.dumps({'error': event['error'], 'content': event['content']})
+                }
+
+    except Exception as e:
+        yield {
+            "event": "error",
+            "data": json.dumps({'error': str(e), 'content': f'处理请求时发生错误: {str(e)}'})
+        }
+
+
+async def load_saved_answer(user_message_id: int) -> Optional[ChatMessage]:
+    """取回数据库中该问题之后的助手回答"""
+    async with AsyncSessionLocal() as db:
+        question = await db.get(ChatMessage, user_message_id)
+        if question is None:
+            return None
+        result = await db.execute(
+            select(ChatMessage)
+            .where(
+                ChatMessage.session_id == question.session_id,
+                ChatMessage.role == "assistant",
+                ChatMessage.id > user_message_id
+            )
+            .order_by(ChatMessage.id)
+            .limit(1)
+        )
+        return result.scalars().first()
+
+
+async def replay_saved_turn(user_message_id: int):
+    """生成已不在内存中时，从数据库取回该问题之后的助手回答（不会重新调用模型）"""
+    answer = await load_saved_answer(user_message_id)
+    if answer is None:
+        yield {
+            "event": "error",
+            "data": json.dumps({'error': 'not_resumable', 'content': '生成已结束且没有保存回答，请重新发送'})
+        }
+        return
+    yield {
+        "event": "complete",
+        "id": f"{user_message_id}:complete",
+        "data": json.dumps({'assistant_message_id': answer.id, 'content': answer.content, 'usage': (answer.message_metadata or {}).get('usage'), 'cached': False})
+    }
+
+
+def resume_stream(user_message_id: int, after_id: int, delta_mode: bool) -> EventSourceResponse:
+    """从 after_id 之后恢复生成流"""
+    flight = chat_flights.resumable(user_message_id)
+    if flight is None:
+        return EventSourceResponse(replay_saved_turn(user_message_id))
+    return EventSourceResponse(format_stream_events(flight, delta_mode, after_id))
+
+
+async def begin_turn(session_id: Optional[int], message: str) -> Tuple[ChatSession, ChatMessage]:
+    """
+    开始一轮对话：获取或创建会话，保存用户消息并更新会话标题和时间
+
+    作为一个写操作提交到批量写入队列，与并发请求的写入合并在同一个事务中。
+    会话不存在时抛出 404 HTTPException。
+    """
+    async def write(db: AsyncSession) -> Tuple[ChatSession, ChatMessage]:
         # 获取或创建会话
         if session_id:
-            session = db.query(ChatSession).filter(
-                ChatSession.id == session_id,
-                ChatSession.is_active == True
-            ).first()
+            # 同一批次可能包含同一会话的多条消息，重新加载已过期的统计字段
+            result = await db.execute(
+                select(ChatSession)
+                .where(
+                    ChatSession.id == session_id,
+                    ChatSession.is_active == True
+                )
+                .execution_options(populate_existing=True)
+            )
+            session = result.scalars().first()
             if not session:
                 raise HTTPException(status_code=404, detail="会话不存在")
+            if session.archived_at is not None:
+                # 继续已归档的对话：先在同一事务中恢复消息，新消息排在历史之后
+                await archiver.restore_session(db, session.id)
+                set_committed_value(session, "archived_at", None)
         else:
             # 创建新会话
             session = ChatSession(title="新对话")
             db.add(session)
-            db.commit()
-            db.refresh(session)
+            await db.flush()
+            await db.refresh(session)
 
-        # 保存用户消息
+        # 保存用户消息（flush 后读取数据库生成的 id 和时间）
         user_message = ChatMessage(
             session_id=session.id,
             role="user",
-            content=message
+            content=message,
+            token_count=estimate_tokens(message)
         )
         db.add(user_message)
-        db.commit()
+        await db.flush()
+        await db.refresh(user_message)
+
+        # 维护会话的用户消息统计
+        is_first_question = session.record_user_message(user_message)
 
         # 如果是第一条用户消息且会话标题是"新对话"，则使用用户消息作为标题
-        if session.title == "新对话":
-            # 检查是否是第一条用户消息
-            user_message_count = db.query(ChatMessage).filter(
-                ChatMessage.session_id == session.id,
-                ChatMessage.role == "user"
-            ).count()
-
-            if user_message_count == 1:
-                # 截取前30个字符作为标题
-                new_title = message[:30] + "..." if len(message) > 30 else message
-                session.title = new_title
+        if session.title == "新对话" and is_first_question:
+            # 截取前30个字符作为标题
+            new_title = message[:30] + "..." if len(message) > 30 else message
+            session.title = new_title
 
         # 更新会话时间
         session.updated_at = user_message.created_at
-        db.commit()
-
-        # 在生成器外部提取会话信息，避免DetachedInstanceError
-        session_id = session.id
-        user_message_id = user_message.id
-        model_name = session.model_name
-        system_message = session.system_message
-        temperature = float(session.temperature)
-        max_tokens = session.max_tokens
-
-        async def generate_response():
-            """生成流式响应"""
-            assistant_content = ""
-
-            # 发送会话信息
-            yield {
-                "event": "session",
-                "data": json.dumps({'session_id': session_id, 'user_message_id': user_message_id})
-            }
+        await db.flush()
+        # 自增表达式（user_message_count）和数据库端的 onupdate（updated_at 值未变化时）在 flush 后使属性过期，
+        # 返回前读回，避免调用方在数据库会话之外访问时触发懒加载
+        await db.refresh(session)
+        return session, user_message
+
+    session, user_message = await persistence.run(write)
+    if not session_id:
+        total_cache.invalidate("sessions")
+    total_cache.invalidate(("messages", session.id))
+    return session, user_message
+
+
+async def start_stream_turn(session_id: Optional[int], message: str):
+    """
+    开始一轮流式生成，返回可订阅的 Flight
+
+    同一会话并发提交相同的消息时返回进行中的生成，不会重复保存消息和调用模型。
+    """
+    # 合并进行中的相同请求（必须在任何 await 之前检查并登记）
+    flight = None
+    if session_id:
+        flight_key = message_key("stream", session_id, message)
+        running = chat_flights.get(flight_key)
+        if running is not None:
+            return running
+        flight = chat_flights.reserve(flight_key)
+
+    try:
+        session, user_message = await begin_turn(session_id, message)
+
+        # 新会话在创建后登记，客户端用返回的 session_id 重试时也能合并
+        if flight is None:
+            flight = chat_flights.reserve(message_key("stream", session.id, message))
+
+        # 在后台任务中生成（订阅者断开不影响生成和保存），调用方作为订阅者接收事件
+        return chat_flights.start(flight, generate_turn(
+            session_id=session.id,
+            user_message_id=user_message.id,
+            message=message,
+            model_name=session.model_name,
+            system_message=session.system_message,
+            temperature=float(session.temperature),
+            max_tokens=session.max_tokens
+        ), resume_key=user_message.id)
 
-            try:
-                # 获取流式响应
-                async for chunk in autogen_service.chat_stream(
-                    session_id=session_id,
-                    message=message,
-                    model_name=model_name,
-                    system_message=system_message,
-                    temperature=temperature,
-                    max_tokens=max_tokens
-                ):
-                    if chunk["type"] == "chunk":
-                        # 发送内容块
-                        yield {
-                            "event": "chunk",
-                            "data": json.dumps({'content': chunk['content'], 'full_content': chunk['full_content']})
-                        }
-                        assistant_content = chunk["full_content"]
-                    
-                    elif chunk["type"] == "complete":
-                        # 完成响应
-                        assistant_content = chunk["content"]
-                        
-                        # 保存助手消息（使用新的数据库会话）
-                        from app.database import SessionLocal
-                        with SessionLocal() as new_db:
-                            # 处理usage对象，转换为可序列化的字典
-                            usage_data = chunk.get("usage")
-                            if usage_data and hasattr(usage_data, '__dict__'):
-                                usage_dict = {
-                                    "prompt_tokens": getattr(usage_data, 'prompt_tokens', 0),
-                                    "completion_tokens": getattr(usage_data, 'completion_tokens', 0),
-                                    "total_tokens": getattr(usage_data, 'total_tokens', 0)
-                                }
-                            else:
-                                usage_dict = usage_data
-
-                            assistant_message = ChatMessage(
-                                session_id=session_id,
-                                role="assistant",
-                                content=assistant_content,
-                                message_metadata={}
-                            )
-                            new_db.add(assistant_message)
-                            new_db.commit()
-                            new_db.refresh(assistant_message)
-                            assistant_message_id = assistant_message.id
-                        
-                        # 发送完成事件
-                        yield {
-                            "event": "complete",
-                            "data": json.dumps({'assistant_message_id': assistant_message_id, 'content': assistant_content, 'usage': chunk.get('usage')})
-                        }
-                        break
-                    
-                    elif chunk["type"] == "error":
-                        # 发送错误事件
-                        yield {
-                            "event": "error",
-                            "data": json.dumps({'error': chunk['error'], 'content': chunk['content']})
-                        }
-                        break
-                        
-            except Exception as e:
-                yield {
-                    "event": "error",
-                    "data": json.dumps({'error': str(e), 'content': f'处理请求时发生错误: {str(e)}'})
-                }
-        
-        return EventSourceResponse(generate_response())
-        
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+        if flight is not None and flight.task is None:
+            chat_flights.fail(flight, {"type": "error", "error": str(e), "content": f"处理请求时发生错误: {str(e)}"})
+        raise
 
-@router.post("/chat")
-async def chat_simple(
-    request: ChatRequest,
-    db: Session = Depends(get_db)
+
+@router.get("/chat/stream")
+async def chat_stream(
+    message: str,
+    session_id: int = None,
+    stream: bool = True,
+    protocol: Optional[str] = Query(None, pattern="^(full|delta)$"),
+    x_stream_protocol: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None)
 ):
-    """简单聊天接口（非流式）"""
+    """
+    流式聊天接口
+
+    协议协商：查询参数 protocol 优先，其次请求头 X-Stream-Protocol，默认 full。
+    delta 模式下 chunk 事件只包含 {seq, delta}，完整内容只在 complete 事件中发送。
+    同一会话并发提交相同的消息时，后到的请求订阅进行中的生成，不会重复保存消息和调用模型。
+    浏览器断线自动重连时会带上 Last-Event-ID，此时从断点继续输出，不会重新发送消息。
+    """
+    delta_mode = (protocol or x_stream_protocol or STREAM_PROTOCOL_FULL).lower() == STREAM_PROTOCOL_DELTA
+    if last_event_id:
+        resume_from = parse_event_id(last_event_id)
+        if resume_from is None:
+            raise HTTPException(status_code=400, detail="无效的Last-Event-ID")
+        return resume_stream(*resume_from, delta_mode)
+
     try:
-        # 获取或创建会话
-        if request.session_id:
-            session = db.query(ChatSession).filter(
-                ChatSession.id == request.session_id,
-                ChatSession.is_active == True
-            ).first()
-            if not session:
-                raise HTTPException(status_code=404, detail="会话不存在")
-        else:
-            # 创建新会话
-            session = ChatSession(title="新对话")
-            db.add(session)
-            db.commit()
-            db.refresh(session)
-        
-        # 保存用户消息
-        user_message = ChatMessage(
-            session_id=session.id,
-            role="user",
-            content=request.message
+        flight = await start_stream_turn(session_id, message)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+    return EventSourceResponse(format_stream_events(flight, delta_mode))
+
+
+@router.get("/chat/stream/{user_message_id}")
+async def resume_chat_stream(
+    user_message_id: int,
+    after: int = Query(0, ge=0),
+    protocol: Optional[str] = Query(None, pattern="^(full|delta)$"),
+    x_stream_protocol: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    恢复生成流
+
+    从 Last-Event-ID 请求头（或 after 参数）指定的事件之后继续输出，默认从头回放。
+    生成已不在内存中时返回数据库中保存的回答，不会重新调用模型。
+    """
+    delta_mode = (protocol or x_stream_protocol or STREAM_PROTOCOL_FULL).lower() == STREAM_PROTOCOL_DELTA
+    resume_from = parse_event_id(last_event_id)
+    if resume_from is not None and resume_from[0] == user_message_id:
+        after = resume_from[1]
+    return resume_stream(user_message_id, after, delta_mode)
+
+
+async def generate_simple_turn(
+    session_id: int,
+    user_message: Dict[str, Any],
+    message: str,
+    model_name: str,
+    system_message: str,
+    temperature: float,
+    max_tokens: int
+):
+    """运行一轮非流式对话并保存助手消息，产生一个 complete 或 error 事件"""
+    started = time.monotonic()
+    # 获取AI响应
+    response = await autogen_service.chat_simple(
+        session_id=session_id,
+        message=message,
+        model_name=model_name,
+        system_message=system_message,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+
+    if response["success"]:
+        # 保存助手消息及token用量
+        metadata = turn_metadata(response.get("usage"), response.get("cached", False), system_message, message, response["content"])
+        assistant_message = await save_assistant_message(
+            session_id,
+            response["content"],
+            metadata,
+            response.get("provider") or resolve_llm_name(model_name),
+            time.monotonic() - started
         )
-        db.add(user_message)
-        db.commit()
 
-        # 如果是第一条用户消息且会话标题是"新对话"，则使用用户消息作为标题
-        if session.title == "新对话":
-            # 检查是否是第一条用户消息
-            user_message_count = db.query(ChatMessage).filter(
-                ChatMessage.session_id == session.id,
-                ChatMessage.role == "user"
-            ).count()
-
-            if user_message_count == 1:
-                # 截取前30个字符作为标题
-                new_title = request.message[:30] + "..." if len(request.message) > 30 else request.message
-                session.title = new_title
-                db.commit()
-        
-        # 获取AI响应
-        response = await autogen_service.chat_simple(
+        yield {
+            "type": "complete",
+            "data": {
+                "session_id": session_id,
+                "user_message": user_message,
+                "assistant_message": assistant_message.to_dict()
+            }
+        }
+    else:
+        yield {"type": "error", "error": response.get("error"), "content": response["content"]}
+
+
+@router.post("/chat")
+async def chat_simple(request: ChatRequest):
+    """简单聊天接口（非流式），同一会话并发提交相同的消息时共享同一次生成"""
+    flight = None
+    if request.session_id:
+        flight_key = message_key("chat", request.session_id, request.message)
+        running = chat_flights.get(flight_key)
+        if running is not None:
+            # 进行中的相同请求，等待其结果
+            return await wait_simple_turn(running)
+        flight = chat_flights.reserve(flight_key)
+
+    try:
+        session, user_message = await begin_turn(request.session_id, request.message)
+
+        if flight is None:
+            flight = chat_flights.reserve(message_key("chat", session.id, request.message))
+        chat_flights.start(flight, generate_simple_turn(
             session_id=session.id,
+            user_message=user_message.to_dict(),
             message=request.message,
             model_name=session.model_name,
             system_message=session.system_message,
             temperature=float(session.temperature),
             max_tokens=session.max_tokens
-        )
-        
-        if response["success"]:
-            # 处理usage对象，转换为可序列化的字典
-            usage_data = response.get("usage")
-            if usage_data and hasattr(usage_data, '__dict__'):
-                usage_dict = {
-                    "prompt_tokens": getattr(usage_data, 'prompt_tokens', 0),
-                    "completion_tokens": getattr(usage_data, 'completion_tokens', 0),
-                    "total_tokens": getattr(usage_data, 'total_tokens', 0)
-                }
-            else:
-                usage_dict = usage_data
-
-            # 保存助手消息（暂时不保存usage信息以避免序列化问题）
-            assistant_message = ChatMessage(
-                session_id=session.id,
-                role="assistant",
-                content=response["content"],
-                message_metadata={}
-            )
-            db.add(assistant_message)
-            db.commit()
-            
-            return BaseResponse(
-                data={
-                    "session_id": session.id,
-                    "user_message": user_message.to_dict(),
-                    "assistant_message": assistant_message.to_dict()
-                }
-            )
-        else:
-            raise HTTPException(status_code=500, detail=response["content"])
-            
+        ))
+
     except Exception as e:
+        if flight is not None and flight.task is None:
+            chat_flights.fail(flight, {"type": "error", "error": str(e), "content": f"服务器错误: {str(e)}"})
         raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
+    return await wait_simple_turn(flight)
+
+
+async def wait_simple_turn(flight) -> BaseResponse:
+    """等待非流式生成的结果"""
+    event = await flight.result()
+    if event is None or event["type"] != "complete":
+        detail = event["content"] if event else "未收到有效响应"
+        raise HTTPException(status_code=500, detail=f"服务器错误: {detail}")
+    return BaseResponse(data=event["data"])
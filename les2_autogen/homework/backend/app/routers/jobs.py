@@ -0,0 +1,104 @@
+"""
+异步聊天任务API路由
+
+POST /chat/jobs 保存用户消息后立即返回任务id（202），模型调用在任务队列中完成：
+- GET /chat/jobs/{job_id}?wait=10 轮询结果，wait 大于0时最多等待该秒数再返回（长轮询）
+- DELETE /chat/jobs/{job_id} 取消排队中或执行中的任务
+- 提交时指定 webhook_url 的任务结束后会把任务信息 POST 到该地址（只允许公网地址或 JOB_WEBHOOK_ALLOWED_HOSTS 中的主机）
+任务结果（与 POST /chat 的 data 相同）在结束后保留 JOB_RESULT_TTL 秒。
+"""
+from typing import Any, Dict
+
+from fastapi import APIRouter, HTTPException, Query
+
+from app.jobs import JOB_DEFAULT_DEADLINE, JobQueueFull, WebhookNotAllowed, check_webhook_url, job_queue
+from app.routers.chat import begin_turn, generate_simple_turn
+from app.schemas import BaseResponse, ChatJobRequest
+
+router = APIRouter()
+
+
+async def run_chat_job(session_id: int, user_message: Dict[str, Any], message: str, model_name: str,
+                       system_message: str, temperature: float, max_tokens: int) -> Dict[str, Any]:
+    """运行一轮非流式对话，返回 session_id/user_message/assistant_message"""
+    async for event in generate_simple_turn(
+        session_id=session_id,
+        user_message=user_message,
+        message=message,
+        model_name=model_name,
+        system_message=system_message,
+        temperature=temperature,
+        max_tokens=max_tokens
+    ):
+        if event["type"] == "complete":
+            return event["data"]
+        raise RuntimeError(event["content"])
+    raise RuntimeError("未收到有效响应")
+
+
+def queue_full_error(e: Exception) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+@router.post("/chat/jobs", response_model=BaseResponse, status_code=202)
+async def submit_chat_job(request: ChatJobRequest):
+    """提交异步聊天任务，立即返回任务id"""
+    if request.webhook_url:
+        try:
+            await check_webhook_url(request.webhook_url)
+        except WebhookNotAllowed as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    # 队列已满时在保存消息之前拒绝
+    try:
+        job_queue.check_capacity()
+    except JobQueueFull as e:
+        raise queue_full_error(e)
+    try:
+        session, user_message = await begin_turn(request.session_id, request.message)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"服务器错误: {str(e)}")
+
+    turn = {
+        "session_id": session.id,
+        "user_message": user_message.to_dict(),
+        "message": request.message,
+        "model_name": session.model_name,
+        "system_message": session.system_message,
+        "temperature": float(session.temperature),
+        "max_tokens": session.max_tokens,
+    }
+    try:
+        job = job_queue.submit(
+            lambda: run_chat_job(**turn),
+            kind="chat",
+            priority=request.priority,
+            deadline=request.deadline_seconds or JOB_DEFAULT_DEADLINE,
+            webhook_url=request.webhook_url,
+            metadata={"session_id": session.id, "user_message_id": user_message.id}
+        )
+    except JobQueueFull as e:
+        raise queue_full_error(e)
+    return BaseResponse(message="任务已提交", data=job.to_dict())
+
+
+@router.get("/chat/jobs/{job_id}", response_model=BaseResponse)
+async def get_chat_job(job_id: str, wait: float = Query(0, ge=0, le=60)):
+    """查询任务状态和结果，wait 秒内任务结束时立即返回"""
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    await job.wait(wait)
+    return BaseResponse(data=job.to_dict())
+
+
+@router.delete("/chat/jobs/{job_id}", response_model=BaseResponse)
+async def cancel_chat_job(job_id: str):
+    """取消任务（已结束的任务不受影响）"""
+    job = job_queue.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在或已过期")
+    # 执行中的任务在取消生效后才更新状态
+    await job.wait(5)
+    return BaseResponse(data=job.to_dict())
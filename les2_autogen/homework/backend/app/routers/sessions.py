@@ -3,10 +3,11 @@
 """
 from typing import List, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import select, delete, desc, tuple_
 from sqlalchemy.sql import func
 
+from app.archive import archiver
 from app.database import get_db
 from app.models import ChatSession, ChatMessage
 from app.schemas import (
@@ -19,13 +20,15 @@ from app.schemas import (
     PaginatedResponse
 )
 from app.autogen_service import autogen_service
+from app import search
+from app.pagination import decode_cursor, encode_cursor, sort_key, sort_value, total_cache
 
 router = APIRouter()
 
 @router.post("/sessions", response_model=BaseResponse)
 async def create_session(
     session_data: ChatSessionCreate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """创建新会话"""
     try:
@@ -37,8 +40,9 @@ async def create_session(
             max_tokens=session_data.max_tokens
         )
         db.add(session)
-        db.commit()
-        db.refresh(session)
+        await db.commit()
+        await db.refresh(session)
+        total_cache.invalidate("sessions")
         
         return BaseResponse(
             message="会话创建成功",
@@ -51,20 +55,50 @@ async def create_session(
 async def get_sessions(
     page: int = Query(1, ge=1),
     size: int = Query(10, ge=1, le=50),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    db: AsyncSession = Depends(get_db)
 ):
-    """获取会话列表"""
+    """
+    获取会话列表
+
+    按 (updated_at, id) 倒序的游标分页：传入上一页返回的 next_cursor 获取下一页；
+    未传游标时兼容 page 参数。总数可选，并在短时间内缓存。
+    """
     try:
-        # 计算偏移量
-        offset = (page - 1) * size
+        key = sort_key(ChatSession.updated_at, db)
+        query = (
+            select(ChatSession, key)
+            .where(ChatSession.is_active == True)
+            .order_by(desc(ChatSession.updated_at), desc(ChatSession.id))
+        )
+        try:
+            after = decode_cursor(cursor, 2)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if after:
+            query = query.where(
+                tuple_(ChatSession.updated_at, ChatSession.id) < tuple_(sort_value(after[0], key), after[1])
+            )
+        elif page > 1:
+            query = query.offset((page - 1) * size)
         
-        # 查询会话
-        sessions_query = db.query(ChatSession).filter(
-            ChatSession.is_active == True
-        ).order_by(desc(ChatSession.updated_at))
+        # 多取一条用于判断是否还有下一页
+        result = await db.execute(query.limit(size + 1))
+        rows = result.all()
+        has_more = len(rows) > size
+        rows = rows[:size]
+        sessions = [row[0] for row in rows]
+        next_cursor = encode_cursor(rows[-1][1], sessions[-1].id) if has_more else None
         
-        total = sessions_query.count()
-        sessions = sessions_query.offset(offset).limit(size).all()
+        total = None
+        if include_total:
+            total = await total_cache.get(
+                "sessions",
+                lambda: db.scalar(
+                    select(func.count()).select_from(ChatSession).where(ChatSession.is_active == True)
+                )
+            )
         
         # 转换为响应格式
         session_list = [session.to_dict() for session in sessions]
@@ -75,23 +109,30 @@ async def get_sessions(
                 "total": total,
                 "page": page,
                 "size": size,
-                "pages": (total + size - 1) // size
+                "pages": (total + size - 1) // size if total is not None else None,
+                "next_cursor": next_cursor
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取会话列表失败: {str(e)}")
 
 @router.get("/sessions/{session_id}", response_model=BaseResponse)
 async def get_session(
     session_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """获取单个会话详情"""
     try:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == session_id,
-            ChatSession.is_active == True
-        ).first()
+        result = await db.execute(
+            select(ChatSession)
+            .where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
         
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
@@ -106,14 +147,17 @@ async def get_session(
 async def update_session(
     session_id: int,
     session_data: ChatSessionUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """更新会话"""
     try:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == session_id,
-            ChatSession.is_active == True
-        ).first()
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
         
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
@@ -123,8 +167,8 @@ async def update_session(
         for field, value in update_data.items():
             setattr(session, field, value)
         
-        db.commit()
-        db.refresh(session)
+        await db.commit()
+        await db.refresh(session)
         
         return BaseResponse(
             message="会话更新成功",
@@ -138,26 +182,34 @@ async def update_session(
 @router.delete("/sessions/{session_id}", response_model=BaseResponse)
 async def delete_session(
     session_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """删除会话"""
     try:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == session_id,
-            ChatSession.is_active == True
-        ).first()
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
         
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
         
         # 删除相关消息
-        db.query(ChatMessage).filter(
-            ChatMessage.session_id == session_id
-        ).delete()
+        await db.execute(
+            delete(ChatMessage).where(ChatMessage.session_id == session_id)
+        )
+        await archiver.discard_archive(db, session_id)
 
         # 软删除会话
         session.is_active = False
-        db.commit()
+        session.archived_at = None
+        session.reset_message_stats()
+        await db.commit()
+        total_cache.invalidate("sessions")
+        total_cache.invalidate(("messages", session_id))
         
         # 清理AutoGen会话
         await autogen_service.clear_session(session_id)
@@ -173,29 +225,66 @@ async def get_session_messages(
     session_id: int,
     page: int = Query(1, ge=1),
     size: int = Query(20, ge=1, le=100),
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    db: AsyncSession = Depends(get_db)
 ):
-    """获取会话消息"""
+    """
+    获取会话消息
+
+    按 (created_at, id) 正序的游标分页：传入上一页返回的 next_cursor 获取下一页；
+    未传游标时兼容 page 参数。总数可选，并在短时间内缓存。
+    """
     try:
         # 验证会话存在
-        session = db.query(ChatSession).filter(
-            ChatSession.id == session_id,
-            ChatSession.is_active == True
-        ).first()
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
         
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
+        if session.archived_at is not None:
+            await archiver.ensure_restored(session_id)
+            # 结束当前读事务，之后的查询才能看到恢复的消息
+            await db.commit()
         
-        # 计算偏移量
-        offset = (page - 1) * size
+        key = sort_key(ChatMessage.created_at, db)
+        query = (
+            select(ChatMessage, key)
+            .where(ChatMessage.session_id == session_id)
+            .order_by(ChatMessage.created_at, ChatMessage.id)
+        )
+        try:
+            after = decode_cursor(cursor, 2)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if after:
+            query = query.where(
+                tuple_(ChatMessage.created_at, ChatMessage.id) > tuple_(sort_value(after[0], key), after[1])
+            )
+        elif page > 1:
+            query = query.offset((page - 1) * size)
         
-        # 查询消息
-        messages_query = db.query(ChatMessage).filter(
-            ChatMessage.session_id == session_id
-        ).order_by(ChatMessage.created_at)
+        # 多取一条用于判断是否还有下一页
+        result = await db.execute(query.limit(size + 1))
+        rows = result.all()
+        has_more = len(rows) > size
+        rows = rows[:size]
+        messages = [row[0] for row in rows]
+        next_cursor = encode_cursor(rows[-1][1], messages[-1].id) if has_more else None
         
-        total = messages_query.count()
-        messages = messages_query.offset(offset).limit(size).all()
+        total = None
+        if include_total:
+            total = await total_cache.get(
+                ("messages", session_id),
+                lambda: db.scalar(
+                    select(func.count()).select_from(ChatMessage).where(ChatMessage.session_id == session_id)
+                )
+            )
         
         # 转换为响应格式
         message_list = [message.to_dict() for message in messages]
@@ -206,7 +295,8 @@ async def get_session_messages(
                 "total": total,
                 "page": page,
                 "size": size,
-                "pages": (total + size - 1) // size
+                "pages": (total + size - 1) // size if total is not None else None,
+                "next_cursor": next_cursor
             }
         )
     except HTTPException:
@@ -217,58 +307,79 @@ async def get_session_messages(
 @router.post("/sessions/search", response_model=BaseResponse)
 async def search_sessions(
     search_request: SearchRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """搜索会话"""
     try:
         query = search_request.query
         limit = search_request.limit
         
-        # 搜索会话标题和消息内容
-        sessions = db.query(ChatSession).join(ChatMessage, isouter=True).filter(
-            ChatSession.is_active == True,
-            or_(
-                ChatSession.title.contains(query),
-                ChatMessage.content.contains(query)
-            )
-        ).distinct().order_by(desc(ChatSession.updated_at)).limit(limit).all()
+        # 通过全文索引检索，按相关度排序并使用游标分页
+        try:
+            found = await search.search_sessions(db, query, limit, search_request.cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        hits = found["hits"]
+        
+        # 按检索顺序加载会话
+        session_ids = [session_id for session_id, _ in hits]
+        result = await db.execute(
+            select(ChatSession)
+            .where(ChatSession.id.in_(session_ids))
+        )
+        sessions = {session.id: session for session in result.scalars().all()}
         
         # 转换为响应格式
-        session_list = [session.to_dict() for session in sessions]
+        session_list = []
+        for session_id, snippet in hits:
+            if session_id in sessions:
+                item = sessions[session_id].to_dict()
+                item["snippet"] = snippet
+                session_list.append(item)
         
         return BaseResponse(
             data={
                 "sessions": session_list,
                 "total": len(session_list),
-                "query": query
+                "query": query,
+                "next_cursor": found["next_cursor"]
             }
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"搜索会话失败: {str(e)}")
 
 @router.delete("/sessions/{session_id}/clear", response_model=BaseResponse)
 async def clear_session_messages(
     session_id: int,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """清空会话消息"""
     try:
-        session = db.query(ChatSession).filter(
-            ChatSession.id == session_id,
-            ChatSession.is_active == True
-        ).first()
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
         
         if not session:
             raise HTTPException(status_code=404, detail="会话不存在")
         
-        # 删除所有消息
-        db.query(ChatMessage).filter(
-            ChatMessage.session_id == session_id
-        ).delete()
+        # 删除所有消息（包括归档的消息）
+        await db.execute(
+            delete(ChatMessage).where(ChatMessage.session_id == session_id)
+        )
+        await archiver.discard_archive(db, session_id)
+        session.archived_at = None
 
-        # 更新会话的updated_at时间戳
+        # 更新会话的updated_at时间戳并重置消息统计
         session.updated_at = func.now()
-        db.commit()
+        session.reset_message_stats()
+        await db.commit()
+        total_cache.invalidate(("messages", session_id))
         
         # 清理AutoGen会话
         await autogen_service.clear_session(session_id)
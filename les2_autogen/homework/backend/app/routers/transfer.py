@@ -0,0 +1,57 @@
+"""
+对话历史导出/导入API路由
+"""
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+
+from app.database import AsyncSessionLocal
+from app.models import ChatSession
+from app.pagination import total_cache
+from app.schemas import BaseResponse
+from app.transfer import HistoryImporter, export_records, gzip_ndjson, import_ndjson
+
+router = APIRouter()
+
+
+@router.get("/export")
+async def export_history(
+    session_id: Optional[int] = Query(None, description="只导出指定会话"),
+    include_inactive: bool = Query(False, description="是否包含已删除的会话")
+):
+    """以 gzip 压缩的 NDJSON 流式导出会话和消息（格式见 app/transfer.py）"""
+    if session_id is not None:
+        async with AsyncSessionLocal() as db:
+            exists = await db.scalar(select(ChatSession.id).where(ChatSession.id == session_id))
+        if exists is None:
+            raise HTTPException(status_code=404, detail="会话不存在")
+
+    filename = f"chat_history_{datetime.now().strftime('%Y%m%d%H%M%S')}.ndjson.gz"
+    return StreamingResponse(
+        gzip_ndjson(export_records(session_id, include_inactive)),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@router.post("/import", response_model=BaseResponse)
+async def import_history(request: Request):
+    """
+    导入导出文件（请求体为 gzip 压缩或未压缩的 NDJSON），会话和消息分配新的id
+
+    例如: curl -X POST --data-binary @chat_history.ndjson.gz http://127.0.0.1:8000/api/v1/import
+    """
+    importer = HistoryImporter()
+    try:
+        await import_ndjson(request.stream(), importer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"导入失败: {e}，已导入: {importer.stats()}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"导入失败: {str(e)}，已导入: {importer.stats()}")
+    finally:
+        if importer.committed["sessions"]:
+            total_cache.invalidate("sessions")
+    return BaseResponse(message="导入成功", data=importer.stats())
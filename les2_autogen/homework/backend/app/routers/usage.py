@@ -0,0 +1,57 @@
+"""
+token用量统计相关API路由
+"""
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.database import get_db
+from app.models import ChatSession, ProviderUsage
+from app.schemas import BaseResponse
+from app.usage import provider_report, session_report
+from common.llms import resolve_llm_name
+
+router = APIRouter()
+
+
+@router.get("/usage/providers", response_model=BaseResponse)
+async def get_provider_usage(db: AsyncSession = Depends(get_db)):
+    """各模型提供商的累计用量、吞吐量和费用，按总token数降序"""
+    try:
+        result = await db.execute(select(ProviderUsage))
+        providers = sorted(
+            (provider_report(row) for row in result.scalars().all()),
+            key=lambda item: item["total_tokens"],
+            reverse=True
+        )
+        totals = {
+            key: sum(item[key] for item in providers)
+            for key in ("requests", "prompt_tokens", "completion_tokens", "total_tokens")
+        }
+        totals["cost"] = round(sum(item["cost"] for item in providers), 6)
+        return BaseResponse(data={"providers": providers, "totals": totals})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取用量统计失败: {str(e)}")
+
+
+@router.get("/usage/sessions/{session_id}", response_model=BaseResponse)
+async def get_session_usage(
+    session_id: int,
+    db: AsyncSession = Depends(get_db)
+):
+    """单个会话的累计用量和费用（按会话当前的模型提供商单价计算）"""
+    try:
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.is_active == True
+            )
+        )
+        session = result.scalars().first()
+        if not session:
+            raise HTTPException(status_code=404, detail="会话不存在")
+        return BaseResponse(data=session_report(session, resolve_llm_name(session.model_name)))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"获取会话用量失败: {str(e)}")
@@ -0,0 +1,190 @@
+"""
+WebSocket聊天接口
+
+一个客户端保持一条连接，在同一连接上并发进行多个会话的流式对话，省去每轮的连接建立和请求头开销。
+消息均为紧凑JSON文本帧，每一轮由客户端指定的 id 标识，服务端的所有帧都带上该 id 供客户端分发。
+
+客户端 -> 服务端:
+    {"op":"chat","id":"a1","session_id":12,"message":"你好"}   开始一轮对话（session_id 省略时创建新会话）
+    {"op":"resume","id":"a2","user_message_id":34,"after":17}   从事件序号 after 之后恢复生成
+    {"op":"cancel","id":"a1"}                                   取消该轮生成，已生成的部分内容会被保存
+    {"op":"ping"}
+
+服务端 -> 客户端（n 为事件序号，断线后用 resume 的 after 续传）:
+    {"t":"s","id":"a1","sid":12,"uid":34,"n":1}     会话信息
+    {"t":"d","id":"a1","n":2,"d":"增量"}             内容增量
+    {"t":"snap","id":"a1","n":9,"c":"截至目前的内容"}  恢复时缓冲区已丢弃的内容
+    {"t":"done","id":"a1","n":20,"aid":35,"u":{...},"k":false}  完成（完整内容由客户端拼接增量得到）
+    {"t":"err","id":"a1","e":"cancelled","c":"生成已取消"}
+    {"t":"pong"}
+"""
+import asyncio
+import json
+from typing import Any, Dict, Optional, Set
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect
+
+from app.coalesce import Flight, chat_flights
+from app.framing import encode_frame, format_ws_event
+from app.routers.chat import load_saved_answer, start_stream_turn
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+router = APIRouter()
+
+
+def is_int(value: Any) -> bool:
+    """JSON整数（bool 是 int 的子类，true/false 不算）"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ChatConnection:
+    """一条WebSocket连接及其上进行中的各轮对话"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        # 轮次id -> 转发任务
+        self.turns: Dict[Any, asyncio.Task] = {}
+        # 轮次id -> 订阅的生成，用于取消
+        self.flights: Dict[Any, Flight] = {}
+        # 生成开始前（保存消息期间）收到取消请求的轮次
+        self._cancel_pending: Set[Any] = set()
+        # 多个转发任务共用一条连接，发送需要串行
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, frame: Dict[str, Any]) -> None:
+        async with self._send_lock:
+            await self.websocket.send_text(encode_frame(frame))
+
+    async def send_error(self, turn_id: Any, error: str, content: str) -> None:
+        await self.send({"t": "err", "id": turn_id, "e": error, "c": content})
+
+    async def serve(self) -> None:
+        """读取客户端帧并分派，连接断开时停止转发（生成本身继续在后台运行，可通过 resume 恢复）"""
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                # 二进制帧不属于协议，回复错误但保持连接
+                if message.get("text") is None:
+                    await self.send_error(None, "bad_request", "只接受JSON文本帧")
+                    continue
+                try:
+                    frame = json.loads(message["text"])
+                except ValueError:
+                    await self.send_error(None, "bad_request", "无效的JSON")
+                    continue
+                if not isinstance(frame, dict):
+                    await self.send_error(None, "bad_request", "无效的请求")
+                    continue
+                try:
+                    await self.dispatch(frame)
+                except WebSocketDisconnect:
+                    raise
+                except Exception as e:
+                    # 单个请求出错不影响连接上的其他会话
+                    logger.error("WebSocket处理请求失败: %s", e)
+                    await self.send_error(None, "internal_error", "处理请求时发生错误")
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for task in self.turns.values():
+                task.cancel()
+
+    async def dispatch(self, frame: Dict[str, Any]) -> None:
+        op = frame.get("op")
+        turn_id = frame.get("id")
+        # id 作为字典键使用，列表/对象无法哈希（True/False 会与 1/0 混淆）
+        if turn_id is not None and (not isinstance(turn_id, (str, int)) or isinstance(turn_id, bool)):
+            await self.send_error(None, "bad_request", "id必须是字符串或整数")
+            return
+        if op == "ping":
+            await self.send({"t": "pong"})
+            return
+        if op == "cancel":
+            flight = self.flights.get(turn_id)
+            if flight is None and turn_id in self.turns:
+                self._cancel_pending.add(turn_id)
+            elif flight is None or not chat_flights.cancel(flight):
+                await self.send_error(turn_id, "not_running", "没有进行中的生成")
+            return
+        if op not in ("chat", "resume"):
+            await self.send_error(turn_id, "bad_request", f"未知的操作: {op}")
+            return
+        if turn_id is None or turn_id in self.turns:
+            await self.send_error(turn_id, "bad_request", "缺少id或id正在使用")
+            return
+
+        if op == "chat":
+            message = frame.get("message")
+            session_id = frame.get("session_id")
+            if not isinstance(message, str) or not message or (session_id is not None and not is_int(session_id)):
+                await self.send_error(turn_id, "bad_request", "缺少message或session_id无效")
+                return
+            coro = self.run_chat(turn_id, session_id, message)
+        else:
+            user_message_id = frame.get("user_message_id")
+            after = frame.get("after", 0)
+            if not is_int(user_message_id) or not is_int(after) or after < 0:
+                await self.send_error(turn_id, "bad_request", "user_message_id或after无效")
+                return
+            coro = self.run_resume(turn_id, user_message_id, after)
+
+        # 每轮在独立任务中运行，读取循环可以继续接收其他会话的消息和取消请求
+        task = asyncio.create_task(coro)
+        self.turns[turn_id] = task
+        task.add_done_callback(lambda task, turn_id=turn_id: self._forget(turn_id, task))
+
+    def _forget(self, turn_id: Any, task: asyncio.Task) -> None:
+        self.turns.pop(turn_id, None)
+        self.flights.pop(turn_id, None)
+        self._cancel_pending.discard(turn_id)
+        if not task.cancelled() and task.exception() is not None:
+            # 通常是连接已关闭时仍在发送
+            logger.info("WebSocket转发结束: %s", task.exception())
+
+    async def run_chat(self, turn_id: Any, session_id: Optional[int], message: str) -> None:
+        try:
+            flight = await start_stream_turn(session_id, message)
+        except HTTPException as e:
+            await self.send_error(turn_id, "http_%d" % e.status_code, str(e.detail))
+            return
+        except Exception as e:
+            # 异常细节只记录日志，不发给客户端
+            logger.error("WebSocket开始对话失败: %s", e)
+            await self.send_error(turn_id, "internal_error", "处理请求时发生错误")
+            return
+        await self.forward(turn_id, flight)
+
+    async def run_resume(self, turn_id: Any, user_message_id: int, after: int) -> None:
+        flight = chat_flights.resumable(user_message_id)
+        if flight is not None:
+            await self.forward(turn_id, flight, after)
+            return
+
+        # 生成已不在内存中，从数据库取回该问题之后的助手回答
+        answer = await load_saved_answer(user_message_id)
+        if answer is None:
+            await self.send_error(turn_id, "not_resumable", "生成已结束且没有保存回答，请重新发送")
+            return
+        await self.send({"t": "snap", "id": turn_id, "c": answer.content})
+        await self.send({"t": "done", "id": turn_id, "aid": answer.id, "u": (answer.message_metadata or {}).get("usage"), "k": False})
+
+    async def forward(self, turn_id: Any, flight: Flight, after_id: int = 0) -> None:
+        """订阅生成并把事件转发到连接"""
+        self.flights[turn_id] = flight
+        if turn_id in self._cancel_pending:
+            chat_flights.cancel(flight)
+        async for seq, event in flight.subscribe(after_id):
+            frame = format_ws_event(turn_id, seq, event)
+            if frame is not None:
+                await self.send(frame)
+
+
+@router.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket):
+    """WebSocket流式聊天接口，一条连接上可并发多个会话，协议见模块说明"""
+    await websocket.accept()
+    await ChatConnection(websocket).serve()
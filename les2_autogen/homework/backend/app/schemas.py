@@ -5,6 +5,8 @@ from datetime import datetime
 from typing import List, Optional, Dict, Any
 from pydantic import BaseModel, Field
 
+from app.batch import BATCH_MAX_PROMPTS
+
 # 基础响应模式
 class BaseResponse(BaseModel):
     """基础响应模式"""
@@ -43,6 +45,9 @@ class ChatSessionResponse(BaseModel):
     temperature: str
     max_tokens: int
     message_count: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    archived: bool = False
 
     class Config:
         from_attributes = True
@@ -73,6 +78,27 @@ class ChatRequest(BaseModel):
     session_id: Optional[int] = None
     stream: bool = True
 
+class ChatJobRequest(BaseModel):
+    """异步聊天任务请求"""
+    message: str = Field(..., min_length=1, max_length=10000)
+    session_id: Optional[int] = None
+    # 优先级，越大越先执行
+    priority: int = Field(default=0, ge=0, le=9)
+    # 截止时间（秒，从提交时算起），为空时使用 JOB_DEFAULT_DEADLINE
+    deadline_seconds: Optional[float] = Field(default=None, gt=0, le=3600)
+    # 任务结束后接收通知的地址
+    webhook_url: Optional[str] = Field(default=None, pattern="^https?://", max_length=2000)
+
+class BatchPromptRequest(BaseModel):
+    """批量提示词请求"""
+    prompts: List[str] = Field(..., min_length=1, max_length=BATCH_MAX_PROMPTS)
+    system_message: Optional[str] = "你是一个有用的AI助手。"
+    model_name: Optional[str] = "mota"
+    temperature: Optional[float] = Field(default=None, ge=0, le=2)
+    max_tokens: Optional[int] = Field(default=None, ge=1)
+    # 同时执行的提示词数，为空时使用 BATCH_DEFAULT_PARALLELISM
+    parallelism: Optional[int] = Field(default=None, ge=1)
+
 class ChatResponse(BaseModel):
     """聊天响应"""
     session_id: int
@@ -84,12 +110,14 @@ class SearchRequest(BaseModel):
     """搜索请求"""
     query: str = Field(..., min_length=1, max_length=200)
     limit: int = Field(default=10, ge=1, le=50)
+    cursor: Optional[str] = None
 
 # 分页响应
 class PaginatedResponse(BaseModel):
     """分页响应"""
     items: List[Any]
-    total: int
+    total: Optional[int] = None
     page: int = 1
     size: int = 10
-    pages: int = 1
+    pages: Optional[int] = 1
+    next_cursor: Optional[str] = None
@@ -0,0 +1,462 @@
+"""
+会话全文检索模块
+
+基于 SQLite FTS5（trigram 分词，支持中文子串匹配）为消息内容和会话标题建立倒排索引，
+通过触发器在插入/更新/删除时增量维护。检索结果按 bm25 排序、附带高亮片段，并使用游标分页。
+各索引的 bm25 不可直接比较（词频统计各自独立），先在每个索引内除以该索引的最佳分数归一化，再合并排序。
+
+trigram 无法匹配少于3个字符的查询（中文常见的两字词），短查询使用另一组索引（*_chars_fts）：
+写入时把文本拆成以空格分隔的单个字符（SQL函数 search_chars，在每个连接上注册），
+用 unicode61 分词后每个字符是一个词，短查询转换为相邻字符组成的短语，等价于子串匹配。
+这组索引只保存倒排索引（content=''），大小与 trigram 索引相当，可通过 SEARCH_SHORT_INDEX=0 关闭。
+注意触发器依赖 search_chars 函数：在本应用之外（如 sqlite3 命令行）写入消息或会话时需要先注册该函数。
+非 SQLite 数据库、SQLite 不支持 FTS5 或关闭了短查询索引时，退化为 LIKE 查询（按更新时间游标分页）。
+
+已归档会话（见 app/archive.py）的消息不在 chat_messages 中，由归档任务写入 chat_archives_fts：
+每个会话一行（rowid 为会话id），无内容表（content=''）只保存倒排索引、不再保存一份未压缩的原文，
+高亮片段在命中后解压归档生成。代价是归档节省的空间中不包括索引本身；
+LIKE 退化查询不检索归档的消息。
+"""
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import desc, or_, select, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from app.models import ChatMessage, ChatSession
+from app.pagination import decode_cursor, encode_cursor, sort_key, sort_value
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+# trigram 分词要求查询至少包含3个字符
+FTS_MIN_QUERY_LENGTH = 3
+# 高亮片段配置
+SNIPPET_OPEN = "<mark>"
+SNIPPET_CLOSE = "</mark>"
+SNIPPET_TOKENS = 16
+
+# 是否为少于 FTS_MIN_QUERY_LENGTH 个字符的查询建立单字索引
+SEARCH_SHORT_INDEX: bool = os.getenv("SEARCH_SHORT_INDEX", "1") != "0"
+
+# 是否启用了FTS索引和短查询索引（在 init_search_index 中确定）
+fts_enabled = False
+short_index_enabled = False
+
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5(
+        content, content='chat_messages', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_sessions_fts USING fts5(
+        title, content='chat_sessions', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    # 已归档会话的消息（由归档任务维护，没有触发器）
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_archives_fts USING fts5(
+        content, content='', tokenize='trigram'
+    )
+    """,
+    # 消息索引触发器
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_ad AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_fts_au AFTER UPDATE OF content ON chat_messages BEGIN
+        INSERT INTO chat_messages_fts(chat_messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO chat_messages_fts(rowid, content) VALUES (new.id, new.content);
+    END
+    """,
+    # 会话标题索引触发器
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_fts_ai AFTER INSERT ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_fts_ad AFTER DELETE ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_fts(chat_sessions_fts, rowid, title) VALUES ('delete', old.id, old.title);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_fts_au AFTER UPDATE OF title ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_fts(chat_sessions_fts, rowid, title) VALUES ('delete', old.id, old.title);
+        INSERT INTO chat_sessions_fts(rowid, title) VALUES (new.id, new.title);
+    END
+    """,
+]
+
+# 短查询索引：内容为 search_chars() 拆分后的文本
+SHORT_INDEX_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_chars_fts USING fts5(
+        content, content='', tokenize='unicode61'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_sessions_chars_fts USING fts5(
+        title, content='', tokenize='unicode61'
+    )
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS chat_archives_chars_fts USING fts5(
+        content, content='', tokenize='unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_chars_ai AFTER INSERT ON chat_messages BEGIN
+        INSERT INTO chat_messages_chars_fts(rowid, content) VALUES (new.id, search_chars(new.content));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_chars_ad AFTER DELETE ON chat_messages BEGIN
+        INSERT INTO chat_messages_chars_fts(chat_messages_chars_fts, rowid, content)
+        VALUES ('delete', old.id, search_chars(old.content));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_messages_chars_au AFTER UPDATE OF content ON chat_messages BEGIN
+        INSERT INTO chat_messages_chars_fts(chat_messages_chars_fts, rowid, content)
+        VALUES ('delete', old.id, search_chars(old.content));
+        INSERT INTO chat_messages_chars_fts(rowid, content) VALUES (new.id, search_chars(new.content));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_chars_ai AFTER INSERT ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_chars_fts(rowid, title) VALUES (new.id, search_chars(new.title));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_chars_ad AFTER DELETE ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_chars_fts(chat_sessions_chars_fts, rowid, title)
+        VALUES ('delete', old.id, search_chars(old.title));
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS chat_sessions_chars_au AFTER UPDATE OF title ON chat_sessions BEGIN
+        INSERT INTO chat_sessions_chars_fts(chat_sessions_chars_fts, rowid, title)
+        VALUES ('delete', old.id, search_chars(old.title));
+        INSERT INTO chat_sessions_chars_fts(rowid, title) VALUES (new.id, search_chars(new.title));
+    END
+    """,
+]
+
+SHORT_INDEX_DROP = [
+    "DROP TRIGGER IF EXISTS chat_messages_chars_ai",
+    "DROP TRIGGER IF EXISTS chat_messages_chars_ad",
+    "DROP TRIGGER IF EXISTS chat_messages_chars_au",
+    "DROP TRIGGER IF EXISTS chat_sessions_chars_ai",
+    "DROP TRIGGER IF EXISTS chat_sessions_chars_ad",
+    "DROP TRIGGER IF EXISTS chat_sessions_chars_au",
+    "DROP TABLE IF EXISTS chat_messages_chars_fts",
+    "DROP TABLE IF EXISTS chat_sessions_chars_fts",
+    "DROP TABLE IF EXISTS chat_archives_chars_fts",
+]
+
+SHORT_INDEX_BACKFILL = [
+    "INSERT INTO chat_messages_chars_fts(rowid, content) SELECT id, search_chars(content) FROM chat_messages",
+    "INSERT INTO chat_sessions_chars_fts(rowid, title) SELECT id, search_chars(title) FROM chat_sessions",
+]
+
+# 每个会话取最佳匹配，消息内容、会话标题和归档会话的命中合并排序。
+# bm25 越小越相关；每个索引的分数除以该索引的最佳分数后取负，归一化到 [-1, 0)
+SEARCH_SQL_TEMPLATE = """
+WITH message_hits AS (
+    SELECT m.session_id AS session_id,
+           bm25({messages}) AS rank,
+           {message_snippet} AS snippet,
+           m.id AS message_id,
+           'message' AS source
+    FROM {messages}
+    JOIN chat_messages m ON m.id = {messages}.rowid
+    WHERE {messages} MATCH :query
+),
+title_hits AS (
+    SELECT {sessions}.rowid AS session_id,
+           bm25({sessions}) AS rank,
+           {title_snippet} AS snippet,
+           NULL AS message_id,
+           'title' AS source
+    FROM {sessions}
+    WHERE {sessions} MATCH :query
+),
+archive_hits AS (
+    SELECT {archives}.rowid AS session_id,
+           bm25({archives}) AS rank,
+           NULL AS snippet,
+           NULL AS message_id,
+           'archive' AS source
+    FROM {archives}
+    WHERE {archives} MATCH :query
+),
+hits AS (
+    SELECT session_id, -rank / MIN(rank) OVER () AS score, snippet, message_id, source FROM message_hits
+    UNION ALL
+    SELECT session_id, -rank / MIN(rank) OVER () AS score, snippet, message_id, source FROM title_hits
+    UNION ALL
+    SELECT session_id, -rank / MIN(rank) OVER () AS score, snippet, message_id, source FROM archive_hits
+),
+best AS (
+    SELECT session_id, MIN(score) AS score, snippet, message_id, source
+    FROM hits
+    GROUP BY session_id
+)
+SELECT best.session_id, best.score, best.snippet, best.message_id, best.source
+FROM best
+JOIN chat_sessions s ON s.id = best.session_id
+WHERE s.is_active = 1
+  AND (:after_score IS NULL OR (best.score, best.session_id) > (:after_score, :after_id))
+ORDER BY best.score, best.session_id
+LIMIT :limit
+"""
+
+FTS_SEARCH_SQL = SEARCH_SQL_TEMPLATE.format(
+    messages="chat_messages_fts",
+    sessions="chat_sessions_fts",
+    archives="chat_archives_fts",
+    message_snippet="snippet(chat_messages_fts, 0, :open, :close, '...', :tokens)",
+    title_snippet="snippet(chat_sessions_fts, 0, :open, :close, '...', :tokens)"
+)
+
+# 短查询索引没有原文，片段在命中后由原文生成
+SHORT_SEARCH_SQL = SEARCH_SQL_TEMPLATE.format(
+    messages="chat_messages_chars_fts",
+    sessions="chat_sessions_chars_fts",
+    archives="chat_archives_chars_fts",
+    message_snippet="NULL",
+    title_snippet="NULL"
+)
+
+# 无内容表删除时必须提供与写入时相同的内容
+ARCHIVE_INDEX_SQL = "INSERT INTO chat_archives_fts(rowid, content) VALUES (:session_id, :content)"
+ARCHIVE_UNINDEX_SQL = """
+INSERT INTO chat_archives_fts(chat_archives_fts, rowid, content) VALUES ('delete', :session_id, :content)
+"""
+ARCHIVE_CHARS_INDEX_SQL = "INSERT INTO chat_archives_chars_fts(rowid, content) VALUES (:session_id, :content)"
+ARCHIVE_CHARS_UNINDEX_SQL = """
+INSERT INTO chat_archives_chars_fts(chat_archives_chars_fts, rowid, content) VALUES ('delete', :session_id, :content)
+"""
+
+
+def search_chars(value: Optional[str]) -> Optional[str]:
+    """短查询索引的内容：每个字符之间插入空格"""
+    return None if value is None else " ".join(value)
+
+
+def register_sqlite_functions(dbapi_connection: Any) -> None:
+    """在SQLite连接上注册触发器使用的函数"""
+    dbapi_connection.create_function("search_chars", 1, search_chars, deterministic=True)
+
+
+async def init_search_index(conn: AsyncConnection) -> None:
+    """创建FTS索引表和触发器；首次创建时从现有数据重建索引"""
+    global fts_enabled
+    if conn.dialect.name != "sqlite":
+        fts_enabled = False
+        return
+
+    try:
+        existed = (await conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_fts'"
+        )).first() is not None
+        for statement in FTS_SCHEMA:
+            await conn.exec_driver_sql(statement)
+        if not existed:
+            await conn.exec_driver_sql("INSERT INTO chat_messages_fts(chat_messages_fts) VALUES ('rebuild')")
+            await conn.exec_driver_sql("INSERT INTO chat_sessions_fts(chat_sessions_fts) VALUES ('rebuild')")
+        fts_enabled = True
+    except Exception as e:
+        logger.warning("FTS5全文索引不可用，搜索将退化为LIKE查询: %s", e)
+        fts_enabled = False
+        return
+    await _init_short_index(conn)
+
+
+async def _init_short_index(conn: AsyncConnection) -> None:
+    """创建或删除短查询索引；首次创建时从现有数据（包括已索引的归档会话）回填"""
+    global short_index_enabled
+    if not SEARCH_SHORT_INDEX:
+        for statement in SHORT_INDEX_DROP:
+            await conn.exec_driver_sql(statement)
+        short_index_enabled = False
+        return
+
+    from app.archive import decode_messages, search_content
+    from app.models import SessionArchive
+
+    try:
+        existed = (await conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'chat_messages_chars_fts'"
+        )).first() is not None
+        for statement in SHORT_INDEX_SCHEMA:
+            await conn.exec_driver_sql(statement)
+        if not existed:
+            for statement in SHORT_INDEX_BACKFILL:
+                await conn.exec_driver_sql(statement)
+            result = await conn.stream(
+                select(SessionArchive.session_id, SessionArchive.codec, SessionArchive.data)
+                .where(SessionArchive.indexed == True)
+                .execution_options(yield_per=16)
+            )
+            async for row in result:
+                content = search_content(decode_messages(row.codec, row.data))
+                await conn.execute(text(ARCHIVE_CHARS_INDEX_SQL), {"session_id": row.session_id, "content": search_chars(content)})
+        short_index_enabled = True
+    except Exception as e:
+        logger.warning("短查询索引不可用，少于%d个字符的查询将退化为LIKE查询: %s", FTS_MIN_QUERY_LENGTH, e)
+        short_index_enabled = False
+
+
+async def index_archive(db: AsyncSession, session_id: int, content: str) -> None:
+    """把归档会话的消息写入检索索引（在调用方的事务中执行）"""
+    await db.execute(text(ARCHIVE_INDEX_SQL), {"session_id": session_id, "content": content})
+    if short_index_enabled:
+        await db.execute(text(ARCHIVE_CHARS_INDEX_SQL), {"session_id": session_id, "content": search_chars(content)})
+
+
+async def unindex_archive(db: AsyncSession, session_id: int, content: str) -> None:
+    """从检索索引中移除归档会话，content 必须与写入时相同"""
+    await db.execute(text(ARCHIVE_UNINDEX_SQL), {"session_id": session_id, "content": content})
+    if short_index_enabled:
+        await db.execute(text(ARCHIVE_CHARS_UNINDEX_SQL), {"session_id": session_id, "content": search_chars(content)})
+
+
+def make_snippet(content: str, query: str, tokens: int = SNIPPET_TOKENS) -> Optional[str]:
+    """在原文中定位查询词，生成与 snippet() 格式相近的高亮片段"""
+    position = content.lower().find(query.lower())
+    if position < 0:
+        return None
+    end = position + len(query)
+    start, stop = max(position - tokens, 0), min(end + tokens, len(content))
+    return (
+        ("..." if start > 0 else "") + content[start:position]
+        + SNIPPET_OPEN + content[position:end] + SNIPPET_CLOSE
+        + content[end:stop] + ("..." if stop < len(content) else "")
+    )
+
+
+async def _archive_snippets(db: AsyncSession, session_ids: List[int], query: str) -> Dict[int, Optional[str]]:
+    """解压命中的归档会话，取第一条包含查询词的消息生成片段"""
+    from app.archive import decode_messages
+    from app.models import SessionArchive
+
+    result = await db.execute(
+        select(SessionArchive.session_id, SessionArchive.codec, SessionArchive.data)
+        .where(SessionArchive.session_id.in_(session_ids))
+    )
+    snippets: Dict[int, Optional[str]] = {}
+    for row in result.all():
+        for record in decode_messages(row.codec, row.data):
+            snippet = make_snippet(record.get("content") or "", query)
+            if snippet is not None:
+                snippets[row.session_id] = snippet
+                break
+    return snippets
+
+
+def to_match_query(query: str) -> str:
+    """把用户输入转换为FTS5短语查询，避免语法注入"""
+    return '"' + query.replace('"', '""') + '"'
+
+
+def to_chars_query(query: str) -> str:
+    """短查询转换为相邻单字组成的短语"""
+    return to_match_query(search_chars(query))
+
+
+async def _source_snippets(db: AsyncSession, rows: List[Any], query: str) -> Dict[int, Optional[str]]:
+    """为没有片段的命中从原文生成片段（短查询索引和归档索引不保存原文）"""
+    snippets: Dict[int, Optional[str]] = {}
+    message_ids = {row.message_id: row.session_id for row in rows if row.source == "message" and row.snippet is None}
+    if message_ids:
+        result = await db.execute(select(ChatMessage.id, ChatMessage.content).where(ChatMessage.id.in_(message_ids)))
+        for message_id, content in result.all():
+            snippets[message_ids[message_id]] = make_snippet(content, query)
+    title_ids = [row.session_id for row in rows if row.source == "title" and row.snippet is None]
+    if title_ids:
+        result = await db.execute(select(ChatSession.id, ChatSession.title).where(ChatSession.id.in_(title_ids)))
+        for session_id, title in result.all():
+            snippets[session_id] = make_snippet(title, query)
+    archive_ids = [row.session_id for row in rows if row.source == "archive"]
+    if archive_ids:
+        snippets.update(await _archive_snippets(db, archive_ids, query))
+    return snippets
+
+
+async def search_sessions(
+        db: AsyncSession,
+        query: str,
+        limit: int = 10,
+        cursor: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    搜索会话
+
+    :return: {"hits": [(session_id, snippet)], "next_cursor": str | None}
+    """
+    query = query.strip()
+    short = len(query) < FTS_MIN_QUERY_LENGTH
+    if not fts_enabled or (short and not short_index_enabled):
+        return await _search_sessions_like(db, query, limit, cursor)
+
+    after_score, after_id = decode_cursor(cursor, 2) or (None, None)
+    result = await db.execute(
+        text(SHORT_SEARCH_SQL if short else FTS_SEARCH_SQL),
+        {
+            "query": to_chars_query(query) if short else to_match_query(query),
+            "open": SNIPPET_OPEN,
+            "close": SNIPPET_CLOSE,
+            "tokens": SNIPPET_TOKENS,
+            "after_score": after_score,
+            "after_id": after_id,
+            "limit": limit + 1,
+        }
+    )
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = encode_cursor(rows[-1].score, rows[-1].session_id) if has_more else None
+    snippets = await _source_snippets(db, rows, query)
+    return {
+        "hits": [(row.session_id, row.snippet if row.snippet is not None else snippets.get(row.session_id)) for row in rows],
+        "next_cursor": next_cursor,
+    }
+
+
+async def _search_sessions_like(db: AsyncSession, query: str, limit: int, cursor: Optional[str] = None) -> Dict[str, Any]:
+    """LIKE 退化查询，按 (updated_at, id) 倒序游标分页"""
+    key = sort_key(ChatSession.updated_at, db)
+    statement = (
+        select(ChatSession.id, key)
+        .where(
+            ChatSession.is_active == True,
+            or_(
+                ChatSession.title.contains(query, autoescape=True),
+                select(ChatMessage.id)
+                .where(ChatMessage.session_id == ChatSession.id, ChatMessage.content.contains(query, autoescape=True))
+                .exists()
+            )
+        )
+        .order_by(desc(ChatSession.updated_at), desc(ChatSession.id))
+    )
+    after = decode_cursor(cursor, 2)
+    if after:
+        statement = statement.where(
+            tuple_(ChatSession.updated_at, ChatSession.id) < tuple_(sort_value(after[0], key), after[1])
+        )
+    rows = (await db.execute(statement.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    hits: List[Tuple[int, Optional[str]]] = [(row.id, None) for row in rows]
+    return {"hits": hits, "next_cursor": encode_cursor(rows[-1][1], rows[-1].id) if has_more else None}
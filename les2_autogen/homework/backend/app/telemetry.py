@@ -0,0 +1,517 @@
+"""
+指标与链路追踪
+
+不依赖外部服务，离线可用：
+- 指标：进程内的 Counter/Gauge/Histogram，GET /metrics 以 Prometheus 文本格式输出
+- 追踪：OpenTelemetry 风格的 span（trace_id/span_id/parent_span_id/属性/状态），
+  保存在进程内的有界收集器中（GET /debug/traces 查看），配置 TRACE_EXPORT_PATH 时同时以JSONL追加写入文件
+
+埋点位置：HTTP 中间件（请求延迟）、AutoGenService.chat_stream（首token时间、块间隔、token速率、活跃流、提供商错误）、
+get_or_create_agent（智能体创建耗时）、数据库引擎事件（SQL执行时间）。
+"""
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import secrets
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from common.llms import resolve_llm_name
+
+# 进程内保留的最近 span 数
+TRACE_BUFFER_SIZE: int = int(os.getenv("TRACE_BUFFER_SIZE", "1000"))
+# span 导出文件（JSONL），为空表示只保存在内存中
+TRACE_EXPORT_PATH: str = os.getenv("TRACE_EXPORT_PATH", "")
+
+# 延迟类直方图的桶（秒）
+LATENCY_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 块间隔直方图的桶（秒）
+GAP_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+# token速率直方图的桶（token/秒）
+RATE_BUCKETS: Tuple[float, ...] = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """带标签的指标，标签值按声明顺序传入"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Sequence[str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.label_names):
+            raise ValueError(f"{self.name} 需要标签 {self.label_names}")
+        return tuple(str(label) for label in labels)
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """Prometheus 文本格式的样本行"""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """
+    抓取时调用回调取值的指标，用于导出已有的统计（缓存命中率、队列深度等）
+
+    声明了标签时，回调返回 {标签值: 取值}（多个标签时键为元组）。
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], Any], labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self.callback = callback
+
+    def samples(self) -> Iterator[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            return
+        if not self.label_names:
+            if value is not None:
+                yield f"{self.name} {_format_value(value)}"
+            return
+        for key, item in sorted((self._key(key if isinstance(key, tuple) else (key,)), item)
+                                for key, item in (value or {}).items()):
+            if item is not None:
+                yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(item)}"
+
+
+class CallbackCounter(CallbackGauge):
+    """抓取时调用回调取值的累计值"""
+
+    kind = "counter"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> (各桶计数, 总和, 总数)
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, *labels: str) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = 'le="%s"' % _format_value(float(bound))
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            le = 'le="+Inf"'
+            yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {count}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {count}"
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def callback_gauge(self, name: str, help_text: str, callback: Callable[[], Any],
+                       labels: Sequence[str] = ()) -> CallbackGauge:
+        return self.register(CallbackGauge(name, help_text, callback, labels))
+
+    def callback_counter(self, name: str, help_text: str, callback: Callable[[], Any],
+                         labels: Sequence[str] = ()) -> CallbackCounter:
+        return self.register(CallbackCounter(name, help_text, callback, labels))
+
+    def render(self) -> str:
+        """Prometheus 文本格式"""
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP请求耗时（流式响应计到最后一个字节）", ("method", "route", "status"))
+chat_ttft = registry.histogram(
+    "chat_time_to_first_token_seconds", "从开始生成到第一个内容块的时间", ("provider", "source"))
+chat_chunk_gap = registry.histogram(
+    "chat_inter_chunk_seconds", "相邻内容块的间隔", ("provider", "source"), GAP_BUCKETS)
+chat_stream_duration = registry.histogram(
+    "chat_stream_duration_seconds", "一轮流式生成的总耗时", ("provider", "source"))
+chat_tokens_per_second = registry.histogram(
+    "chat_tokens_per_second", "首token之后的回答token速率", ("provider",), RATE_BUCKETS)
+chat_active_streams = registry.gauge("chat_active_streams", "进行中的流式生成数")
+chat_turns = registry.counter("chat_turns_total", "生成轮数", ("provider", "outcome"))
+provider_errors = registry.counter("llm_provider_errors_total", "模型提供商调用失败次数", ("provider",))
+agent_acquire_duration = registry.histogram(
+    "agent_acquire_duration_seconds", "获取智能体（缓存命中或新建）的耗时", ("result",))
+db_query_duration = registry.histogram("db_query_duration_seconds", "SQL执行耗时", ("operation",))
+
+
+# ---------------------------------------------------------------- 追踪
+
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class Span:
+    """OpenTelemetry 风格的 span"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_span_id", "start", "end", "attributes", "status", "_start_perf")
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_span_id = parent.span_id if parent else None
+        self.start = time.time()
+        self._start_perf = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "OK"
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(error).__name__
+        self.attributes["exception.message"] = str(error)
+
+    def finish(self) -> None:
+        if self.end is None:
+            self.end = self.start + (time.perf_counter() - self._start_perf)
+            collector.export(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_span_id,
+            "start_time": self.start,
+            "end_time": self.end,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class SpanCollector:
+    """进程内的 span 收集器，可选地通过后台线程追加写入JSONL文件（不在事件循环中做磁盘IO）"""
+
+    def __init__(self, buffer_size: int = TRACE_BUFFER_SIZE, export_path: str = TRACE_EXPORT_PATH):
+        self.spans: Deque[Dict[str, Any]] = deque(maxlen=max(buffer_size, 1))
+        self.exported = 0
+        self._file_logger: Optional[logging.Logger] = None
+        if export_path:
+            handler = logging.FileHandler(export_path, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            span_queue = queue.SimpleQueue()
+            self._file_logger = logging.getLogger("trace_export")
+            self._file_logger.propagate = False
+            self._file_logger.setLevel(logging.INFO)
+            self._file_logger.addHandler(logging.handlers.QueueHandler(span_queue))
+            self._listener = logging.handlers.QueueListener(span_queue, handler)
+            self._listener.start()
+
+    def export(self, span: Span) -> None:
+        data = span.to_dict()
+        self.spans.append(data)
+        self.exported += 1
+        if self._file_logger is not None:
+            self._file_logger.info(json.dumps(data, ensure_ascii=False, default=str))
+
+    def recent(self, limit: int = 100, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        spans = [span for span in self.spans if trace_id is None or span["trace_id"] == trace_id]
+        return spans[-limit:]
+
+    def close(self) -> None:
+        if self._file_logger is not None:
+            self._listener.stop()
+
+
+collector = SpanCollector()
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """在当前上下文中开始一个子 span，退出时结束（同步和异步代码中都可以使用，但不要跨越 yield）"""
+    current = Span(name, current_span.get(), attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.record_error(e)
+        raise
+    finally:
+        current_span.reset(token)
+        current.finish()
+
+
+def annotate(**attributes: Any) -> None:
+    """给当前 span 添加属性（没有 span 时忽略）"""
+    current = current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def traced(name: str, histogram: Optional[Histogram] = None, label: Optional[str] = None):
+    """
+    为异步方法创建 span，可选地记录耗时
+
+    :param name:        span 名称
+    :param histogram:   记录耗时的直方图
+    :param label:       作为直方图标签值的 span 属性名（由方法通过 annotate 设置）
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name) as current:
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    if histogram is not None:
+                        labels = (str(current.attributes.get(label, "unknown")),) if label else ()
+                        histogram.observe(time.perf_counter() - current._start_perf, *labels)
+        return wrapper
+    return decorator
+
+
+def observe_chat_stream(name: str):
+    """
+    包装产生 chunk/complete/error 事件的异步生成器方法，记录首token时间、块间隔、token速率、活跃流和错误
+
+    提供商取自 model_name 参数。调用时的 span 作为父 span；每次恢复被包装的生成器时把本 span 设为
+    current_span，在同一步内恢复原值（生成器可能在其他任务中被关闭，不能跨越 yield 持有 token），
+    生成过程中创建的 span（获取智能体、加载历史等）都以它为父 span。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs) -> AsyncGenerator[Dict[str, Any], None]:
+            provider = resolve_llm_name(kwargs.get("model_name") or "mota")
+            current = Span(name, current_span.get(), {"llm.provider": provider, "session.id": kwargs.get("session_id")})
+            start = time.perf_counter()
+            first_chunk: Optional[float] = None
+            last_chunk: Optional[float] = None
+            gaps: List[float] = []
+            chunks = 0
+            outcome = "incomplete"
+            source = "model"
+            chat_active_streams.inc()
+            events = func(*args, **kwargs)
+            try:
+                while True:
+                    token = current_span.set(current)
+                    try:
+                        event = await events.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        current_span.reset(token)
+                    now = time.perf_counter()
+                    if event["type"] == "chunk":
+                        chunks += 1
+                        if first_chunk is None:
+                            first_chunk = now
+                        else:
+                            gaps.append(now - last_chunk)
+                        last_chunk = now
+                    elif event["type"] == "complete":
+                        outcome = "complete"
+                        if event.get("cached"):
+                            source = "cache"
+                        usage = event.get("usage")
+                        completion_tokens = (usage.get("completion_tokens") if isinstance(usage, dict)
+                                             else getattr(usage, "completion_tokens", 0)) or 0
+                        if completion_tokens and first_chunk is not None and now > first_chunk and source == "model":
+                            chat_tokens_per_second.observe(completion_tokens / (now - first_chunk), provider)
+                        current.set_attribute("llm.completion_tokens", completion_tokens)
+                    elif event["type"] == "error":
+                        outcome = "error"
+                        provider_errors.inc(provider)
+                        current.status = "ERROR"
+                        current.set_attribute("exception.message", event.get("error"))
+                    yield event
+            except GeneratorExit:
+                # 调用方在收到完成事件后提前关闭生成器
+                raise
+            except BaseException as e:
+                if outcome == "incomplete":
+                    outcome = "cancelled" if not isinstance(e, Exception) else "error"
+                    current.record_error(e)
+                raise
+            finally:
+                await events.aclose()
+                chat_active_streams.dec()
+                end = time.perf_counter()
+                if first_chunk is not None:
+                    chat_ttft.observe(first_chunk - start, provider, source)
+                    current.set_attribute("chat.ttft_ms", round((first_chunk - start) * 1000, 3))
+                for gap in gaps:
+                    chat_chunk_gap.observe(gap, provider, source)
+                chat_stream_duration.observe(end - start, provider, source)
+                chat_turns.inc(provider, outcome)
+                current.set_attribute("chat.chunks", chunks)
+                current.set_attribute("chat.outcome", outcome)
+                current.finish()
+        return wrapper
+    return decorator
+
+
+def instrument_engine(engine) -> None:
+    """通过SQLAlchemy引擎事件记录每条SQL的执行耗时"""
+    from sqlalchemy import event
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get("query_start")
+        if starts:
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+            db_query_duration.observe(time.perf_counter() - starts.pop(), operation)
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def _error(context):
+        starts = context.connection.info.get("query_start") if context.connection is not None else None
+        if starts:
+            starts.pop()
+
+
+def route_template(scope) -> str:
+    """
+    请求的路径模板（路径参数替换为 {参数名}），作为指标标签避免基数失控
+
+    未匹配到路由的请求统一记为 unmatched。
+    """
+    if scope.get("route") is None:
+        return "unmatched"
+    names = {str(value): name for name, value in (scope.get("path_params") or {}).items()}
+    return "/".join("{%s}" % names[part] if part in names else part for part in scope["path"].split("/"))
+
+
+class TelemetryMiddleware:
+    """ASGI中间件：为每个HTTP请求创建根 span 并记录耗时（流式响应计到响应体结束）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        with span("HTTP " + scope["method"], **{"http.method": scope["method"], "http.target": scope["path"]}) as current:
+            try:
+                await self.app(scope, receive, send_wrapper)
+            finally:
+                route_path = route_template(scope)
+                current.name = f"{scope['method']} {route_path}"
+                current.set_attribute("http.route", route_path)
+                current.set_attribute("http.status_code", status["code"])
+                if status["code"] >= 500:
+                    current.status = "ERROR"
+                http_request_duration.observe(
+                    time.perf_counter() - current._start_perf, scope["method"], route_path, str(status["code"])
+                )
@@ -0,0 +1,295 @@
+"""
+对话历史导出/导入
+
+导出格式为 gzip 压缩的 NDJSON（每行一个JSON对象）：
+    {"type": "header", "format": 1, "exported_at": "..."}
+    {"type": "session", "id": 1, "title": "...", ...}      所有会话在前
+    {"type": "message", "id": 1, "session_id": 1, ...}     消息按会话id分页，每页先输出消息表中的消息
+                                                            （按 (session_id, id) 排序），再输出该页中
+                                                            已归档会话的消息（解压后）
+- 导出按主键做 keyset 分页，每页单独开一个短的读事务，不会在整个下载期间占着读事务阻塞 WAL 检查点；
+  因此导出不是时间点快照，导出过程中写入的数据可能包含也可能不包含
+- 导入边接收边解压边解析（也接受未压缩的NDJSON），先在内存中攒满 IMPORT_BATCH_ROWS 行，
+  再开一个短的写事务插入并提交，读取请求体（可能很慢）时不持有写锁
+- 导入时会话和消息都分配新的id，消息按导出文件中的会话id映射到新会话，找不到会话的消息跳过
+"""
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, select, tuple_
+
+from app.archive import decode_messages
+from app.database import AsyncSessionLocal
+from app.models import ChatMessage, ChatSession, SessionArchive
+from common.log import DycLogger
+
+logger = DycLogger().get_logger()
+
+EXPORT_FORMAT_VERSION = 1
+# 导出时每页读取的行数（每页一个读事务）
+EXPORT_YIELD_PER: int = int(os.getenv("EXPORT_YIELD_PER", "1000"))
+# gzip 压缩级别（1最快，9最小）
+EXPORT_GZIP_LEVEL: int = int(os.getenv("EXPORT_GZIP_LEVEL", "6"))
+# 压缩数据积累到该字节数时发送一次
+EXPORT_CHUNK_BYTES = 64 * 1024
+# 导入时每个写事务插入的行数（会话和消息合计）
+IMPORT_BATCH_ROWS: int = int(os.getenv("IMPORT_BATCH_ROWS", "1000"))
+# 导出时每页读取的归档行数（每行包含一个会话的全部消息）
+EXPORT_ARCHIVE_YIELD_PER = 16
+# 导入时每次最多解压的字节数
+IMPORT_DECOMPRESS_BYTES = 1024 * 1024
+
+SESSION_COLUMNS = [column for column in ChatSession.__table__.columns if column.name != "id"]
+MESSAGE_COLUMNS = [column for column in ChatMessage.__table__.columns if column.name != "id"]
+
+
+def encode_value(value: Any) -> Any:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+async def fetch_page(query) -> List[Any]:
+    """在单独的短事务中读取一页"""
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(query)).all()
+
+
+async def export_records(session_id: Optional[int] = None, include_inactive: bool = False) -> AsyncIterator[Dict[str, Any]]:
+    """按导出格式逐条产出会话和消息"""
+    sessions = ChatSession.__table__
+    messages = ChatMessage.__table__
+    archives = SessionArchive.__table__
+    session_filter = []
+    if session_id is not None:
+        session_filter.append(sessions.c.id == session_id)
+    if not include_inactive:
+        session_filter.append(sessions.c.is_active == True)
+
+    yield {"type": "header", "format": EXPORT_FORMAT_VERSION, "exported_at": datetime.now().isoformat()}
+    last_id = 0
+    while True:
+        rows = await fetch_page(
+            select(sessions).where(*session_filter, sessions.c.id > last_id)
+            .order_by(sessions.c.id).limit(EXPORT_YIELD_PER)
+        )
+        for row in rows:
+            yield {"type": "session", **{key: encode_value(value) for key, value in row._mapping.items()}}
+        if len(rows) < EXPORT_YIELD_PER:
+            break
+        last_id = rows[-1].id
+
+    last_id = 0
+    while True:
+        page = [row.id for row in await fetch_page(
+            select(sessions.c.id).where(*session_filter, sessions.c.id > last_id)
+            .order_by(sessions.c.id).limit(EXPORT_YIELD_PER)
+        )]
+        if not page:
+            break
+        last_id = page[-1]
+
+        cursor = (0, 0)
+        while True:
+            rows = await fetch_page(
+                select(messages)
+                .where(messages.c.session_id.in_(page), tuple_(messages.c.session_id, messages.c.id) > tuple_(*cursor))
+                .order_by(messages.c.session_id, messages.c.id).limit(EXPORT_YIELD_PER)
+            )
+            for row in rows:
+                yield {"type": "message", **{key: encode_value(value) for key, value in row._mapping.items()}}
+            if len(rows) < EXPORT_YIELD_PER:
+                break
+            cursor = (rows[-1].session_id, rows[-1].id)
+
+        archive_id = 0
+        while True:
+            rows = await fetch_page(
+                select(archives.c.session_id, archives.c.codec, archives.c.data)
+                .where(archives.c.session_id.in_(page), archives.c.session_id > archive_id)
+                .order_by(archives.c.session_id).limit(EXPORT_ARCHIVE_YIELD_PER)
+            )
+            for row in rows:
+                for message in decode_messages(row.codec, row.data):
+                    yield {"type": "message", "session_id": row.session_id, **message}
+            if len(rows) < EXPORT_ARCHIVE_YIELD_PER:
+                break
+            archive_id = rows[-1].session_id
+
+        if len(page) < EXPORT_YIELD_PER:
+            break
+
+
+async def gzip_ndjson(records: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """把记录编码为NDJSON并增量gzip压缩"""
+    compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31)
+    pending: List[bytes] = []
+    pending_size = 0
+    async for record in records:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+        data = compressor.compress(line.encode("utf-8"))
+        if data:
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= EXPORT_CHUNK_BYTES:
+                yield b"".join(pending)
+                pending, pending_size = [], 0
+    pending.append(compressor.flush())
+    yield b"".join(pending)
+
+
+async def ndjson_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, bytes]]:
+    """解压（按开头的魔数识别gzip，否则视为未压缩）并按行切分，产出 (行号, 行内容)"""
+    decompressor = None
+    buffer = b""
+    line_no = 0
+    started = False
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if not started:
+            started = True
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(47)
+        while chunk:
+            if decompressor is not None:
+                # 压缩率很高的数据一次解压会膨胀上百倍，每次最多解压 IMPORT_DECOMPRESS_BYTES
+                data = decompressor.decompress(chunk, IMPORT_DECOMPRESS_BYTES)
+                chunk = decompressor.unconsumed_tail
+            else:
+                data, chunk = chunk, b""
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                line_no += 1
+                if line.strip():
+                    yield line_no, line
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+def parse_datetime(value: Any) -> Optional[datetime]:
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+class HistoryImporter:
+    """
+    逐条接收导出记录，攒满一批后在一个短的写事务中插入并提交
+
+    add() 只在内存中缓存，不访问数据库；调用方在 full 为真时调用 flush()。
+    一批内先插入会话拿到新id，再插入消息，所以消息的会话映射在 flush() 时才解析。
+    """
+
+    def __init__(self, batch_rows: int = IMPORT_BATCH_ROWS):
+        self.batch_rows = max(batch_rows, 1)
+        # 导出文件中的会话id -> 新会话id
+        self.session_ids: Dict[Any, int] = {}
+        self._sessions: List[Tuple[Any, Dict[str, Any]]] = []
+        # (导出文件中的会话id, 消息行)
+        self._messages: List[Tuple[Any, Dict[str, Any]]] = []
+        self.skipped = 0
+        # 已提交的行数（导入中途失败时，当前批次不会写入）
+        self.committed = {"sessions": 0, "messages": 0}
+
+    @property
+    def full(self) -> bool:
+        return len(self._sessions) + len(self._messages) >= self.batch_rows
+
+    def add(self, record: Dict[str, Any]) -> None:
+        kind = record.get("type")
+        if kind == "session":
+            self._sessions.append((record.get("id"), self._session_row(record)))
+        elif kind == "message":
+            if not record.get("content") or not record.get("role"):
+                self.skipped += 1
+                return
+            self._messages.append((record.get("session_id"), self._message_row(record)))
+        elif kind != "header":
+            self.skipped += 1
+
+    async def flush(self) -> None:
+        """插入并提交当前批次"""
+        if not self._sessions and not self._messages:
+            return
+        sessions, self._sessions = self._sessions, []
+        messages, self._messages = self._messages, []
+        async with AsyncSessionLocal() as db:
+            session_ids = dict(self.session_ids)
+            if sessions:
+                table = ChatSession.__table__
+                result = await db.execute(
+                    insert(table).returning(table.c.id, sort_by_parameter_order=True),
+                    [row for _, row in sessions]
+                )
+                for (old_id, _), new_id in zip(sessions, result.scalars().all()):
+                    if old_id is not None:
+                        session_ids[old_id] = new_id
+            rows = []
+            for old_id, row in messages:
+                new_id = session_ids.get(old_id)
+                if new_id is not None:
+                    rows.append({**row, "session_id": new_id})
+            if rows:
+                await db.execute(insert(ChatMessage.__table__), rows)
+            await db.commit()
+        self.session_ids = session_ids
+        self.skipped += len(messages) - len(rows)
+        self.committed = {
+            "sessions": self.committed["sessions"] + len(sessions),
+            "messages": self.committed["messages"] + len(rows)
+        }
+
+    @staticmethod
+    def _session_row(record: Dict[str, Any]) -> Dict[str, Any]:
+        now = datetime.now()
+        row = {column.name: record.get(column.name) for column in SESSION_COLUMNS}
+        # executemany 要求每行的列相同，缺失的值用模型的默认值补齐
+        row["title"] = row["title"] or "新对话"
+        row["created_at"] = parse_datetime(row["created_at"]) or now
+        row["updated_at"] = parse_datetime(row["updated_at"]) or row["created_at"]
+        row["first_question_time"] = parse_datetime(row["first_question_time"])
+        row["is_active"] = True if row["is_active"] is None else bool(row["is_active"])
+        # 导入的消息都写入消息表，会话不再处于归档状态
+        row["archived_at"] = None
+        row["model_name"] = row["model_name"] or "mota"
+        row["temperature"] = row["temperature"] or "0.7"
+        row["max_tokens"] = row["max_tokens"] or 2000
+        for name in ("user_message_count", "prompt_tokens", "completion_tokens"):
+            row[name] = row[name] or 0
+        return row
+
+    @staticmethod
+    def _message_row(record: Dict[str, Any]) -> Dict[str, Any]:
+        row = {column.name: record.get(column.name) for column in MESSAGE_COLUMNS}
+        row["created_at"] = parse_datetime(row["created_at"]) or datetime.now()
+        row["message_metadata"] = row["message_metadata"] or {}
+        row["token_count"] = row["token_count"] or 0
+        return row
+
+    def stats(self) -> Dict[str, int]:
+        """已提交的会话数、消息数和跳过的记录数"""
+        return {**self.committed, "skipped": self.skipped}
+
+
+async def import_ndjson(chunks: AsyncIterator[bytes], importer: HistoryImporter) -> None:
+    """
+    从字节流导入
+
+    :raises ValueError: 某一行不是有效的JSON或字段格式错误（此前已提交的批次保留）
+    """
+    async for line_no, line in ndjson_lines(chunks):
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("不是JSON对象")
+            importer.add(record)
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"第{line_no}行无效: {e}") from e
+        if importer.full:
+            await importer.flush()
+    await importer.flush()
+    logger.info("导入完成: %s", importer.stats())
@@ -0,0 +1,122 @@
+"""
+token用量统计
+
+- usage_to_dict: 把 models_usage（RequestUsage）转换为可序列化的字典，提供商未返回用量时用本地估算
+- record_usage: 在保存助手消息的同一个写操作中增量更新会话和提供商的累计用量
+- provider_cost: 按单价计算费用
+
+单价与 model_/base_url_/api_key_ 放在一起配置，单位为每1000个token的价格，例如:
+    price_prompt_gf=0.002  price_completion_gf=0.006
+未配置时为0。
+"""
+import os
+from typing import Any, Dict, Optional
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.model_context import estimate_tokens
+from app.models import ChatSession, ProviderUsage
+
+
+def usage_to_dict(usage: Any, prompt_text: str = "", completion_text: str = "") -> Dict[str, Any]:
+    """
+    转换用量为字典
+
+    :param usage:           models_usage（RequestUsage、字典或 None）
+    :param prompt_text:     用量缺失时用于估算提示词token数的文本
+    :param completion_text: 用量缺失时用于估算回答token数的文本
+    """
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    else:
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+
+    # 部分提供商不返回用量（或流式时返回0），使用本地估算
+    estimated = not prompt_tokens and not completion_tokens
+    if estimated:
+        prompt_tokens = estimate_tokens(prompt_text)
+        completion_tokens = estimate_tokens(completion_text)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "estimated": estimated
+    }
+
+
+def provider_prices(provider: str) -> Dict[str, float]:
+    """提供商每1000个token的单价"""
+    return {
+        "prompt": float(os.getenv(f"price_prompt_{provider}", "0")),
+        "completion": float(os.getenv(f"price_completion_{provider}", "0")),
+    }
+
+
+def provider_cost(provider: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """按单价计算费用"""
+    prices = provider_prices(provider)
+    return round(prompt_tokens / 1000 * prices["prompt"] + completion_tokens / 1000 * prices["completion"], 6)
+
+
+async def record_usage(db: AsyncSession, session_id: Optional[int], provider: str, usage: Dict[str, Any],
+                       seconds: float) -> None:
+    """在批量写操作中累加会话和提供商的用量（使用SQL表达式原子自增，不读取旧值），session_id 为空时只累加提供商"""
+    prompt_tokens, completion_tokens = usage["prompt_tokens"], usage["completion_tokens"]
+    if session_id is not None:
+        await db.execute(
+            update(ChatSession)
+            .where(ChatSession.id == session_id)
+            .values(
+                prompt_tokens=ChatSession.prompt_tokens + prompt_tokens,
+                completion_tokens=ChatSession.completion_tokens + completion_tokens,
+                # 显式保留 updated_at（否则 onupdate 会在每次回答后再次更新，打乱分页顺序和归档的空闲判断）
+                updated_at=ChatSession.updated_at
+            )
+        )
+
+    values = {
+        "requests": ProviderUsage.requests + 1,
+        "estimated_requests": ProviderUsage.estimated_requests + (1 if usage["estimated"] else 0),
+        "prompt_tokens": ProviderUsage.prompt_tokens + prompt_tokens,
+        "completion_tokens": ProviderUsage.completion_tokens + completion_tokens,
+        "generation_seconds": ProviderUsage.generation_seconds + seconds,
+    }
+    result = await db.execute(update(ProviderUsage).where(ProviderUsage.provider == provider).values(**values))
+    if result.rowcount == 0:
+        db.add(ProviderUsage(
+            provider=provider,
+            requests=1,
+            estimated_requests=1 if usage["estimated"] else 0,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            generation_seconds=seconds
+        ))
+        # 同一批次中后续的写操作需要看到这一行
+        await db.flush()
+
+
+def provider_report(row: ProviderUsage) -> Dict[str, Any]:
+    """提供商用量、吞吐量和费用"""
+    report = row.to_dict()
+    report["avg_seconds"] = round(row.generation_seconds / row.requests, 3) if row.requests else 0.0
+    report["completion_tokens_per_second"] = (
+        round(row.completion_tokens / row.generation_seconds, 2) if row.generation_seconds else 0.0
+    )
+    report["prices_per_1k"] = provider_prices(row.provider)
+    report["cost"] = provider_cost(row.provider, row.prompt_tokens, row.completion_tokens)
+    return report
+
+
+def session_report(session: ChatSession, provider: Optional[str] = None) -> Dict[str, Any]:
+    """会话用量和按会话当前提供商单价计算的费用"""
+    prompt_tokens, completion_tokens = session.prompt_tokens or 0, session.completion_tokens or 0
+    return {
+        "session_id": session.id,
+        "provider": provider,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "cost": provider_cost(provider, prompt_tokens, completion_tokens) if provider else None
+    }
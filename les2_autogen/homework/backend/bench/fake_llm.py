@@ -0,0 +1,176 @@
+"""
+本地 OpenAI 兼容的假模型服务（用于离线压测）
+
+支持 /v1/chat/completions 的流式和非流式调用，可配置：
+- 首token延迟、token速率、回答长度
+- 随机失败注入（返回指定HTTP状态码，或在流中途断开）
+
+用法:
+    python bench/fake_llm.py --port 9999 --tokens-per-sec 50 --first-token-ms 300 --fail-rate 0.05
+
+然后把某个模型提供商指向它，例如:
+    model_gf=fake-model  base_url_gf=http://127.0.0.1:9999/v1  api_key_gf=sk-fake
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeLLMConfig:
+    """假模型行为配置"""
+    tokens_per_sec: float = 50.0
+    first_token_ms: float = 200.0
+    jitter_ms: float = 20.0
+    answer_tokens: int = 200
+    fail_rate: float = 0.0
+    fail_status: int = 500
+    midstream_fail_rate: float = 0.0
+
+
+config = FakeLLMConfig()
+app = FastAPI(title="Fake LLM")
+
+# 回答内容由这些片段循环组成，每个片段视为一个token
+TOKENS = ["这是", "一个", "用于", "压测", "的", "模拟", "回答", "，", "包含", "中文", "和", " English", " words", "。"]
+
+stats = {"requests": 0, "streams": 0, "failures": 0, "active": 0}
+
+
+def _usage(prompt_tokens: int, completion_tokens: int):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _prompt_tokens(body) -> int:
+    return sum(len(str(m.get("content", ""))) // 2 + 4 for m in body.get("messages", []))
+
+
+def _answer_length(body) -> int:
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+    return min(config.answer_tokens, max_tokens) if max_tokens else config.answer_tokens
+
+
+async def _token_delay():
+    if config.tokens_per_sec > 0:
+        await asyncio.sleep(1.0 / config.tokens_per_sec)
+
+
+@app.get("/v1/models")
+async def list_models():
+    return {"object": "list", "data": [{"id": "fake-model", "object": "model", "owned_by": "bench"}]}
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    stats["requests"] += 1
+
+    # 首token延迟
+    jitter = random.uniform(-config.jitter_ms, config.jitter_ms) if config.jitter_ms else 0
+    await asyncio.sleep(max(config.first_token_ms + jitter, 0) / 1000)
+
+    if random.random() < config.fail_rate:
+        stats["failures"] += 1
+        return JSONResponse(
+            status_code=config.fail_status,
+            content={"error": {"message": "injected failure", "type": "fake_llm_error"}}
+        )
+
+    completion_id = "chatcmpl-" + uuid.uuid4().hex
+    created = int(time.time())
+    model = body.get("model", "fake-model")
+    n_tokens = _answer_length(body)
+    prompt_tokens = _prompt_tokens(body)
+
+    if not body.get("stream"):
+        for _ in range(n_tokens):
+            await _token_delay()
+        content = "".join(TOKENS[i % len(TOKENS)] for i in range(n_tokens))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": _usage(prompt_tokens, n_tokens),
+        }
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    fail_midstream = random.random() < config.midstream_fail_rate
+
+    def chunk(delta, finish_reason=None, usage=None):
+        payload = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [] if usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        if usage:
+            payload["usage"] = usage
+        return "data: " + json.dumps(payload, ensure_ascii=False) + "\n\n"
+
+    async def generate():
+        stats["streams"] += 1
+        stats["active"] += 1
+        try:
+            yield chunk({"role": "assistant", "content": ""})
+            for i in range(n_tokens):
+                if fail_midstream and i == n_tokens // 2:
+                    stats["failures"] += 1
+                    raise RuntimeError("injected mid-stream failure")
+                yield chunk({"content": TOKENS[i % len(TOKENS)]})
+                await _token_delay()
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk({}, usage=_usage(prompt_tokens, n_tokens))
+            yield "data: [DONE]\n\n"
+        finally:
+            stats["active"] -= 1
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容的假模型服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--tokens-per-sec", type=float, default=config.tokens_per_sec, help="每个流的token速率")
+    parser.add_argument("--first-token-ms", type=float, default=config.first_token_ms, help="首token延迟（毫秒）")
+    parser.add_argument("--jitter-ms", type=float, default=config.jitter_ms, help="首token延迟抖动（毫秒）")
+    parser.add_argument("--answer-tokens", type=int, default=config.answer_tokens, help="每次回答的token数")
+    parser.add_argument("--fail-rate", type=float, default=config.fail_rate, help="请求直接失败的概率")
+    parser.add_argument("--fail-status", type=int, default=config.fail_status, help="失败时返回的HTTP状态码")
+    parser.add_argument("--midstream-fail-rate", type=float, default=config.midstream_fail_rate, help="流式回答中途断开的概率")
+    args = parser.parse_args()
+
+    config.tokens_per_sec = args.tokens_per_sec
+    config.first_token_ms = args.first_token_ms
+    config.jitter_ms = args.jitter_ms
+    config.answer_tokens = args.answer_tokens
+    config.fail_rate = args.fail_rate
+    config.fail_status = args.fail_status
+    config.midstream_fail_rate = args.midstream_fail_rate
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+导入时间预算检查
+
+在新的子进程中用 python -X importtime 导入模块（默认 app.autogen_service），报告：
+- 总导入时间（重复多次取最小值，减少磁盘缓存和调度带来的抖动）
+- 累计耗时最多的模块
+- 不应在导入阶段加载的重量级模块（autogen_agentchat、autogen_ext、openai 等，应在第一次使用时才导入）
+超出预算或加载了重量级模块时以非0状态码退出，可以放在CI或部署前检查中。
+
+用法:
+    python bench/import_budget.py --budget-ms 1000
+    IMPORT_BUDGET_MS=800 python bench/import_budget.py --module main
+"""
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+PROJECT_DIR = BACKEND_DIR.parent.parent.parent
+
+# 导入预算（毫秒）
+IMPORT_BUDGET_MS: float = float(os.getenv("IMPORT_BUDGET_MS", "1000"))
+# 导入阶段不应加载的模块（逗号分隔）
+IMPORT_FORBIDDEN: str = os.getenv("IMPORT_FORBIDDEN", "autogen_agentchat,autogen_ext,openai,tiktoken")
+
+
+def measure(module: str) -> Tuple[float, Dict[str, float]]:
+    """在子进程中导入模块，返回 (总耗时毫秒, 各模块累计耗时毫秒)"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(PROJECT_DIR), str(BACKEND_DIR), env.get("PYTHONPATH")]))
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"导入 {module} 失败:\n{proc.stderr[-2000:]}")
+
+    cumulative: Dict[str, float] = {}
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cum, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cum) / 1000
+    return cumulative.get(module, 0.0), cumulative
+
+
+def top_modules(cumulative: Dict[str, float], target: str, limit: int) -> List[Tuple[str, float]]:
+    """累计耗时最多的顶层包（子模块的时间已经算在包里）"""
+    packages: Dict[str, float] = {}
+    for name, ms in cumulative.items():
+        if name == target:
+            continue
+        root = name.split(".")[0] if not name.startswith("app.") else name
+        packages[root] = max(packages.get(root, 0.0), ms)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导入时间预算检查")
+    parser.add_argument("--module", default="app.autogen_service", help="要检查的模块")
+    parser.add_argument("--budget-ms", type=float, default=IMPORT_BUDGET_MS, help="导入时间预算（毫秒）")
+    parser.add_argument("--repeat", type=int, default=3, help="重复测量次数，取最小值")
+    parser.add_argument("--top", type=int, default=10, help="显示耗时最多的模块数")
+    parser.add_argument("--forbid", default=IMPORT_FORBIDDEN, help="导入阶段不应加载的模块，逗号分隔")
+    args = parser.parse_args()
+
+    total, cumulative = min((measure(args.module) for _ in range(max(args.repeat, 1))), key=lambda item: item[0])
+    forbidden = [name for name in filter(None, args.forbid.split(",")) if name in cumulative]
+
+    print(f"{args.module}: {total:.1f} ms（预算 {args.budget_ms:.0f} ms，{args.repeat} 次取最小值）")
+    for name, ms in top_modules(cumulative, args.module, args.top):
+        print(f"  {ms:8.1f} ms  {name}")
+
+    failed = False
+    if total > args.budget_ms:
+        print(f"超出导入预算 {total - args.budget_ms:.1f} ms")
+        failed = True
+    if forbidden:
+        print(f"导入阶段加载了重量级模块: {', '.join(forbidden)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
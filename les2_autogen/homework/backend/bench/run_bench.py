@@ -0,0 +1,271 @@
+"""
+聊天后端压测脚本
+
+对 /api/v1/chat/stream、/api/v1/chat、/api/v1/sessions/search 施加并发负载，报告：
+- 请求延迟、首token时间（TTFT）的 p50/p95/p99
+- 每个流的 token/s、整体 RPS、错误数
+- 每个会话的内存占用（进程内模式读取本进程RSS，外部模式通过 --server-pid 读取服务进程RSS）
+
+用法:
+    # 1. 启动假模型服务
+    python bench/fake_llm.py --port 9999 --tokens-per-sec 100 --first-token-ms 200
+    # 2a. 进程内压测（自动把所有模型提供商指向假模型服务，使用临时数据库）
+    python bench/run_bench.py --in-process --fake-llm http://127.0.0.1:9999/v1 --scenario stream -c 20 -n 200
+    # 2b. 压测已启动的后端
+    python bench/run_bench.py --base-url http://127.0.0.1:8000 --server-pid <uvicorn进程id> --scenario all
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+SCENARIOS = ["stream", "chat", "search"]
+
+
+@dataclass
+class ScenarioResult:
+    """单个场景的测量结果"""
+    name: str
+    latencies: List[float] = field(default_factory=list)
+    ttfts: List[float] = field(default_factory=list)
+    tokens_per_sec: List[float] = field(default_factory=list)
+    tokens: int = 0
+    errors: int = 0
+    duration: float = 0.0
+    sessions: int = 0
+    rss_before: Optional[int] = None
+    rss_after: Optional[int] = None
+
+    def summary(self) -> Dict[str, Any]:
+        done = len(self.latencies)
+        result = {
+            "scenario": self.name,
+            "requests": done + self.errors,
+            "errors": self.errors,
+            "rps": round(done / self.duration, 2) if self.duration else 0.0,
+            "latency_ms": percentiles(self.latencies),
+        }
+        if self.ttfts:
+            result["ttft_ms"] = percentiles(self.ttfts)
+            result["tokens_per_sec_per_stream"] = percentiles(self.tokens_per_sec, scale=1)
+            result["tokens_per_sec_total"] = round(self.tokens / self.duration, 1) if self.duration else 0.0
+        if self.rss_before is not None and self.rss_after is not None and self.sessions:
+            result["memory_per_session_kb"] = round((self.rss_after - self.rss_before) / self.sessions / 1024, 1)
+        return result
+
+
+def percentiles(values: List[float], scale: float = 1000) -> Dict[str, Optional[float]]:
+    """最近秩法计算 p50/p95/p99（默认把秒转换为毫秒）"""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def pick(p):
+        index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+        return round(ordered[index] * scale, 2)
+
+    return {"p50": pick(50), "p95": pick(95), "p99": pick(99)}
+
+
+def read_rss(pid: Optional[int] = None) -> Optional[int]:
+    """读取进程的常驻内存（字节），仅支持Linux"""
+    path = Path(f"/proc/{pid or 'self'}/status")
+    try:
+        for line in path.read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+async def run_stream(client: httpx.AsyncClient, session_id: Optional[int], message: str, result: ScenarioResult):
+    """发送一次流式请求，记录TTFT、token速率和总延迟，返回会话id"""
+    params = {"message": message, "protocol": "delta"}
+    if session_id:
+        params["session_id"] = session_id
+
+    start = time.perf_counter()
+    first_token = None
+    tokens = 0
+    event = None
+    async with client.stream("GET", "/api/v1/chat/stream", params=params) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}")
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event = line[6:].strip()
+            elif line.startswith("data:") and event:
+                data = json.loads(line[5:])
+                if event == "session":
+                    session_id = data.get("session_id")
+                elif event == "chunk":
+                    tokens += 1
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                elif event == "error":
+                    raise RuntimeError(data.get("error"))
+                elif event == "complete":
+                    break
+    end = time.perf_counter()
+
+    result.latencies.append(end - start)
+    if first_token is not None:
+        result.ttfts.append(first_token - start)
+        if end > first_token:
+            result.tokens_per_sec.append(tokens / (end - first_token))
+    result.tokens += tokens
+    return session_id
+
+
+async def run_chat(client: httpx.AsyncClient, session_id: Optional[int], message: str, result: ScenarioResult):
+    """发送一次非流式请求，返回会话id"""
+    payload = {"message": message, "stream": False}
+    if session_id:
+        payload["session_id"] = session_id
+    start = time.perf_counter()
+    response = await client.post("/api/v1/chat", json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    result.latencies.append(time.perf_counter() - start)
+    return response.json()["data"]["session_id"]
+
+
+async def run_search(client: httpx.AsyncClient, session_id: Optional[int], message: str, result: ScenarioResult):
+    """发送一次搜索请求"""
+    start = time.perf_counter()
+    response = await client.post("/api/v1/sessions/search", json={"query": message[:20], "limit": 10})
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    result.latencies.append(time.perf_counter() - start)
+    return session_id
+
+
+RUNNERS = {"stream": run_stream, "chat": run_chat, "search": run_search}
+
+
+async def run_scenario(
+        client: httpx.AsyncClient,
+        name: str,
+        concurrency: int,
+        total: int,
+        turns_per_session: int,
+        server_pid: Optional[int]
+) -> ScenarioResult:
+    """以固定并发执行 total 次请求，每个工作协程每 turns_per_session 轮换一个新会话"""
+    result = ScenarioResult(name=name)
+    runner = RUNNERS[name]
+    counter = iter(range(total))
+    result.rss_before = read_rss(server_pid)
+
+    async def worker(worker_id: int):
+        session_id = None
+        turn = 0
+        for i in counter:
+            if turn % turns_per_session == 0:
+                session_id = None
+            message = f"压测问题 {worker_id}-{i}: 请介绍一下性能测试"
+            try:
+                new_session_id = await runner(client, session_id, message, result)
+                if session_id is None and new_session_id and name != "search":
+                    result.sessions += 1
+                session_id = new_session_id
+            except Exception as e:
+                result.errors += 1
+                print(f"[{name}] 请求失败: {e}", file=sys.stderr)
+            turn += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    result.duration = time.perf_counter() - start
+    result.rss_after = read_rss(server_pid)
+    return result
+
+
+def configure_in_process(fake_llm: str, llm_name: str) -> None:
+    """进程内模式：把模型提供商指向假模型服务，并使用临时数据库"""
+    os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db")
+    os.environ.setdefault("LOG_USE_QUEUE", "true")
+    sys.path.insert(0, str(BACKEND_DIR))
+    sys.path.insert(0, str(BACKEND_DIR.parent.parent.parent))
+    # 默认模型 gf、未知名称回退的 mota 都需要一并配置
+    for name in {llm_name, "gf", "mota"}:
+        os.environ[f"model_{name}"] = "fake-model"
+        os.environ[f"base_url_{name}"] = fake_llm
+        os.environ[f"api_key_{name}"] = "sk-fake"
+
+
+async def main_async(args) -> List[Dict[str, Any]]:
+    scenarios = SCENARIOS if args.scenario == "all" else [args.scenario]
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+
+    server = server_task = None
+    base_url = args.base_url
+    server_pid = args.server_pid
+    if args.in_process:
+        # 用真实的uvicorn服务而不是ASGITransport，后者会缓冲整个响应，测不出TTFT
+        configure_in_process(args.fake_llm, args.llm_name)
+        import uvicorn
+        from main import app
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+        server_task = asyncio.create_task(server.serve())
+        while not server.started:
+            if server_task.done():
+                server_task.result()
+            await asyncio.sleep(0.05)
+        base_url = f"http://127.0.0.1:{args.port}"
+        server_pid = None
+
+    client = httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits)
+
+    summaries = []
+    try:
+        for name in scenarios:
+            if args.warmup:
+                await run_scenario(client, name, min(args.concurrency, args.warmup), args.warmup, args.turns, server_pid)
+            result = await run_scenario(client, name, args.concurrency, args.requests, args.turns, server_pid)
+            summaries.append(result.summary())
+    finally:
+        await client.aclose()
+        if server is not None:
+            server.should_exit = True
+            await server_task
+    return summaries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天后端压测")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000", help="后端地址（外部模式）")
+    parser.add_argument("--server-pid", type=int, default=None, help="后端进程id，用于统计每会话内存（外部模式）")
+    parser.add_argument("--in-process", action="store_true", help="在本进程内启动后端应用进行压测")
+    parser.add_argument("--port", type=int, default=18000, help="进程内模式后端监听的端口")
+    parser.add_argument("--fake-llm", default="http://127.0.0.1:9999/v1", help="进程内模式使用的假模型服务地址")
+    parser.add_argument("--llm-name", default="gf", help="进程内模式指向假模型服务的模型提供商")
+    parser.add_argument("--scenario", choices=SCENARIOS + ["all"], default="stream")
+    parser.add_argument("-c", "--concurrency", type=int, default=10)
+    parser.add_argument("-n", "--requests", type=int, default=100, help="每个场景的请求总数")
+    parser.add_argument("--turns", type=int, default=3, help="每个会话的对话轮数")
+    parser.add_argument("--warmup", type=int, default=0, help="每个场景正式测量前的预热请求数")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", dest="json_path", default=None, help="把结果写入JSON文件")
+    args = parser.parse_args()
+
+    summaries = asyncio.run(main_async(args))
+    for summary in summaries:
+        print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(summaries, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,22 @@
 """
 FastAPI主应用程序入口
 """
+import asyncio
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 
-from app.database import init_db
-from app.routers import chat, sessions
+from app.database import init_db, close_db, engine
+from app.routers import archive, batch, chat, jobs, sessions, transfer, usage, ws_chat
+from app.archive import ARCHIVE_INTERVAL, archiver
+from app.autogen_service import autogen_service
+from app.coalesce import chat_flights
+from app.jobs import job_queue
+from app.persistence import persistence
+from app.telemetry import TelemetryMiddleware, collector, instrument_engine, registry
+from common.llms import client_registry
+from common.llm_router import router_stats
 
 
 @asynccontextmanager
@@ -14,9 +24,23 @@ async def lifespan(app: FastAPI):
     """应用程序生命周期管理"""
     # 启动时初始化数据库
     await init_db()
+    # 后台定期淘汰空闲的智能体
+    sweeper = asyncio.create_task(autogen_service.agent_cache.run_sweeper())
+    # 后台定期归档空闲会话、清除软删除的会话
+    archive_task = asyncio.create_task(archiver.run(ARCHIVE_INTERVAL)) if ARCHIVE_INTERVAL > 0 else None
     yield
     # 关闭时的清理工作
-    pass
+    sweeper.cancel()
+    if archive_task is not None:
+        archive_task.cancel()
+        await asyncio.gather(archive_task, return_exceptions=True)
+    # 取消未完成的异步任务
+    await job_queue.close()
+    await autogen_service.cleanup()
+    # 写完批量写入队列中剩余的消息
+    await persistence.close()
+    await close_db()
+    collector.close()
 
 
 # 创建FastAPI应用实例
@@ -36,9 +60,49 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 请求耗时和追踪（最后添加的中间件在最外层，耗时包含其他中间件）
+app.add_middleware(TelemetryMiddleware)
+
+# SQL执行耗时
+instrument_engine(engine)
+
+# 从已有统计导出的指标
+registry.callback_gauge("agent_cache_hit_rate", "智能体缓存命中率", lambda: autogen_service.agent_cache.stats()["hit_rate"])
+registry.callback_gauge("agent_cache_entries", "缓存的智能体数", lambda: autogen_service.agent_cache.stats()["entries"])
+registry.callback_gauge(
+    "response_cache_hit_rate", "回答缓存命中率",
+    lambda: autogen_service.response_cache.stats()["hit_rate"] if autogen_service.response_cache else None
+)
+registry.callback_gauge("chat_in_flight", "进行中的生成数（含已断开但仍在生成的）", lambda: chat_flights.stats()["in_flight"])
+registry.callback_gauge("persistence_queue_depth", "批量写入队列中等待的写操作数", lambda: persistence.stats()["queued"])
+registry.callback_gauge("job_queue_depth", "排队中的异步聊天任务数", lambda: job_queue.queued)
+registry.callback_gauge("jobs_running", "执行中的异步聊天任务数", lambda: job_queue.running)
+
+
+def limiter_metric(field: str):
+    """按提供商取限流器统计中的一项"""
+    return lambda: {name: stats[field] for name, stats in client_registry.limiter_stats().items()}
+
+
+registry.callback_gauge("llm_limiter_queue_depth", "在限流器中排队等待的模型请求数", limiter_metric("queue_depth"), ("provider",))
+registry.callback_gauge("llm_limiter_active", "已放行、执行中的模型请求数", limiter_metric("active"), ("provider",))
+registry.callback_gauge("llm_limiter_waiting_sessions", "有请求在排队的会话数", limiter_metric("waiting_sessions"), ("provider",))
+registry.callback_gauge("llm_limiter_max_wait_seconds", "单个请求的最长排队时间", limiter_metric("max_wait"), ("provider",))
+registry.callback_counter("llm_limiter_acquired_total", "通过限流器放行的请求数", limiter_metric("acquired"), ("provider",))
+registry.callback_counter(
+    "llm_limiter_wait_seconds_total", "排队等待时间累计（除以 acquired_total 的增量得到平均等待）",
+    limiter_metric("total_wait"), ("provider",)
+)
+
 # 注册路由
 app.include_router(chat.router, prefix="/api/v1", tags=["chat"])
 app.include_router(sessions.router, prefix="/api/v1", tags=["sessions"])
+app.include_router(ws_chat.router, prefix="/api/v1", tags=["chat"])
+app.include_router(jobs.router, prefix="/api/v1", tags=["chat"])
+app.include_router(batch.router, prefix="/api/v1", tags=["chat"])
+app.include_router(usage.router, prefix="/api/v1", tags=["usage"])
+app.include_router(transfer.router, prefix="/api/v1", tags=["transfer"])
+app.include_router(archive.router, prefix="/api/v1", tags=["archive"])
 
 
 @app.get("/")
@@ -50,7 +114,30 @@ async def root():
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
-    return {"status": "healthy", "message": "Service is running normally"}
+    return {
+        "status": "healthy",
+        "message": "Service is running normally",
+        "agent_cache": autogen_service.agent_cache.stats(),
+        "response_cache": autogen_service.response_cache.stats() if autogen_service.response_cache else None,
+        "agent_state": autogen_service.state_store.stats() if autogen_service.state_store else None,
+        "model_clients": client_registry.stats(),
+        "persistence": persistence.stats(),
+        "jobs": job_queue.stats(),
+        "archive": archiver.stats(),
+        "llm_router": router_stats()
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus 文本格式的指标"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/debug/traces")
+async def recent_traces(limit: int = Query(100, ge=1, le=1000), trace_id: str = None):
+    """进程内收集的最近 span"""
+    return {"exported": collector.exported, "spans": collector.recent(limit, trace_id)}
 
 
 if __name__ == "__main__":
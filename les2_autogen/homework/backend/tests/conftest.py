@@ -0,0 +1,18 @@
+"""
+测试配置
+
+在 backend 目录下运行: python -m pytest -q
+测试不访问网络和真实数据库，异步代码在同步测试中用 asyncio.run 执行。
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/test.db")
+os.environ.setdefault("LLM_ENV_FILE", "")
+# app 在 backend 下，common 在仓库根目录下
+sys.path.insert(0, str(BACKEND_DIR))
+sys.path.insert(0, str(BACKEND_DIR.parent.parent.parent))
@@ -0,0 +1,179 @@
+"""
+common/llm_router.py：熔断、故障转移和对冲的触发条件
+"""
+import asyncio
+import time
+from typing import Dict
+
+import pytest
+from autogen_core.models import CreateResult, RequestUsage, UserMessage
+
+from common import llm_router
+from common.llm_router import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, RouterModelClient
+from common.llms import track_served_provider
+
+MESSAGES = [UserMessage(content="你好", source="user")]
+
+
+class FakeClient:
+    """按设定的延迟返回或失败的模型客户端，记录调用次数"""
+
+    def __init__(self, name: str, delay: float = 0.0, fail: bool = False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def result(self) -> CreateResult:
+        return CreateResult(
+            finish_reason="stop",
+            content=self.name,
+            usage=RequestUsage(prompt_tokens=1, completion_tokens=1),
+            cached=False
+        )
+
+    async def create(self, messages, **kwargs) -> CreateResult:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f"{self.name} failed")
+        return self.result()
+
+    async def create_stream(self, messages, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError(f"{self.name} failed")
+        yield self.name
+        yield self.result()
+
+
+class FakeRegistry:
+    def __init__(self, clients: Dict[str, FakeClient]):
+        self.clients = clients
+
+    def get(self, name: str) -> FakeClient:
+        return self.clients[name]
+
+
+@pytest.fixture
+def providers(monkeypatch):
+    clients = {"p1": FakeClient("p1"), "p2": FakeClient("p2")}
+    monkeypatch.setattr(llm_router, "client_registry", FakeRegistry(clients))
+    return clients
+
+
+def make_router(**kwargs) -> RouterModelClient:
+    options = dict(hedge_delay=0, hedge_percentile=0, failure_threshold=2, cooldown=30, max_attempts=2)
+    options.update(kwargs)
+    return RouterModelClient(["p1", "p2"], **options)
+
+
+def test_circuit_opens_after_consecutive_failures(providers):
+    router = make_router()
+    router._record_failure("p1")
+    assert router._stats["p1"].state == CIRCUIT_CLOSED
+    router._record_failure("p1")
+    assert router._stats["p1"].state == CIRCUIT_OPEN
+    assert router.rank() == ["p2"]
+
+
+def test_half_open_allows_a_single_probe(providers):
+    router = make_router(cooldown=0.01)
+    router._record_failure("p1")
+    router._record_failure("p1")
+    time.sleep(0.02)
+    assert "p1" in router.rank()
+
+    router._begin("p1")
+    assert router._stats["p1"].state == CIRCUIT_HALF_OPEN
+    # 探测进行中，不再放行其他请求
+    assert router.rank() == ["p2"]
+
+    # 探测失败立即重新熔断
+    router._record_failure("p1")
+    assert router._stats["p1"].state == CIRCUIT_OPEN
+    assert router.rank() == ["p2"]
+
+
+def test_probe_success_closes_circuit(providers):
+    router = make_router(cooldown=0)
+    router._record_failure("p1")
+    router._record_failure("p1")
+    router._begin("p1")
+    router._record_success("p1", 0.1)
+    assert router._stats["p1"].state == CIRCUIT_CLOSED
+    assert router._stats["p1"].consecutive_failures == 0
+
+
+def test_create_fails_over_and_reports_served_provider(providers):
+    providers["p1"].fail = True
+    router = make_router()
+
+    async def scenario():
+        served = track_served_provider("auto")
+        result = await router.create(MESSAGES)
+        return result, served.name
+
+    result, served = asyncio.run(scenario())
+    assert result.content == "p2"
+    assert served == "p2"
+    assert router._stats["p1"].failures == 1
+
+
+def test_create_raises_when_every_provider_fails(providers):
+    providers["p1"].fail = True
+    providers["p2"].fail = True
+    router = make_router()
+    with pytest.raises(RuntimeError, match="failed"):
+        asyncio.run(router.create(MESSAGES))
+    assert providers["p1"].calls == providers["p2"].calls == 1
+
+
+def test_create_does_not_hedge_without_enough_samples(providers):
+    providers["p1"].delay = 0.1
+    router = make_router(hedge_percentile=95, hedge_min_samples=3)
+    router._stats["p1"].record_completion(0.001, router.alpha)
+    assert router.completion_hedge_delay("p1") is None
+
+    result = asyncio.run(router.create(MESSAGES))
+    assert result.content == "p1"
+    assert providers["p2"].calls == 0
+
+
+def test_create_hedges_past_latency_percentile(providers):
+    providers["p1"].delay = 0.5
+    router = make_router(hedge_percentile=95, hedge_min_samples=3)
+    for _ in range(3):
+        router._stats["p1"].record_completion(0.01, router.alpha)
+    assert router.completion_hedge_delay("p1") == pytest.approx(0.01)
+
+    result = asyncio.run(router.create(MESSAGES))
+    assert result.content == "p2"
+    assert providers["p1"].calls == providers["p2"].calls == 1
+    # 被取消的一方不计为失败
+    assert router._stats["p1"].failures == 0
+
+
+def test_stream_hedges_after_first_token_delay(providers):
+    providers["p1"].delay = 0.5
+    router = make_router(hedge_delay=0.02)
+
+    async def scenario():
+        return [item async for item in router.create_stream(MESSAGES)]
+
+    items = asyncio.run(scenario())
+    assert items[0] == "p2"
+    assert providers["p2"].calls == 1
+
+
+def test_stream_without_hedge_delay_waits_for_primary(providers):
+    providers["p1"].delay = 0.05
+    router = make_router(hedge_delay=0)
+
+    async def scenario():
+        return [item async for item in router.create_stream(MESSAGES)]
+
+    items = asyncio.run(scenario())
+    assert items[0] == "p1"
+    assert providers["p2"].calls == 0
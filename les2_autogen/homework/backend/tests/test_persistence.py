@@ -0,0 +1,143 @@
+"""
+app/persistence.py：批次内的执行顺序、提交后返回结果、单个操作失败的传播和隔离
+"""
+import asyncio
+from typing import Any, List
+
+import pytest
+
+from app.persistence import WriteBehindQueue
+
+
+class FakeStore:
+    """记录每次提交包含的操作；未提交的操作随会话关闭丢弃（相当于回滚）"""
+
+    def __init__(self, fail_commit: bool = False):
+        self.commits: List[List[Any]] = []
+        self.fail_commit = fail_commit
+
+    def session(self) -> "FakeSession":
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, store: FakeStore):
+        self.store = store
+        self.pending: List[Any] = []
+
+    async def __aenter__(self) -> "FakeSession":
+        return self
+
+    async def __aexit__(self, *exc_info) -> bool:
+        return False
+
+    async def commit(self) -> None:
+        if self.store.fail_commit:
+            raise RuntimeError("disk I/O error")
+        self.store.commits.append(self.pending)
+
+
+def write(value: Any):
+    async def op(db: FakeSession) -> Any:
+        db.pending.append(value)
+        return value
+    return op
+
+
+def fail(message: str):
+    async def op(db: FakeSession) -> Any:
+        db.pending.append("bad")
+        raise ValueError(message)
+    return op
+
+
+def test_concurrent_ops_share_one_commit_in_submit_order():
+    store = FakeStore()
+    queue = WriteBehindQueue(store.session, batch_ms=5)
+
+    async def scenario():
+        results = await asyncio.gather(*(queue.run(write(i)) for i in range(5)))
+        await queue.close()
+        return results
+
+    assert asyncio.run(scenario()) == [0, 1, 2, 3, 4]
+    assert store.commits == [[0, 1, 2, 3, 4]]
+    assert queue.stats()["batches"] == 1
+
+
+def test_batch_max_splits_batches_in_order():
+    store = FakeStore()
+    queue = WriteBehindQueue(store.session, batch_ms=5, batch_max=2)
+
+    async def scenario():
+        await asyncio.gather(*(queue.run(write(i)) for i in range(5)))
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert store.commits == [[0, 1], [2, 3], [4]]
+    assert queue.stats()["max_batch"] == 2
+
+
+def test_failed_op_is_isolated_and_raised_to_its_caller():
+    store = FakeStore()
+    queue = WriteBehindQueue(store.session, batch_ms=5)
+
+    async def scenario():
+        results = await asyncio.gather(
+            queue.run(write("a")), queue.run(fail("会话不存在")), queue.run(write("b")),
+            return_exceptions=True
+        )
+        await queue.close()
+        return results
+
+    first, error, last = asyncio.run(scenario())
+    assert (first, last) == ("a", "b")
+    assert isinstance(error, ValueError) and str(error) == "会话不存在"
+    # 整批回滚后逐个重试，失败操作的写入不会被提交
+    assert store.commits == [["a"], ["b"]]
+    assert queue.stats()["retried_batches"] == 1
+    assert queue.stats()["failed"] == 1
+
+
+def test_commit_failure_propagates():
+    store = FakeStore(fail_commit=True)
+    queue = WriteBehindQueue(store.session, batch_ms=0)
+
+    async def scenario():
+        with pytest.raises(RuntimeError, match="disk I/O error"):
+            await queue.run(write(1))
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert store.commits == []
+
+
+def test_enqueue_failure_does_not_raise_and_close_flushes():
+    store = FakeStore()
+    queue = WriteBehindQueue(store.session, batch_ms=5)
+
+    async def scenario():
+        queue.enqueue(fail("ignored"))
+        queue.enqueue(write(1))
+        queue.enqueue(write(2))
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert store.commits == [[1], [2]]
+    assert queue.stats()["queued"] == 0
+
+
+def test_cancelled_caller_still_writes():
+    store = FakeStore()
+    queue = WriteBehindQueue(store.session, batch_ms=20)
+
+    async def scenario():
+        caller = asyncio.create_task(queue.run(write("kept")))
+        await asyncio.sleep(0)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await queue.close()
+
+    asyncio.run(scenario())
+    assert store.commits == [["kept"]]
@@ -0,0 +1,130 @@
+"""
+common/rate_limit.py：令牌桶补充、TPM多退少补、按会话公平排队
+"""
+import asyncio
+
+import pytest
+
+from common import rate_limit
+from common.rate_limit import ProviderLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_refills_at_per_minute_rate(clock):
+    bucket = TokenBucket(60)
+    bucket.consume(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0)
+
+    clock.now += 30
+    assert bucket.wait_time(30) == 0.0
+    assert bucket.tokens == pytest.approx(30)
+
+
+def test_bucket_is_capped_at_capacity(clock):
+    bucket = TokenBucket(60)
+    bucket.consume(10)
+    clock.now += 3600
+    bucket.wait_time(1)
+    assert bucket.tokens == pytest.approx(60)
+    # 超过容量的请求按容量计算，不会永远等待
+    bucket.consume(60)
+    assert bucket.wait_time(1000) == pytest.approx(60.0)
+
+
+def test_bucket_refund_corrects_reservation(clock):
+    bucket = TokenBucket(1000)
+    bucket.consume(600)
+    bucket.refund(500)
+    assert bucket.tokens == pytest.approx(900)
+    # 实际用量超过预留时追加扣除
+    bucket.refund(-200)
+    assert bucket.tokens == pytest.approx(700)
+
+
+def test_release_refunds_unused_tpm(clock):
+    async def scenario():
+        limiter = ProviderLimiter("p", tpm=1000)
+        await limiter.acquire("s", 600)
+        assert limiter.tpm_bucket.tokens == pytest.approx(400)
+        limiter.release(600, 100)
+        assert limiter.tpm_bucket.tokens == pytest.approx(900)
+        assert limiter.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_sessions_are_served_round_robin():
+    async def scenario():
+        limiter = ProviderLimiter("p", max_concurrency=1)
+        order = []
+
+        async def request(session: str, label: str):
+            await limiter.acquire(session, 1)
+            order.append(label)
+            await asyncio.sleep(0)
+            limiter.release(1)
+
+        # 占住唯一的并发名额，让后续请求排队
+        await limiter.acquire("holder", 1)
+        tasks = []
+        for session, label in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")):
+            tasks.append(asyncio.create_task(request(session, label)))
+            await asyncio.sleep(0)
+        assert limiter.stats()["queue_depth"] == 4
+        assert limiter.stats()["waiting_sessions"] == 2
+
+        limiter.release(1)
+        await asyncio.gather(*tasks)
+        return order
+
+    # 会话 a 的突发请求不会让会话 b 排到最后
+    assert asyncio.run(scenario()) == ["a1", "b1", "a2", "a3"]
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def scenario():
+        limiter = ProviderLimiter("p", max_concurrency=1)
+        await limiter.acquire("a", 1)
+        waiter = asyncio.create_task(limiter.acquire("b", 1))
+        await asyncio.sleep(0)
+        assert limiter.stats()["queue_depth"] == 1
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.stats()["queue_depth"] == 0
+        assert limiter.stats()["waiting_sessions"] == 0
+
+        # 名额释放后新的请求可以立即获得
+        limiter.release(1)
+        await asyncio.wait_for(limiter.acquire("c", 1), 1)
+        assert limiter.stats()["active"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_rpm_limit_delays_until_refill():
+    async def scenario():
+        # 每秒补充 10 个，容量 600：先耗尽，再确认下一个请求需要等待补充
+        limiter = ProviderLimiter("p", rpm=600)
+        limiter.rpm_bucket.consume(600)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.wait_for(limiter.acquire("a", 1), 2)
+        return loop.time() - start
+
+    assert asyncio.run(scenario()) >= 0.05
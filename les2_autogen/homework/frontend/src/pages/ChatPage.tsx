@@ -114,7 +114,10 @@ const ChatPage: React.FC = () => {
       es.addEventListener('chunk', (event) => {
         try {
           const data = JSON.parse(event.data)
-          assistantContent = data.full_content || data.content
+          // 增量协议下拼接delta，兼容旧的full_content协议
+          assistantContent = data.delta !== undefined
+            ? assistantContent + data.delta
+            : data.full_content || data.content
 
           if (!assistantMessage) {
             assistantMessage = {
@@ -136,6 +139,20 @@ const ChatPage: React.FC = () => {
         }
       })
 
+      // 断线重连后缓冲区已不足以逐块回放时，服务端发送截至当前的完整内容
+      es.addEventListener('snapshot', (event) => {
+        try {
+          const data = JSON.parse(event.data)
+          assistantContent = data.content
+          if (assistantMessage) {
+            assistantMessage.content = assistantContent
+            setStreamingMessage({ ...assistantMessage })
+          }
+        } catch (error) {
+          console.error('解析snapshot事件失败:', error)
+        }
+      })
+
       es.addEventListener('complete', (event) => {
         try {
           const data = JSON.parse(event.data)
@@ -169,6 +186,11 @@ const ChatPage: React.FC = () => {
       })
 
       es.onerror = (error) => {
+        // 浏览器正在自动重连（携带Last-Event-ID，服务端从断点继续），无需中断
+        if (es.readyState === EventSource.CONNECTING) {
+          console.warn('SSE连接中断，正在重连...')
+          return
+        }
         console.error('SSE连接错误:', error)
         message.error('连接中断，请重试')
         setStatus('error')
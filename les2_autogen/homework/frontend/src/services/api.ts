@@ -71,7 +71,7 @@ export const sessionAPI = {
     api.delete(`/sessions/${id}/clear`),
 
   // 搜索会话
-  search: (data: SearchRequest): Promise<BaseResponse<{ sessions: ChatSession[], total: number, query: string }>> =>
+  search: (data: SearchRequest): Promise<BaseResponse<{ sessions: ChatSession[], total: number, query: string, next_cursor?: string | null }>> =>
     api.post('/sessions/search', data),
 }
 
@@ -94,6 +94,8 @@ export const chatAPI = {
     if (data.stream !== undefined) {
       url.searchParams.append('stream', data.stream.toString())
     }
+    // 使用增量协议：chunk事件只携带增量内容
+    url.searchParams.append('protocol', 'delta')
 
     return new EventSource(url.toString())
   },
@@ -18,6 +18,7 @@ export interface ChatSession {
   temperature: string
   max_tokens: number
   message_count: number
+  snippet?: string | null
 }
 
 // 聊天消息类型
@@ -60,6 +61,7 @@ export interface UpdateSessionRequest {
 export interface SearchRequest {
   query: string
   limit?: number
+  cursor?: string
 }
 
 // 分页响应